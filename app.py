@@ -1,13 +1,18 @@
 import os
+import json
 import geopandas as gpd
 import sqlalchemy
 import networkx as nx
 import pandas as pd
 import numpy as np
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS, cross_origin  # needs to be installed via pip install flask-cors
 import logging
-from sqlalchemy.orm import sessionmaker
+import random
+import time
+import threading
+import shapely
+from sqlalchemy import text
 
 
 from ebike_city_tools.graph_utils import (
@@ -18,19 +23,28 @@ from ebike_city_tools.graph_utils import (
 )
 
 from shapely.geometry import Polygon
-from ebike_city_tools.iterative_algorithms import topdown_betweenness_pareto, betweenness_pareto
-from ebike_city_tools.od_utils import extend_od_circular
-from ebike_city_tools.optimize.round_optimized import ParetoRoundOptimize
+from ebike_city_tools.od_utils import extend_od_circular, ODSnapper
+from ebike_city_tools.app_jobs import JobQueue, FINISHED, FAILED
+from ebike_city_tools.profiling import REQUEST_LATENCY, render_metrics, timed_span
 from ebike_city_tools.app_utils import (
-    get_database_connector,
+    get_pooled_engine,
+    get_pool_metrics,
+    db_session,
+    BaseDataCache,
+    copy_insert,
+    COPY_CHUNKSIZE,
     generate_od_nodes,
     generate_od_geometry,
     get_expected_time,
     compute_nr_variables,
-    recreate_lane_graph,
+    RunGraphCache,
+    get_distance_per_lane_type,
     get_mode_subgraph,
     get_degree_ratios,
     get_network_bearings,
+    get_result_key,
+    ODOriginIndex,
+    select_in_polygon,
     )
 from ebike_city_tools.metrics import compute_travel_times_in_graph
 from collections import Counter
@@ -58,29 +72,46 @@ FULL_GRAPH = "_full" # set to "" to use the version with simplified geometries
 maxspeed_fill_val = 50
 include_lanetypes = ["H>", "H<", "M>", "M<", "M-"]
 fixed_lanetypes = ["H>", "<H"]
-algorithm_dict = {
-    "betweenness_topdown": (topdown_betweenness_pareto, {}),
-    "betweenness_cartime": (betweenness_pareto, {"betweenness_attr": "car_time"}),
-    "betweenness_biketime": (betweenness_pareto, {"betweenness_attr": "bike_time"}),
-}
+# optimization jobs run in the background, their status is stored in a local SQLite file
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", "jobs.sqlite")
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 2))
+MAX_JOBS_PER_PROJECT = int(os.environ.get("MAX_JOBS_PER_PROJECT", 1))
+# seed for extending the OD matrix, so that the same area always yields the same OD matrix (see get_result_key)
+OD_EXTENSION_SEED = 42
 
 app = Flask(__name__)
 CORS(app, origins=["*", "null"])  # allowing any origin as well as localhost (null)
 
-# load main nodes and edges that will be used for any graph
-db_connector = get_database_connector(DB_LOGIN_PATH)
-zurich_edges = gpd.read_postgis("SELECT * FROM zurich.edges"+FULL_GRAPH, db_connector, geom_col="geometry").set_index(
-    ["u", "v"]
-)
-zurich_nodes = gpd.read_postgis(
-    "SELECT * FROM zurich.nodes"+FULL_GRAPH, db_connector, geom_col="geometry", index_col="osmid"
-)
-print("Loaded nodes and edges for Zurich from server", len(zurich_nodes), len(zurich_edges))
-trips_microcensus = gpd.read_postgis(
-    "SELECT * FROM zurich.trips_microcensus", db_connector, geom_col="geometry"
-)
-od_zurich = pd.read_sql("SELECT * FROM zurich.od_matrix"+FULL_GRAPH, db_connector)
-print("Loaded OD matrix for Zurich", len(od_zurich))
+db_connector = get_pooled_engine(DB_LOGIN_PATH)
+# the city-wide data is loaded on first use, from a local memory-mapped copy that is shared by all processes
+base_data_cache = BaseDataCache(db_connector, schema="zurich")
+base_data = {}
+base_data_lock = threading.Lock()
+
+
+def get_base_data() -> dict:
+    """Load main nodes, edges and OD data that will be used for any graph (only once per process)"""
+    with base_data_lock:
+        if len(base_data) > 0:
+            return base_data
+        zurich_edges = base_data_cache.load("edges" + FULL_GRAPH, geom_col="geometry").set_index(["u", "v"])
+        zurich_nodes = base_data_cache.load("nodes" + FULL_GRAPH, geom_col="geometry", index_col="osmid")
+        print("Loaded nodes and edges for Zurich", len(zurich_nodes), len(zurich_edges))
+        trips_microcensus = base_data_cache.load(
+            "trips_microcensus", columns=["start_lng", "start_lat", "end_lng", "end_lat", "count"]
+        )
+        od_zurich = base_data_cache.load("od_matrix" + FULL_GRAPH)
+        print("Loaded OD matrix for Zurich", len(od_zurich))
+
+        base_data["zurich_nodes"] = zurich_nodes
+        base_data["zurich_edges"] = zurich_edges
+        # keep trip origins and destinations as arrays for snapping them to the nodes
+        base_data["od_snapper"] = ODSnapper.from_dataframe(trips_microcensus, crs=CRS)
+        # spatial indices for selecting the nodes and edges in an area, and OD matrix indexed by origin node
+        base_data["zurich_nodes_tree"] = shapely.STRtree(zurich_nodes.geometry.values)
+        base_data["zurich_edges_tree"] = shapely.STRtree(zurich_edges.geometry.values)
+        base_data["od_zurich_index"] = ODOriginIndex(od_zurich)
+    return base_data
 
 # # DEPRECATED VERSION WITHOUT DATABASE:
 # zurich_nodes = gpd.read_file(os.path.join(PATH_DATA, "street_graph_nodes.gpkg")).to_crs(CRS).set_index("osmid")
@@ -110,12 +141,36 @@ print("Loaded OD matrix for Zurich", len(od_zurich))
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 logger = logging.getLogger(__name__)
 
+# headers and bodies are only logged for a sample of the requests, and bodies are truncated
+LOG_BODY_SAMPLE_RATE = float(os.environ.get("LOG_BODY_SAMPLE_RATE", 0.01))
+LOG_BODY_MAX_BYTES = int(os.environ.get("LOG_BODY_MAX_BYTES", 2048))
+
+
 @app.before_request
 def log_request_info():
+    g.request_start = time.perf_counter()
     logger.info(f"Incoming request: {request.method} {request.url}")
-    logger.info(f"Headers: {dict(request.headers)}")
-    if request.method in ["POST", "PUT", "PATCH"]:
-        logger.info(f"Body: {request.get_data()}")
+    if random.random() < LOG_BODY_SAMPLE_RATE:
+        logger.info(f"Headers: {dict(request.headers)}")
+        if request.method in ["POST", "PUT", "PATCH"]:
+            body = request.get_data()
+            logger.info(f"Body ({len(body)} bytes): {body[:LOG_BODY_MAX_BYTES]}")
+
+
+@app.after_request
+def record_request_latency(response):
+    if "request_start" in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unknown"
+        REQUEST_LATENCY.observe(time.perf_counter() - g.request_start, endpoint, request.method, response.status_code)
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Request latencies, durations of the request and optimization phases, and database and cache state for Prometheus"""
+    gauges = {f"ebike_db_pool_{key}": value for key, value in get_pool_metrics(db_connector).items()}
+    gauges.update({f"ebike_run_cache_{key}": value for key, value in run_cache.stats().items()})
+    return Response(render_metrics(gauges), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/construct_graph", methods=["POST"])
@@ -143,11 +198,11 @@ def generate_input_graph():
         area_polygon = Polygon(bounds_polygon)
     except ValueError:
         return (jsonify("Coordinates have wrong format. Check the documentation."), 400)
-    area_polygon = gpd.GeoDataFrame(geometry=[area_polygon], crs=CRS)
-
     # restrict graph to Polygon
-    zurich_nodes_area = zurich_nodes.sjoin(area_polygon)
-    zurich_edges_area = zurich_edges.sjoin(area_polygon)
+    base = get_base_data()
+    zurich_nodes_area = select_in_polygon(base["zurich_nodes"], base["zurich_nodes_tree"], area_polygon)
+    zurich_edges_area = select_in_polygon(base["zurich_edges"], base["zurich_edges_tree"], area_polygon)
+    area_polygon = gpd.GeoDataFrame(geometry=[area_polygon], crs=CRS)
     # if the graph is empty, return message
     if len(zurich_edges_area) == 0:
         return (jsonify("No edges found in this area. Try with other coordinates."), 400)
@@ -157,84 +212,76 @@ def generate_input_graph():
 
     # create OD matrix
     if od_creation_mode == "fast":
-        od = generate_od_nodes(od_zurich, zurich_nodes_area)
+        od = generate_od_nodes(base["od_zurich_index"], zurich_nodes_area)
     elif od_creation_mode == "slow":
-        od = generate_od_geometry(area_polygon, trips_microcensus, zurich_nodes_area)
+        od = generate_od_geometry(area_polygon, base["od_snapper"], zurich_nodes_area)
     else:
         return (jsonify("Wrong value for odmode argument. Must be one of {slow, fast}"), 400)
 
     # create graph
-    lane_graph = street_to_lane_graph(
-        zurich_nodes_area,
-        zurich_edges_area,
-        maxspeed_fill_val=maxspeed_fill_val,
-        include_lanetypes=include_lanetypes,
-        fixed_lanetypes=fixed_lanetypes,
-        target_crs=CRS,
-    )
-    # reduce to largest connected component
-    lane_graph = keep_only_the_largest_connected_component(lane_graph)
+    with timed_span("graph_construction"):
+        lane_graph = street_to_lane_graph(
+            zurich_nodes_area,
+            zurich_edges_area,
+            maxspeed_fill_val=maxspeed_fill_val,
+            include_lanetypes=include_lanetypes,
+            fixed_lanetypes=fixed_lanetypes,
+            target_crs=CRS,
+        )
+        # reduce to largest connected component
+        lane_graph = keep_only_the_largest_connected_component(lane_graph)
 
     # we need to extend the OD matrix to guarantee connectivity of the car network
     od = od[od["s"] != od["t"]]
     node_list = list(lane_graph.nodes())
     od = od[(od["s"].isin(node_list)) & (od["t"].isin(node_list))]
-    od_matrix_area_extended = extend_od_circular(od, node_list)
+    od_matrix_area_extended = extend_od_circular(od, node_list, seed=OD_EXTENSION_SEED)
 
     # estimate runtime
     nr_variables = compute_nr_variables(lane_graph.number_of_edges(), len(od_matrix_area_extended))
     runtime_min = get_expected_time(nr_variables)
 
-    # save nodes for the geometry
-    
-    connector = get_database_connector(DB_LOGIN_PATH)
-    # Create a new project
-    session = None
+    # save the new project with its geometry, nodes, edges and OD matrix in one transaction, such that no partial
+    # project is left behind if one of the writes fails
     try:
-        Session = sessionmaker(bind=connector)
-        session = Session()
-        cursor = session.connection().connection.cursor()
-        cursor.execute(
-            f"INSERT INTO webapp.projects (prj_name, runtime_min) VALUES ('{project_name}', {np.round(runtime_min,2)}) RETURNING id"
-        )
-        project_id = cursor.fetchone()[0]
-        session.commit()
+        with timed_span("db_write"), db_connector.begin() as con:
+            # Create a new project
+            project_id = con.execute(
+                text("INSERT INTO webapp.projects (prj_name, runtime_min) VALUES (:prj_name, :runtime_min) RETURNING id"),
+                {"prj_name": project_name, "runtime_min": float(np.round(runtime_min, 2))},
+            ).scalar()
+
+            area_polygon['id_prj'] = project_id
+            area_polygon.to_postgis(
+                f"bounds", con, schema=SCHEMA, if_exists="append", index=False
+            )
+
+            # save nodes for the geometry
+            zurich_nodes_area['id_prj'] = project_id
+            save_nodes = zurich_nodes_area.reset_index().rename({"osmid": "id_node"}, axis=1)[
+                ["id_prj","id_node"]
+            ]  # only save geometry and id
+            save_nodes.to_sql(
+                f"nodes", con, schema=SCHEMA, if_exists="append", index=False, method=copy_insert, chunksize=COPY_CHUNKSIZE
+            )
+
+            # save edges for constructing the graph later
+            save_edges = nx.to_pandas_edgelist(lane_graph, edge_key="edge_key")[
+                ["source", "target", "edge_key", "fixed", "lanetype", "distance", "gradient", "speed_limit"]
+            ]
+            save_edges['id_prj'] = project_id
+            save_edges.to_sql(
+                f"edges", con, schema=SCHEMA, if_exists="append", index=False, method=copy_insert, chunksize=COPY_CHUNKSIZE
+            )
+
+            # save OD matrix
+            od_matrix_area_extended['id_prj'] = project_id
+            od_matrix_area_extended.rename(columns={'s': 'source', 't': 'target'}, inplace=True)
+            od_matrix_area_extended.to_sql(
+                f"od", con, schema=SCHEMA, if_exists="append", index=False, method=copy_insert, chunksize=COPY_CHUNKSIZE
+            )
     except Exception as e:
-        if session:
-            session.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        if session:
-            session.close()
-        
-    area_polygon['id_prj'] = project_id
-    area_polygon.to_postgis(
-        f"bounds", connector, schema=SCHEMA, if_exists="append", index=False
-    )
-    
-    zurich_nodes_area['id_prj'] = project_id
-    save_nodes = zurich_nodes_area.reset_index().rename({"osmid": "id_node"}, axis=1)[
-        ["id_prj","id_node"]
-    ]  # only save geometry and id
-    
-    save_nodes.to_sql(
-        f"nodes", connector, schema=SCHEMA, if_exists="append", index=False
-    )
-    
-    # save edges for constructing the graph later
-    save_edges = nx.to_pandas_edgelist(lane_graph, edge_key="edge_key")[
-        ["source", "target", "edge_key", "fixed", "lanetype", "distance", "gradient", "speed_limit"]
-    ]
-    save_edges['id_prj'] = project_id
-    save_edges.to_sql(f"edges", connector, schema=SCHEMA, if_exists="append", index=False)
-    
-    
-    # save OD matrix
-    od_matrix_area_extended['id_prj'] = project_id
-    od_matrix_area_extended.rename(columns={'s': 'source', 't': 'target'}, inplace=True)
-    od_matrix_area_extended.to_sql(
-        f"od", connector, schema=SCHEMA, if_exists="append", index=False
-    )
 
     return (jsonify({"project_id": project_id, "variables": nr_variables, "expected_runtime": runtime_min}), 200)
 
@@ -242,9 +289,8 @@ def generate_input_graph():
 @app.route("/get_new_run_id", methods=["GET"])
 def get_new_run_id():
     project_id = int(request.args.get("project_id"))
-    connector = get_database_connector(DB_LOGIN_PATH)
     try:
-        run_id = pd.read_sql(f"SELECT MAX(id_run) FROM {SCHEMA}.runs WHERE id_prj = {project_id}", connector)
+        run_id = pd.read_sql(f"SELECT MAX(id_run) FROM {SCHEMA}.runs WHERE id_prj = {project_id}", db_connector)
         if run_id.empty or run_id.iloc[0][0] is None:
             run_id = 1
         else:
@@ -267,6 +313,8 @@ def optimize():
         car_weight: Weighting of the car travel time in the objective function. Should be something between 0.1 and 10
         bike_safety_penalty: factor by how much the perceived bike travel time increases if cycling on car lane.
             Defaults to 2, i.e. the perceived travel time on a car lane is twice as much as the one on a bike lane
+    The optimization runs in the background. Returns the job ID, which can be used to query the progress with
+    get_job_status, the pareto frontier computed so far with get_job_pareto, or to stop the job with cancel_job
     e.g. test with
     curl -X GET "http://localhost:8989/optimize?project_id=test&algorithm=betweenness_biketime&run_name=1&bike_ratio=0.1"
     """
@@ -280,140 +328,275 @@ def optimize():
     shared_lane_factor = float(request.args.get("bike_safety_penalty", "2"))
     
     
-    connector = get_database_connector(DB_LOGIN_PATH)
     try:
-        edges = pd.read_sql(f"SELECT * FROM {SCHEMA}.edges WHERE id_prj = {project_id}", connector)
-        od = pd.read_sql(f"SELECT * FROM {SCHEMA}.od WHERE id_prj = {project_id}", connector)
+        with timed_span("db_read"):
+            edges = pd.read_sql(f"SELECT * FROM {SCHEMA}.edges WHERE id_prj = {project_id}", db_connector)
+            od = pd.read_sql(f"SELECT * FROM {SCHEMA}.od WHERE id_prj = {project_id}", db_connector)
         
         
         edges = edges[["source", "target", "edge_key", "fixed","lanetype","distance","gradient","speed_limit"]]
         edges["capacity"] = 1 # since it's a lane graph with one edge per lane, every edge has capacity 1
         od.rename(columns={'source': 's', 'target': 't'}, inplace=True)
         od = od[["s", "t", "trips"]]
-        
-        # Fetch run_id from the database after insertion
-        run_id = pd.read_sql(f"SELECT MAX(id_run) FROM {SCHEMA}.runs WHERE id_prj = {project_id}", connector)
-        print("run Id: --> ", run_id.iloc[0][0])
-        if run_id.empty or run_id.iloc[0][0] is None:
-            run_id = 1
-        else:
-            run_id = int(run_id.iloc[0][0]) + 1
-
-        
     except:
         return (
             jsonify("Problem loading project from database. To start a new project, call `construct_graph` first"),
             400,
         )
-    lane_graph = nx.from_pandas_edgelist(
-        edges,
-        edge_key="edge_key",
-        edge_attr=[col for col in edges.columns if col not in ["source", "target", "edge_key"]],
-        create_using=nx.MultiDiGraph,
-    )
-    run_list = pd.DataFrame({
-        "id_prj": [project_id],
-        "algorithm": [algorithm],
-        "bike_ratio": [ratio_bike_edges],
-        "optimize_frequency": [optimize_every_x],
-        "car_weight": [car_weight],
-        "bike_safety_penalty": [shared_lane_factor],
-        "run_name": [run_name],
-    })
-   
 
     # compute the absolute number of bike lanes that are desired
-    desired_edge_count = int(ratio_bike_edges * lane_graph.number_of_edges())
-    print("Desired edges", desired_edge_count, lane_graph.number_of_edges(), len(od))
-
-    if "betweenness" in algorithm:
-
-        print(f"Running betweenness algorithm {algorithm}")
-        # get algorithm method
-        algorithm_func, kwargs = algorithm_dict[algorithm]
-
-        # run betweenness centrality algorithm for comparison
-        result_graph, pareto_df = algorithm_func(
-            lane_graph.copy(),
-            sp_method=SP_METHOD,
-            od_matrix=od,
-            weight_od_flow=WEIGHT_OD_FLOW,
-            fix_multilane=FIX_MULTILANE,
-            shared_lane_factor=shared_lane_factor,
-            save_graph_path=None,
-            return_graph_at_edges=desired_edge_count,
-            **kwargs,
-        )
-    else:
-        # potentially only extend OD matrix for the optimzation algorithm and not for the betweenness algorithm
-        # od = extend_od_circular(od, node_list)
-
-        opt = ParetoRoundOptimize(
-            lane_graph.copy(),
-            od.copy(),
-            optimize_every_x=optimize_every_x,
-            car_weight=car_weight,
-            sp_method=SP_METHOD,
-            shared_lane_factor=shared_lane_factor,
-            weight_od_flow=WEIGHT_OD_FLOW,
-            valid_edges_k=0,
+    nr_lanes = len(edges.drop_duplicates(subset=["source", "target", "edge_key"]))
+    desired_edge_count = int(ratio_bike_edges * nr_lanes)
+    print("Desired edges", desired_edge_count, nr_lanes, len(od))
+
+    params = {
+        "algorithm": algorithm,
+        "bike_ratio": ratio_bike_edges,
+        "desired_edge_count": desired_edge_count,
+        "optimize_every_x": optimize_every_x,
+        "car_weight": car_weight,
+        "shared_lane_factor": shared_lane_factor,
+        "sp_method": SP_METHOD,
+        "weight_od_flow": WEIGHT_OD_FLOW,
+        "fix_multilane": FIX_MULTILANE,
+    }
+    # identical inputs yield identical results, so the rows of an earlier run with the same inputs can be copied
+    params["result_key"] = get_result_key(edges, od, params)
+    cached_run = load_cached_result(params["result_key"])
+    if cached_run is not None:
+        job_id = job_queue.job_table.create(project_id, run_name, params, desired_edge_count)
+        try:
+            run_id = copy_cached_run(
+                {"id_prj": project_id, "run_name": run_name, "params": params}, *cached_run
+            )
+        except Exception as e:
+            # copying failed (e.g. the cached run was deleted) -> run the optimization instead
+            print("Copying cached run failed, optimizing instead:", e)
+            job_queue.job_table.set_status(job_id, FAILED, error=f"copying cached run failed: {e}")
+            cached_run = None
+    if cached_run is not None:
+        job_queue.job_table.set_status(job_id, FINISHED, id_run=run_id, progress=desired_edge_count)
+        return (
+            jsonify(
+                {
+                    "project_id": project_id,
+                    "job_id": job_id,
+                    "run_name": run_name,
+                    "status": FINISHED,
+                    "run_id": run_id,
+                    "cached": True,
+                }
+            ),
+            200,
         )
-        # RUN pareto optimization, potentially with saving the graph after each optimization step
-        result_graph, pareto_df = opt.pareto(fix_multilane=FIX_MULTILANE, return_graph_at_edges=desired_edge_count)
-    #print("Result graph: ", result_graph)
-    # convert to pandas datafrme
-    result_graph_edges = nx.to_pandas_edgelist(result_graph, edge_key="edge_key")[
-        ["source", "target", "edge_key", "lanetype"]
-    ]
-    
-    result_graph_edges['id_run'] = run_id
-    result_graph_edges['id_prj'] = project_id
-    pareto_df['id_run'] = run_id
-    pareto_df['id_prj'] = project_id   
-
-    # compute relative timees
-    base_bike, base_car = pareto_df["bike_time"].max(), pareto_df["car_time"].min()
-    pareto_df["car_time_change"] = (pareto_df["car_time"] - base_car) / base_car * 100
-    pareto_df["bike_time_change"] = (pareto_df["bike_time"] - base_bike) / base_bike * 100
-
-    connector = get_database_connector(DB_LOGIN_PATH)
-    run_list.to_sql(
-        f"runs", connector, schema=SCHEMA, if_exists="append", index=False
-    )
-    
-    result_graph_edges.to_sql(
-        f"runs_optimized", connector, schema=SCHEMA, if_exists="append", index=False
-    )
-    pareto_df.to_sql(
-        f"pareto", connector, schema=SCHEMA, if_exists="append", index=False
-    )
-        
-    
+
+    # node coordinates for the network bearings in the run summary (only needed if the optimization is run)
+    with timed_span("db_read"):
+        nodes = load_node_coordinates(project_id)
+    # run the optimization in the background, the results are saved in save_run_results
+    job_id = job_queue.submit(project_id, run_name, edges, od, params, nodes=nodes)
 
     return (
         jsonify(
             {
                 "project_id": project_id,
-                "run_id": run_id,
+                "job_id": job_id,
                 "run_name": run_name,
-                "bike_edges": len(result_graph_edges[result_graph_edges["lanetype"] == "P"]),
+                "status": job_queue.job_table.get_status(job_id),
             }
         ),
-        200,
+        202,
+    )
+
+
+def save_run_results(job: dict, result_graph_edges: pd.DataFrame, pareto_df: pd.DataFrame, run_summary: dict) -> int:
+    """
+    Write a finished optimization job into the runs, runs_optimized, pareto and run_summary tables and return the run ID
+    (runs without a summary are not added to the run_summary table)
+    """
+    project_id = job["id_prj"]
+    params = job["params"]
+    run_list = {
+        "id_prj": project_id,
+        "algorithm": params["algorithm"],
+        "bike_ratio": params["bike_ratio"],
+        "optimize_frequency": params["optimize_every_x"],
+        "car_weight": params["car_weight"],
+        "bike_safety_penalty": params["shared_lane_factor"],
+        "run_name": job["run_name"],
+    }
+
+    # write all tables of the run in one transaction
+    with timed_span("db_write"), db_connector.begin() as con:
+        # the run ID is assigned by the database, so jobs that finish at the same time (also in other processes of the
+        # app) cannot get the same ID
+        run_id = con.execute(
+            text(
+                f"INSERT INTO {SCHEMA}.runs ({', '.join(run_list)}) "
+                f"VALUES ({', '.join(':' + col for col in run_list)}) RETURNING id_run"
+            ),
+            run_list,
+        ).scalar()
+
+        result_graph_edges['id_run'] = run_id
+        result_graph_edges['id_prj'] = project_id
+        pareto_df['id_run'] = run_id
+        pareto_df['id_prj'] = project_id
+
+        result_graph_edges.to_sql(
+            f"runs_optimized", con, schema=SCHEMA, if_exists="append", index=False, method=copy_insert,
+            chunksize=COPY_CHUNKSIZE,
+        )
+        pareto_df.to_sql(
+            f"pareto", con, schema=SCHEMA, if_exists="append", index=False, method=copy_insert,
+            chunksize=COPY_CHUNKSIZE,
+        )
+        if run_summary is not None:
+            pd.DataFrame([{"id_prj": project_id, "id_run": run_id, **run_summary}]).to_sql(
+                f"run_summary", con, schema=SCHEMA, if_exists="append", index=False
+            )
+        if "result_key" in params:
+            pd.DataFrame({"result_key": [params["result_key"]], "id_prj": [project_id], "id_run": [run_id]}).to_sql(
+                f"result_cache", con, schema=SCHEMA, if_exists="append", index=False
+            )
+    run_cache.invalidate(project_id)
+    print("Saved run", run_id, "of project", project_id, "bike edges:", sum(result_graph_edges["lanetype"] == "P"))
+    return run_id
+
+
+def load_cached_result(result_key: str):
+    """
+    Find an earlier run with the same result key (see get_result_key) and return its (project_id, run_id), or None if
+    there is no such run
+    """
+    try:
+        cached_run = pd.read_sql(
+            f"""
+            SELECT c.id_prj, c.id_run FROM {SCHEMA}.result_cache AS c
+            JOIN {SCHEMA}.runs AS r ON r.id_prj = c.id_prj AND r.id_run = c.id_run
+            WHERE c.result_key = '{result_key}'
+            LIMIT 1
+            """,
+            db_connector,
+        )
+    except Exception:
+        # the result_cache table is only created when the first run is saved
+        return None
+    if cached_run.empty:
+        return None
+    return int(cached_run.iloc[0]["id_prj"]), int(cached_run.iloc[0]["id_run"])
+
+
+def copy_cached_run(job: dict, cached_project_id: int, cached_run_id: int) -> int:
+    """Save the results of an earlier run with the same inputs as a new run of the job and return the new run ID"""
+    with timed_span("db_read"):
+        run_filter = f"WHERE id_prj = {cached_project_id} AND id_run = {cached_run_id}"
+        result_graph_edges = pd.read_sql(f"SELECT * FROM {SCHEMA}.runs_optimized {run_filter}", db_connector)
+        pareto_df = pd.read_sql(f"SELECT * FROM {SCHEMA}.pareto {run_filter}", db_connector)
+        run_summary = load_run_summary(cached_project_id, cached_run_id)
+    if run_summary is not None:
+        run_summary = {key: val for key, val in run_summary.items() if key not in ["id_prj", "id_run"]}
+    run_id = save_run_results(job, result_graph_edges, pareto_df, run_summary)
+    print("Copied run", cached_run_id, "of project", cached_project_id, "as run", run_id, "of project", job["id_prj"])
+    return run_id
+
+
+job_queue = JobQueue(
+    JOB_DB_PATH, save_run_results, max_workers=MAX_CONCURRENT_JOBS, max_jobs_per_project=MAX_JOBS_PER_PROJECT
+)
+
+
+@app.route("/get_job_status", methods=["GET"])
+def get_job_status():
+    """
+    Get the status of an optimization job (queued, running, saving, finished, failed or cancelled) and its progress,
+    i.e. the number of bike lanes allocated so far (progress) compared to the desired number of bike lanes (target).
+    When the job is finished, the results are saved under the returned run_id.
+    """
+    job = job_queue.get_job(request.args.get("job_id"))
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+
+@app.route("/get_job_pareto", methods=["GET"])
+def get_job_pareto():
+    """Get the pareto frontier rows that were computed so far by an optimization job"""
+    job_id = request.args.get("job_id")
+    if job_queue.job_table.get_status(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"job_id": job_id, "pareto": job_queue.job_table.get_pareto_rows(job_id)}), 200
+
+
+@app.route("/get_jobs", methods=["GET"])
+def get_jobs():
+    """Get all optimization jobs of a project"""
+    project_id = int(request.args.get("project_id"))
+    return jsonify({"jobs": job_queue.job_table.get_project_jobs(project_id)}), 200
+
+
+@app.route("/cancel_job", methods=["GET", "POST"])
+def cancel_job():
+    """Cancel a queued or running optimization job"""
+    job_id = request.args.get("job_id")
+    if not job_queue.cancel(job_id):
+        return jsonify({"error": "Job not found or already finished"}), 400
+    return jsonify({"job_id": job_id, "status": job_queue.job_table.get_status(job_id)}), 200
+
+
+def load_run(project_id: int, run_id: int):
+    """Load the project edges, the OD matrix and the output of one run from the database"""
+    project_edges = pd.read_sql(f"SELECT * FROM {SCHEMA}.edges WHERE id_prj = {project_id}", db_connector)
+    project_od = pd.read_sql(f"SELECT * FROM {SCHEMA}.od WHERE id_prj = {project_id}", db_connector)
+    run_output = pd.read_sql(
+        f"SELECT * FROM {SCHEMA}.runs_optimized WHERE id_prj = {project_id} AND id_run = {run_id}", db_connector
     )
+    return project_edges, project_od, run_output
+
+
+def load_node_coordinates(project_id: int) -> pd.DataFrame:
+    """Load the coordinates of the nodes of a project (columns osmid, x and y)"""
+    return pd.read_sql(f"""
+        SELECT DISTINCT z.osmid, z.x, z.y
+        FROM zurich.nodes{FULL_GRAPH} AS z
+        JOIN  webapp.edges AS w ON w.source = z.osmid OR w.target = z.osmid
+        WHERE w.id_prj = {project_id}
+        """, db_connector)
+
+
+def load_run_summary(project_id: int, run_id: int):
+    """
+    Load the summary statistics of a run that were computed when the optimization finished (see compute_run_summary).
+    Returns None for runs without a summary (e.g. runs from before the run_summary table existed)
+    """
+    try:
+        run_summary = pd.read_sql(
+            f"SELECT * FROM {SCHEMA}.run_summary WHERE id_prj = {int(project_id)} AND id_run = {int(run_id)}",
+            db_connector,
+        )
+    except Exception:
+        return None
+    if run_summary.empty:
+        return None
+    return run_summary.iloc[0].replace({np.nan: None}).to_dict()
+
+
+# the evaluation endpoints are usually called together for the same run, so the reconstructed graphs are cached
+run_cache = RunGraphCache()
 
 
 @app.route("/get_distance_per_lane_type", methods=["GET"])
 def get_distance_per_lane_type():
     try:
-        connector = get_database_connector(DB_LOGIN_PATH)
         project_id = int(request.args.get("project_id"))
         run_id = request.args.get("run_name")
 
-        bike_distance = pd.read_sql(f"SELECT SUM(edges.distance) AS total_bike_lane_distance FROM {SCHEMA}.runs_optimized JOIN {SCHEMA}.edges ON runs_optimized.source = edges.source AND runs_optimized.target = edges.target WHERE runs_optimized.lanetype = 'P' AND runs_optimized.id_run ={run_id} AND runs_optimized.id_prj = {project_id}", connector)
-        car_distance = pd.read_sql(f"SELECT SUM(edges.distance) AS total_car_lane_distance FROM {SCHEMA}.runs_optimized JOIN {SCHEMA}.edges ON runs_optimized.source = edges.source AND runs_optimized.target = edges.target WHERE runs_optimized.lanetype = 'M>' AND runs_optimized.id_run ={run_id} AND runs_optimized.id_prj = {project_id}", connector)
-        bike_distance_json = bike_distance.to_dict(orient="records")
-        car_distance_json = car_distance.to_dict(orient="records")
+        run_summary = load_run_summary(project_id, run_id)
+        if run_summary is None:
+            run = run_cache.get(project_id, run_id, load_run)
+            run_summary = get_distance_per_lane_type(run["edges"], run["run_output"])
+        bike_distance_json = [{"total_bike_lane_distance": run_summary["distance_bike"]}]
+        car_distance_json = [{"total_car_lane_distance": run_summary["distance_car"]}]
 
         return (jsonify({"distance_bike": bike_distance_json, "distance_car": car_distance_json}), 200)
 
@@ -429,31 +612,31 @@ def evaluate_travel_time():
     project_id = request.args.get("project_id")
     run_id = request.args.get("run_name")
 
-    connector = get_database_connector(DB_LOGIN_PATH)
-    project_edges = pd.read_sql(f"SELECT * FROM {SCHEMA}.edges WHERE id_prj = {project_id}", connector)
-    project_od = pd.read_sql(f"SELECT * FROM {SCHEMA}.od WHERE id_prj = {project_id}", connector)
-    run_output = pd.read_sql(f"SELECT * FROM {SCHEMA}.runs_optimized WHERE id_prj = {project_id} AND id_run = {run_id}", connector)
+    run_summary = load_run_summary(project_id, run_id)
+    if run_summary is not None:
+        return (
+            jsonify(
+                {"bike_travel_time": run_summary["bike_travel_time"], "car_travel_time": run_summary["car_travel_time"]}
+            ),
+            200,
+        )
 
-    # put lanetype attribute from run_output onto the edges and update bike and car travel time attributes
-    lane_graph = recreate_lane_graph(project_edges, run_output)
-    
-    # rename columns
-    project_edges.rename(columns={'source': 's', 'target': 't'}, inplace=True)
-    project_od.rename(columns={'source': 's', 'target': 't'}, inplace=True)
-    run_output.rename(columns={'source': 's', 'target': 't'}, inplace=True)
+    # lane graph with the lanetypes of the run and the bike and car travel time attributes
+    run = run_cache.get(project_id, run_id, load_run)
 
     # measure travel times -> TODO: would be better to just use the pareto times, and do some other evaluation here
-    bike_travel_time, car_travel_time = compute_travel_times_in_graph(lane_graph, project_od, SP_METHOD, WEIGHT_OD_FLOW)
+    bike_travel_time, car_travel_time = compute_travel_times_in_graph(
+        run["lane_graph"], run["od"], SP_METHOD, WEIGHT_OD_FLOW
+    )
     return (jsonify({"bike_travel_time": bike_travel_time, "car_travel_time": car_travel_time}), 200)
 
 @app.route("/get_pareto", methods=["GET"])
 def get_pareto():
     try:
-        connector = get_database_connector(DB_LOGIN_PATH)
         project_id = request.args.get("project_id")
         run_id = request.args.get("run_name")
 
-        pareto = pd.read_sql(f"SELECT * FROM {SCHEMA}.pareto WHERE id_prj = {project_id} AND id_run = {run_id}", connector)
+        pareto = pd.read_sql(f"SELECT * FROM {SCHEMA}.pareto WHERE id_prj = {project_id} AND id_run = {run_id}", db_connector)
         pareto_json = pareto.to_dict(orient="records")
         return jsonify({"projects": pareto_json}), 200
     except Exception as e:
@@ -466,15 +649,15 @@ def get_complexity():
         project_id = int(request.args.get("project_id"))
         run_id = request.args.get("run_name")
 
-        connector = get_database_connector(DB_LOGIN_PATH)
-        project_edges = pd.read_sql(f"SELECT * FROM {SCHEMA}.edges WHERE id_prj = {project_id}", connector)
-        project_od = pd.read_sql(f"SELECT * FROM {SCHEMA}.od WHERE id_prj = {project_id}", connector)
-        run_output = pd.read_sql(f"SELECT * FROM {SCHEMA}.runs_optimized WHERE id_prj = {project_id} AND id_run = {run_id}", connector)
-
-        lane_graph = recreate_lane_graph(project_edges, run_output)
-
-        bike_degree_ratios = get_degree_ratios(lane_graph, 'P')
-        car_degree_ratios = get_degree_ratios(lane_graph, 'M')
+        run_summary = load_run_summary(project_id, run_id)
+        if run_summary is not None:
+            # the degrees are stored as json, where the keys are strings
+            bike_degree_ratios = {int(k): v for k, v in json.loads(run_summary["bike_degree_ratios"]).items()}
+            car_degree_ratios = {int(k): v for k, v in json.loads(run_summary["car_degree_ratios"]).items()}
+        else:
+            lane_graph = run_cache.get(project_id, run_id, load_run)["lane_graph"]
+            bike_degree_ratios = get_degree_ratios(lane_graph, 'P')
+            car_degree_ratios = get_degree_ratios(lane_graph, 'M')
 
         return (jsonify({"bike_degree_ratio": bike_degree_ratios, "car_degree_ratios": car_degree_ratios}), 200)
     
@@ -484,38 +667,70 @@ def get_complexity():
 
 @app.route("/get_network_bearing", methods=["GET"])
 def get_network_bearing():
+    """
+    Average deviation of the shortest paths from the direct bearing, for the bike and the car network of a run
+    Optional request arguments:
+        sample_size: only use the shortest paths from this number of random source nodes
+        time_budget: stop after this number of seconds (per network) and estimate from the sources processed so far
+    With one of these arguments, the response also contains the estimates with a 95% confidence interval
+    """
     try:
         
             project_id = int(request.args.get("project_id"))
             run_id = request.args.get("run_name")
 
-            connector = get_database_connector(DB_LOGIN_PATH)
-            project_edges = pd.read_sql(f"SELECT * FROM {SCHEMA}.edges WHERE id_prj = {project_id}", connector)
-            project_od = pd.read_sql(f"SELECT * FROM {SCHEMA}.od WHERE id_prj = {project_id}", connector)
-            run_output = pd.read_sql(f"SELECT * FROM {SCHEMA}.runs_optimized WHERE id_prj = {project_id} AND id_run = {run_id}", connector)
+            # optionally estimate the bearings from a sample of sources or within a time budget (in seconds)
+            sample_size = request.args.get("sample_size", None, type=int)
+            time_budget = request.args.get("time_budget", None, type=float)
+
+            run_summary = load_run_summary(project_id, run_id)
+            exact = sample_size is None and time_budget is None
+            if exact and run_summary is not None and run_summary.get("bike_network_bearings") is not None:
+                return (
+                    jsonify(
+                        {
+                            "bike_network_bearings": run_summary["bike_network_bearings"],
+                            "car_network_bearings": run_summary["car_network_bearings"],
+                        }
+                    ),
+                    200,
+                )
 
             # load nodes from database
-            nodes_zurich = pd.read_sql(f"""
-                SELECT z.osmid, z.x, z.y
-                FROM zurich.nodes{FULL_GRAPH} AS z
-                JOIN  webapp.edges AS w ON w.source = z.osmid OR w.target = z.osmid
-                WHERE w.id_prj = {project_id}
-                """, connector)
-
-            lane_graph = recreate_lane_graph(project_edges, run_output)
+            nodes_zurich = load_node_coordinates(project_id)
+
+            lane_graph = run_cache.get(project_id, run_id, load_run)["lane_graph"]
             
-            xs = {nodes_zurich.loc[i, 'osmid']: nodes_zurich.loc[i, 'x'] for i in nodes_zurich.index}
+            xs = dict(zip(nodes_zurich['osmid'], nodes_zurich['x']))
             nx.set_node_attributes(lane_graph, xs, 'x')
 
-            ys = {nodes_zurich.loc[i, 'osmid']: nodes_zurich.loc[i, 'y'] for i in nodes_zurich.index}
+            ys = dict(zip(nodes_zurich['osmid'], nodes_zurich['y']))
             nx.set_node_attributes(lane_graph, ys, 'y')
 
             lane_graph.graph['crs'] = 4326
 
-            bike_network_bearings = get_network_bearings(lane_graph, 'P', 'distance')
-            car_network_bearings = get_network_bearings(lane_graph, 'M', 'distance')
-
-            return (jsonify({"bike_network_bearings": bike_network_bearings, "car_network_bearings": car_network_bearings}), 200)
+            if sample_size is None and time_budget is None:
+                bike_network_bearings = get_network_bearings(lane_graph, 'P', 'distance')
+                car_network_bearings = get_network_bearings(lane_graph, 'M', 'distance')
+                return (jsonify({"bike_network_bearings": bike_network_bearings, "car_network_bearings": car_network_bearings}), 200)
+
+            bike_estimate = get_network_bearings(
+                lane_graph, 'P', 'distance', sample_size=sample_size, time_budget=time_budget, seed=0, return_ci=True
+            )
+            car_estimate = get_network_bearings(
+                lane_graph, 'M', 'distance', sample_size=sample_size, time_budget=time_budget, seed=0, return_ci=True
+            )
+            return (
+                jsonify(
+                    {
+                        "bike_network_bearings": bike_estimate["mean"],
+                        "car_network_bearings": car_estimate["mean"],
+                        "bike_network_bearings_estimate": bike_estimate,
+                        "car_network_bearings_estimate": car_estimate,
+                    }
+                ),
+                200,
+            )
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -525,8 +740,7 @@ def get_network_bearing():
 @app.route("/get_projects", methods=["GET"])
 def get_projects():
     try:
-        connector = get_database_connector(DB_LOGIN_PATH)
-        projects = pd.read_sql("SELECT id, prj_name, created, runtime_min FROM webapp.projects", connector)
+        projects = pd.read_sql("SELECT id, prj_name, created, runtime_min FROM webapp.projects", db_connector)
         replaced_df = projects.replace({np.nan: None})
         projects_json = replaced_df.to_dict(orient="records")  
         return jsonify({"projects": projects_json}), 200
@@ -538,8 +752,7 @@ def get_projects():
 def get_runs():
     project_id = request.args.get("project_id")
     try:
-        connector = get_database_connector(DB_LOGIN_PATH)
-        runs = pd.read_sql(f"SELECT * FROM webapp.runs WHERE id_prj = {project_id}", connector)
+        runs = pd.read_sql(f"SELECT * FROM webapp.runs WHERE id_prj = {project_id}", db_connector)
         runs_json = runs.to_dict(orient="records")
         return jsonify({"runs": runs_json}), 200
     
@@ -554,23 +767,15 @@ def get_runs():
 def get_bounding_box():
     project_id = request.args.get("project_id")
     bbox_params = None  # Initialize bbox_params to None
-    
-    session = None
-    
+
     sql_statement = f"""
         SELECT bbox_east, bbox_south, bbox_west, bbox_north
         FROM webapp.v_bound
         WHERE id_prj = {project_id};"""  
         
     try:
-        connector = get_database_connector(DB_LOGIN_PATH)
-        Session = sessionmaker(bind=connector)
-        session = Session()
-        cursor = session.connection().connection.cursor()
-        
-        cursor.execute(sql_statement)
-        
-        bbox_result = cursor.fetchone()
+        with db_session(db_connector) as session:
+            bbox_result = session.execute(text(sql_statement)).fetchone()
         if bbox_result:
             bbox_params = {
                 "bbox_east": bbox_result[0],
@@ -579,20 +784,21 @@ def get_bounding_box():
                 "bbox_north": bbox_result[3]
             }
     except Exception as e:
-        if session: 
-            session.rollback()
         return jsonify({"error": f"Failed to get Bounding Box: {str(e)}"}), 500
-    finally:
-        if session:
-            session.close()
-            
-        if bbox_params:
-            return jsonify({
-                "message": "Bounding box retrieved successfully",
-                "bounding_box": bbox_params
-            }), 200
-        else:
-            return jsonify({"message": "No bounding box found"}), 200
+
+    if bbox_params:
+        return jsonify({
+            "message": "Bounding box retrieved successfully",
+            "bounding_box": bbox_params
+        }), 200
+    else:
+        return jsonify({"message": "No bounding box found"}), 200
+
+
+@app.route("/get_pool_metrics", methods=["GET"])
+def pool_metrics():
+    """Monitoring: state of the database connection pool (checked out connections, overflow and wait times)"""
+    return jsonify(get_pool_metrics(db_connector)), 200
 
 if __name__ == "__main__":
     # run
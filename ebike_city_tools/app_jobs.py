@@ -0,0 +1,370 @@
+import inspect
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import pandas as pd
+
+from ebike_city_tools.iterative_algorithms import topdown_betweenness_pareto, betweenness_pareto
+from ebike_city_tools.optimize.round_optimized import ParetoRoundOptimize
+from ebike_city_tools.app_utils import compute_run_summary
+from ebike_city_tools.profiling import record_spans, observe_spans, timed_span
+
+algorithm_dict = {
+    "betweenness_topdown": (topdown_betweenness_pareto, {}),
+    "betweenness_cartime": (betweenness_pareto, {"betweenness_attr": "car_time"}),
+    "betweenness_biketime": (betweenness_pareto, {"betweenness_attr": "bike_time"}),
+}
+
+# job states (saving: the optimization is done and the results are written, the job cannot be cancelled anymore)
+QUEUED, RUNNING, SAVING, FINISHED, FAILED, CANCELLED = "queued", "running", "saving", "finished", "failed", "cancelled"
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker when the job was cancelled"""
+
+
+def get_job_owner() -> str:
+    """ID of the current process, stored with the jobs that it runs"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_owner_alive(owner: str) -> bool:
+    """Whether the process that owns a job still exists (processes on other hosts are assumed to be alive)"""
+    if owner is None:
+        # job from before the owner was recorded
+        return False
+    host, pid = owner.rsplit(":", 1)
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists, but belongs to another user
+        return True
+    return True
+
+
+class JobTable:
+    """
+    Local job table (SQLite) that is shared between the app and the worker processes.
+    Stores the status and progress of every job and the pareto rows computed so far.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with self.connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY, id_prj INTEGER, run_name TEXT, params TEXT, status TEXT,
+                    progress INTEGER DEFAULT 0, target INTEGER, id_run INTEGER, error TEXT,
+                    created REAL, started REAL, finished REAL
+                )"""
+            )
+            # process of the app that runs the job (host:pid), older job tables do not have this column yet
+            if "owner" not in [col[1] for col in con.execute("PRAGMA table_info(jobs)")]:
+                con.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            con.execute("CREATE TABLE IF NOT EXISTS job_pareto (job_id TEXT, row_nr INTEGER, row TEXT)")
+            con.execute("CREATE INDEX IF NOT EXISTS job_pareto_job_id ON job_pareto (job_id)")
+
+    @contextmanager
+    def connect(self):
+        """Open a connection that is committed and closed afterwards (open connections must not be forked)"""
+        con = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def create(self, project_id: int, run_name: str, params: dict, target: int) -> str:
+        job_id = uuid.uuid4().hex
+        with self.connect() as con:
+            con.execute(
+                "INSERT INTO jobs (job_id, id_prj, run_name, params, status, target, created, owner) "
+                "VALUES (?,?,?,?,?,?,?,?)",
+                (job_id, project_id, run_name, json.dumps(params), QUEUED, target, time.time(), get_job_owner()),
+            )
+        return job_id
+
+    def fail_interrupted_jobs(self) -> int:
+        """
+        Mark the unfinished jobs of app processes that do not exist anymore as failed (they cannot be
+        resumed). Jobs of other running processes, e.g. other workers of the app, are not touched.
+        Returns: number of failed jobs
+        """
+        with self.connect() as con:
+            jobs = con.execute(
+                "SELECT job_id, owner FROM jobs WHERE status IN (?, ?, ?)", (QUEUED, RUNNING, SAVING)
+            ).fetchall()
+            interrupted = [(job_id,) for job_id, owner in jobs if not is_owner_alive(owner)]
+            con.executemany(
+                "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE job_id = ?",
+                [(FAILED, "interrupted by restart", time.time(), job_id) for (job_id,) in interrupted],
+            )
+        return len(interrupted)
+
+    def get(self, job_id: str) -> dict:
+        with self.connect() as con:
+            con.row_factory = sqlite3.Row
+            row = con.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        return job
+
+    def get_project_jobs(self, project_id: int) -> list:
+        with self.connect() as con:
+            job_ids = con.execute("SELECT job_id FROM jobs WHERE id_prj = ? ORDER BY created", (project_id,)).fetchall()
+        return [self.get(job_id) for (job_id,) in job_ids]
+
+    def get_status(self, job_id: str) -> str:
+        with self.connect() as con:
+            row = con.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_status(self, job_id: str, status: str, only_if: str = None, **kwargs) -> bool:
+        """Set the status (and other columns), optionally only if the current status is <only_if>"""
+        columns = {"status": status, **kwargs}
+        if status == RUNNING:
+            columns["started"] = time.time()
+        elif status in [FINISHED, FAILED, CANCELLED]:
+            columns["finished"] = time.time()
+        query = f"UPDATE jobs SET {', '.join(f'{c} = ?' for c in columns)} WHERE job_id = ?"
+        values = list(columns.values()) + [job_id]
+        if only_if is not None:
+            query += " AND status = ?"
+            values.append(only_if)
+        with self.connect() as con:
+            updated = con.execute(query, values).rowcount
+        return updated > 0
+
+    def add_pareto_row(self, job_id: str, row: dict) -> None:
+        with self.connect() as con:
+            row_nr = con.execute("SELECT COUNT(*) FROM job_pareto WHERE job_id = ?", (job_id,)).fetchone()[0]
+            con.execute("INSERT INTO job_pareto VALUES (?,?,?)", (job_id, row_nr, json.dumps(row, default=float)))
+            con.execute("UPDATE jobs SET progress = ? WHERE job_id = ?", (int(row["bike_edges_added"]), job_id))
+
+    def get_pareto_rows(self, job_id: str) -> list:
+        with self.connect() as con:
+            rows = con.execute("SELECT row FROM job_pareto WHERE job_id = ? ORDER BY row_nr", (job_id,)).fetchall()
+        return [json.loads(row) for (row,) in rows]
+
+
+def run_optimization(
+    edges: pd.DataFrame,
+    od: pd.DataFrame,
+    algorithm: str = "optimize",
+    desired_edge_count: int = None,
+    optimize_every_x: float = 30,
+    car_weight: float = 0.7,
+    shared_lane_factor: float = 2,
+    sp_method: str = "od",
+    weight_od_flow: bool = False,
+    fix_multilane: bool = False,
+    callback=None,
+):
+    """
+    Run the optimization or a betweenness algorithm on the lane graph of a project
+    Returns:
+        result_graph_edges: pd.DataFrame with columns source, target, edge_key and lanetype
+        pareto_df: pd.DataFrame with the pareto frontier, including the relative change in travel times
+    """
+    with timed_span("graph_reconstruction"):
+        lane_graph = nx.from_pandas_edgelist(
+            edges,
+            edge_key="edge_key",
+            edge_attr=[col for col in edges.columns if col not in ["source", "target", "edge_key"]],
+            create_using=nx.MultiDiGraph,
+        )
+    if "betweenness" in algorithm:
+        print(f"Running betweenness algorithm {algorithm}")
+        # get algorithm method
+        algorithm_func, kwargs = algorithm_dict[algorithm]
+
+        # run betweenness centrality algorithm for comparison
+        result_graph, pareto_df = algorithm_func(
+            lane_graph.copy(),
+            sp_method=sp_method,
+            od_matrix=od,
+            weight_od_flow=weight_od_flow,
+            fix_multilane=fix_multilane,
+            shared_lane_factor=shared_lane_factor,
+            save_graph_path=None,
+            return_graph_at_edges=desired_edge_count,
+            callback=callback,
+            **kwargs,
+        )
+    else:
+        opt = ParetoRoundOptimize(
+            lane_graph.copy(),
+            od.copy(),
+            optimize_every_x=optimize_every_x,
+            car_weight=car_weight,
+            sp_method=sp_method,
+            shared_lane_factor=shared_lane_factor,
+            weight_od_flow=weight_od_flow,
+            valid_edges_k=0,
+        )
+        # RUN pareto optimization
+        result_graph, pareto_df = opt.pareto(
+            fix_multilane=fix_multilane, return_graph_at_edges=desired_edge_count, callback=callback
+        )
+    # convert to pandas datafrme
+    result_graph_edges = nx.to_pandas_edgelist(result_graph, edge_key="edge_key")[
+        ["source", "target", "edge_key", "lanetype"]
+    ]
+
+    # compute relative timees
+    base_bike, base_car = pareto_df["bike_time"].max(), pareto_df["car_time"].min()
+    pareto_df["car_time_change"] = (pareto_df["car_time"] - base_car) / base_car * 100
+    pareto_df["bike_time_change"] = (pareto_df["bike_time"] - base_bike) / base_bike * 100
+    return result_graph_edges, pareto_df
+
+
+def run_optimization_job(
+    job_id: str, job_db_path: str, edges: pd.DataFrame, od: pd.DataFrame, params: dict, nodes: pd.DataFrame = None
+):
+    """
+    Worker function: runs the optimization and reports every pareto row to the job table. Afterwards, the summary
+    statistics of the run are computed from the result (see compute_run_summary)
+    Returns:
+        result_graph_edges, pareto_df, run_summary (dict, or None if it could not be computed), spans (durations of
+        the phases, see profiling.record_spans)
+    """
+    job_table = JobTable(job_db_path)
+    if not job_table.set_status(job_id, RUNNING, only_if=QUEUED):
+        raise JobCancelled(job_id)
+
+    def report_progress(pareto_row):
+        job_table.add_pareto_row(job_id, pareto_row)
+        # stop as soon as possible if the job was cancelled
+        if job_table.get_status(job_id) == CANCELLED:
+            raise JobCancelled(job_id)
+
+    # some parameters are only stored with the job (e.g. the bike ratio for the runs table), they are not passed on
+    params = {key: val for key, val in params.items() if key in inspect.signature(run_optimization).parameters}
+    with record_spans() as spans:
+        result_graph_edges, pareto_df = run_optimization(edges, od, callback=report_progress, **params)
+
+        with timed_span("run_summary"):
+            try:
+                run_summary = compute_run_summary(
+                    edges,
+                    od,
+                    result_graph_edges,
+                    nodes=nodes,
+                    sp_method=params.get("sp_method", "od"),
+                    weight_od_flow=params.get("weight_od_flow", False),
+                )
+            except Exception as e:
+                # the run is saved without a summary (its statistics are computed on request instead)
+                print("Computing the run summary failed for job", job_id, e)
+                run_summary = None
+    return result_graph_edges, pareto_df, run_summary, spans
+
+
+class JobQueue:
+    """
+    Runs optimization jobs in a process pool.
+    At most max_workers jobs run at the same time, and at most max_jobs_per_project of them for the same project, such
+    that one large project cannot block all others. Jobs are started in the order in which they were submitted.
+    When a job is finished, on_complete(job, result_graph_edges, pareto_df, run_summary) is called in the app process
+    and must return the run ID under which the results were saved.
+    """
+
+    def __init__(self, job_db_path: str, on_complete, max_workers: int = 2, max_jobs_per_project: int = 1):
+        self.job_table = JobTable(job_db_path)
+        self.on_complete = on_complete
+        self.max_workers = max_workers
+        self.max_jobs_per_project = max_jobs_per_project
+        self.executor = ProcessPoolExecutor(max_workers)
+        self.lock = threading.Lock()
+        # jobs waiting for a free worker: list of (job_id, project_id, edges, od, params, nodes)
+        self.pending = []
+        self.running = defaultdict(int)  # number of running jobs per project
+        # jobs of earlier processes of the app cannot be resumed (only their jobs are failed, so that other processes
+        # that share the job table, e.g. with the reloader or several app workers, are not affected)
+        self.job_table.fail_interrupted_jobs()
+
+    def submit(
+        self,
+        project_id: int,
+        run_name: str,
+        edges: pd.DataFrame,
+        od: pd.DataFrame,
+        params: dict,
+        nodes: pd.DataFrame = None,
+    ) -> str:
+        """Add a job to the queue and return its ID. The node coordinates are only used for the run summary"""
+        job_id = self.job_table.create(project_id, run_name, params, params.get("desired_edge_count"))
+        with self.lock:
+            self.pending.append((job_id, project_id, edges, od, params, nodes))
+        self.dispatch()
+        return job_id
+
+    def dispatch(self):
+        """Start pending jobs as long as there are free workers"""
+        with self.lock:
+            for job in list(self.pending):
+                if sum(self.running.values()) >= self.max_workers:
+                    break
+                job_id, project_id, edges, od, params, nodes = job
+                if self.running[project_id] >= self.max_jobs_per_project:
+                    continue
+                self.pending.remove(job)
+                self.running[project_id] += 1
+                future = self.executor.submit(
+                    run_optimization_job, job_id, self.job_table.db_path, edges, od, params, nodes
+                )
+                future.add_done_callback(lambda f, job_id=job_id, prj=project_id: self.finish(job_id, prj, f))
+
+    def finish(self, job_id: str, project_id: int, future):
+        """Called when a worker is done: save the results (unless cancelled) and start the next jobs"""
+        with self.lock:
+            self.running[project_id] -= 1
+        try:
+            result_graph_edges, pareto_df, run_summary, spans = future.result()
+            observe_spans(spans)
+            # claim the job in one step, so that it cannot be cancelled while the results are saved
+            if self.job_table.set_status(job_id, SAVING, only_if=RUNNING):
+                run_id = self.on_complete(self.job_table.get(job_id), result_graph_edges, pareto_df, run_summary)
+                self.job_table.set_status(job_id, FINISHED, id_run=run_id)
+        except JobCancelled:
+            self.job_table.set_status(job_id, CANCELLED)
+        except Exception as e:
+            self.job_table.set_status(job_id, FAILED, error=str(e))
+        self.dispatch()
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a job. Queued jobs are removed immediately, running jobs stop at their next pareto row.
+        Returns False if the job is already finished (or does not exist)
+        """
+        with self.lock:
+            for job in self.pending:
+                if job[0] == job_id:
+                    self.pending.remove(job)
+                    break
+        return self.job_table.set_status(job_id, CANCELLED, only_if=QUEUED) or self.job_table.set_status(
+            job_id, CANCELLED, only_if=RUNNING
+        )
+
+    def get_job(self, job_id: str) -> dict:
+        """Get the status of a job, together with the number of pareto rows computed so far"""
+        job = self.job_table.get(job_id)
+        if job is not None:
+            job["pareto_rows"] = len(self.job_table.get_pareto_rows(job_id))
+        return job
@@ -1,19 +1,43 @@
 import os
+import io
+import csv
 import json
+import hashlib
+import time
+import threading
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import networkx as nx
+import shapely
+import pyarrow as pa
+from pyarrow import feather
 
-from collections import Counter
-from osmnx.bearing import add_edge_bearings, calculate_bearing
+from collections import Counter, OrderedDict
+from osmnx.bearing import calculate_bearing
 from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
 import psycopg2
-from ebike_city_tools.utils import compute_edgedependent_bike_time, compute_car_time
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from ebike_city_tools.utils import compute_edgedependent_bike_time_vectorized, compute_car_time_vectorized
 from ebike_city_tools.graph_utils import clean_street_graph_directions, clean_street_graph_multiedges
-from ebike_city_tools.od_utils import match_od_with_nodes
+from ebike_city_tools.od_utils import match_od_with_nodes, ODSnapper
+from ebike_city_tools.metrics import compute_travel_times_in_graph
+from ebike_city_tools.profiling import timed_span
 
 CRS = 2056
+RUN_CACHE_MAX_BYTES = int(os.environ.get("RUN_CACHE_MAX_BYTES", 2 * 1024**3))
+BASE_DATA_CACHE_DIR = os.environ.get(
+    "BASE_DATA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ebike_city_tools", "base_data")
+)
+COPY_CHUNKSIZE = 100000  # rows per COPY statement when writing tables
+BEARING_BATCH_SIZE = 64  # number of shortest path trees that are computed at once for the network bearings
+GRAPH_BYTES_PER_EDGE = 1000  # approximate memory of one edge (with attributes) in a networkx graph
+# edge columns that determine the result of an optimization (see get_result_key)
+RESULT_KEY_EDGE_COLUMNS = ["source", "target", "edge_key", "fixed", "lanetype", "distance", "gradient", "speed_limit"]
 
 
 # Setup database access
@@ -29,6 +53,209 @@ def get_database_connector(dblogin_file: str):
     return create_engine("postgresql+psycopg2://", creator=get_con_mie)
 
 
+# pool settings of the engine that is shared by all requests of the app
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # replace connections older than this (seconds)
+
+_engines = {}
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long requests wait for a connection (including opening new connections)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.nr_checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        tic = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - tic
+            self.nr_checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def recreate(self):
+        # keep the metrics when the pool is recreated (e.g. on dispose)
+        pool = super().recreate()
+        pool.nr_checkouts, pool.total_wait, pool.max_wait = self.nr_checkouts, self.total_wait, self.max_wait
+        return pool
+
+
+def get_pooled_engine(
+    dblogin_file: str,
+    pool_size: int = DB_POOL_SIZE,
+    max_overflow: int = DB_MAX_OVERFLOW,
+    pool_timeout: float = DB_POOL_TIMEOUT,
+    pool_recycle: int = DB_POOL_RECYCLE,
+):
+    """
+    Get the engine for the login file. Unlike get_database_connector, the engine is only created once per process and
+    keeps a pool of open connections, so requests don't pay for opening a new connection
+    """
+    if dblogin_file not in _engines:
+        with open(dblogin_file, "r") as infile:
+            db_login = json.load(infile)
+            db_login["database"] = "ebikecity"
+
+        def get_con_mie():
+            return psycopg2.connect(**db_login)
+
+        _engines[dblogin_file] = create_engine(
+            "postgresql+psycopg2://",
+            creator=get_con_mie,
+            poolclass=TimedQueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_recycle=pool_recycle,
+            pool_pre_ping=True,  # replace connections that were closed by the server
+        )
+    return _engines[dblogin_file]
+
+
+def _dispose_engines_after_fork():
+    """Forked processes must not use (or close) the connections of the parent, so they start with an empty pool"""
+    for engine in _engines.values():
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+
+@contextmanager
+def db_session(engine):
+    """Session that is committed if the block succeeds, rolled back otherwise, and always closed"""
+    session = Session(bind=engine)
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def get_pool_metrics(engine) -> dict:
+    """Current state of the connection pool of an engine, and how long requests waited for a connection"""
+    pool = engine.pool
+    metrics = {
+        "pool_size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+    }
+    if isinstance(pool, TimedQueuePool):
+        metrics["checkouts"] = pool.nr_checkouts
+        metrics["wait_time_total"] = pool.total_wait
+        metrics["wait_time_mean"] = pool.total_wait / max(pool.nr_checkouts, 1)
+        metrics["wait_time_max"] = pool.max_wait
+    return metrics
+
+
+class BaseDataCache:
+    """
+    Local copy of the city-wide tables of the database (nodes, edges, trips and OD matrix) as uncompressed Feather
+    files. The files are memory-mapped when loading, so the app processes on one machine share the pages of the numeric
+    columns instead of each holding a copy. A table is only downloaded again when its version in the database changes.
+    The version is taken from the table <schema>.data_version (written by zurich_to_database) if it exists, otherwise
+    from the number of rows of the table.
+    """
+
+    def __init__(self, engine, cache_dir: str = BASE_DATA_CACHE_DIR, schema: str = "zurich"):
+        self.engine = engine
+        self.cache_dir = cache_dir
+        self.schema = schema
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_version(self, table: str) -> str:
+        try:
+            version = pd.read_sql(f"SELECT MAX(version) FROM {self.schema}.data_version", self.engine).iloc[0, 0]
+        except Exception:
+            version = None
+        if version is None:
+            nr_rows = pd.read_sql(f"SELECT COUNT(*) FROM {self.schema}.{table}", self.engine).iloc[0, 0]
+            version = f"rows{nr_rows}"
+        return str(version)
+
+    def get_path(self, table: str, version: str, columns: list = None) -> str:
+        key = hashlib.sha1(json.dumps([version, columns]).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{self.schema}.{table}.{key}.feather")
+
+    def download(self, table: str, path: str, columns: list = None, geom_col: str = None, index_col=None) -> None:
+        """Read the table from the database and write it as a Feather file (geometries are stored as WKB)"""
+        query = f"SELECT {', '.join(columns) if columns else '*'} FROM {self.schema}.{table}"
+        metadata = {}
+        if geom_col is not None:
+            data = gpd.read_postgis(query, self.engine, geom_col=geom_col, index_col=index_col)
+            metadata = {"geom_col": geom_col, "crs": data.crs.to_json() if data.crs is not None else ""}
+            data = pd.DataFrame(data)
+            data[geom_col] = shapely.to_wkb(data[geom_col].values)
+        else:
+            data = pd.read_sql(query, self.engine, index_col=index_col)
+        arrow_table = pa.Table.from_pandas(data, preserve_index=index_col is not None)
+        arrow_table = arrow_table.replace_schema_metadata({**arrow_table.schema.metadata, **metadata})
+        # write to a temporary file first, such that other processes never read an incomplete file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        feather.write_feather(arrow_table, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, path)
+        # remove outdated versions of the table
+        for fn in os.listdir(self.cache_dir):
+            old_path = os.path.join(self.cache_dir, fn)
+            if fn.startswith(f"{self.schema}.{table}.") and fn.endswith(".feather") and old_path != path:
+                os.remove(old_path)
+
+    def load(self, table: str, columns: list = None, geom_col: str = None, index_col=None) -> pd.DataFrame:
+        """
+        Load a table of the database, from the local cache if it is up to date
+        Args:
+            table: name of the table (without schema)
+            columns: only load these columns. Defaults to None (all columns)
+            geom_col: name of the geometry column, if given a GeoDataFrame is returned
+            index_col: column(s) to use as the index
+        """
+        version = self.get_version(table)
+        path = self.get_path(table, version, columns)
+        if not os.path.exists(path):
+            print("Downloading", table, "version", version)
+            with timed_span("db_read"):
+                self.download(table, path, columns=columns, geom_col=geom_col, index_col=index_col)
+        arrow_table = feather.read_table(path, memory_map=True)
+        metadata = arrow_table.schema.metadata
+        data = arrow_table.to_pandas(split_blocks=True)
+        if b"geom_col" in metadata:
+            geom_col = metadata[b"geom_col"].decode()
+            crs = metadata[b"crs"].decode() or None
+            data = gpd.GeoDataFrame(data, geometry=shapely.from_wkb(data[geom_col].values), crs=crs)
+            if geom_col != "geometry":
+                data = data.drop(columns=geom_col).rename_geometry(geom_col)
+        return data
+
+
+def copy_insert(table, con, keys: list, data_iter) -> None:
+    """
+    Insert method for DataFrame.to_sql that streams the rows with COPY FROM STDIN (CSV) instead of INSERT statements.
+    Use together with chunksize to bound the memory of the CSV buffer, e.g.
+    df.to_sql("edges", con, schema=SCHEMA, if_exists="append", index=False, method=copy_insert, chunksize=100000)
+    """
+    buffer = io.StringIO()
+    # None is written as \N such that it can be distinguished from an empty string
+    csv.writer(buffer).writerows([r"\N" if val is None else val for val in row] for row in data_iter)
+    buffer.seek(0)
+
+    table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    columns = ", ".join(f'"{key}"' for key in keys)
+    with con.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+
+
 def get_expected_time_linear(nr_variables: int, coef=2.17235844e-05, intercept=-15.15954725242839):
     """Fit linear function to runtime from number of variables"""
     return nr_variables * coef + intercept
@@ -45,47 +272,73 @@ def compute_nr_variables(nr_edges: int, od_len: int):
     return nr_variables
 
 
-def generate_od_nodes(od_whole_zurich_nodes: pd.DataFrame, nodes: gpd.GeoDataFrame):
+class ODOriginIndex:
+    """
+    OD matrix indexed by origin node (CSR layout): the rows are sorted by origin, and indptr gives the range of rows
+    for every origin node. Selecting the OD pairs of a set of nodes only touches the rows of these nodes.
+    """
+
+    def __init__(self, od: pd.DataFrame):
+        self.od = od
+        # row positions sorted by origin node (stable, so rows of one origin stay in their original order)
+        self.order = np.argsort(od["s"].to_numpy(), kind="stable")
+        sorted_s = od["s"].to_numpy()[self.order]
+        self.origins, start = np.unique(sorted_s, return_index=True)
+        self.indptr = np.append(start, len(sorted_s))
+        self.targets = od["t"].to_numpy()[self.order]
+
+    def rows_for_origins(self, nodes: np.ndarray) -> np.ndarray:
+        """Get the positions (in the sorted order) of all rows with an origin in nodes"""
+        pos = np.searchsorted(self.origins, nodes)
+        # only keep the nodes that appear as origin
+        found = pos < len(self.origins)
+        found[found] = self.origins[pos[found]] == nodes[found]
+        pos = pos[found]
+        starts, ends = self.indptr[pos], self.indptr[pos + 1]
+        lengths = ends - starts
+        # concatenate the ranges [start, end) of all origins
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def od_between(self, nodes) -> pd.DataFrame:
+        """Select the OD pairs where both origin and destination are in nodes (same rows as an isin-filter)"""
+        nodes = np.unique(np.asarray(nodes))
+        rows = self.rows_for_origins(nodes)
+        rows = rows[np.isin(self.targets[rows], nodes)]
+        return self.od.iloc[np.sort(self.order[rows])]
+
+
+def select_in_polygon(gdf: gpd.GeoDataFrame, tree: shapely.STRtree, polygon) -> gpd.GeoDataFrame:
+    """Select the rows of gdf that intersect the polygon, using an STRtree that was built over gdf.geometry"""
+    index = np.sort(tree.query(polygon, predicate="intersects"))
+    return gdf.iloc[index].copy()
+
+
+def generate_od_nodes(od_whole_zurich_nodes, nodes: gpd.GeoDataFrame):
     """
     Fast method for generating the OD matrix for a specific area: Take the OD matrix for the whole city and only use
     the node-pairs of nodes that appear in the nodes-dataframe
+    od_whole_zurich_nodes can be a pd.DataFrame or an ODOriginIndex (faster)
     """
     assert nodes.index.name == "osmid"
     nodes_in_area = nodes.index.unique()
+    if isinstance(od_whole_zurich_nodes, ODOriginIndex):
+        return od_whole_zurich_nodes.od_between(nodes_in_area)
     od_in_area = od_whole_zurich_nodes[
         (od_whole_zurich_nodes["s"].isin(nodes_in_area)) & (od_whole_zurich_nodes["t"].isin(nodes_in_area))
     ]
     return od_in_area
 
 
-def generate_od_geometry(area_polygon: gpd.GeoDataFrame, trips_microcensus: gpd.GeoDataFrame, nodes: gpd.GeoDataFrame):
+def generate_od_geometry(area_polygon: gpd.GeoDataFrame, od_snapper: ODSnapper, nodes: gpd.GeoDataFrame):
     """
     Slow method for generating the OD matrix for a specific area: Take the Mobility Microncensus data, and match it
     to the nodes in this area.
+    The trips of the microcensus are loaded once into the od_snapper (see ODSnapper.from_dataframe)
     """
-    # restrict trips to the ones crossing the area
-    trips = trips_microcensus.sjoin(area_polygon)
-
-    # get the closest nodes to the respective destination
-    trips.set_geometry("geom_destination", inplace=True, crs=CRS)
-    trips.to_crs(nodes.crs, inplace=True)
-    trips = trips.sjoin_nearest(nodes, distance_col="dist_destination", how="left", lsuffix="", rsuffix="destination")
-    trips.rename(columns={"osmid": "osmid_destination"}, inplace=True)
-
-    # trips["geom_origin"].apply(wkt.loads)
-    trips.set_geometry("geom_origin", inplace=True, crs=CRS)
-    trips.to_crs(nodes.crs, inplace=True)
-    trips.drop(["geom_destination"], axis=1, inplace=True)
-
-    # get the closest nodes to the respective origin
-    trips = trips.sjoin_nearest(nodes, distance_col="dist_origin", how="left", lsuffix="", rsuffix="origin")
-    trips.rename(columns={"osmid": "osmid_origin"}, inplace=True)
-    od_in_area = (
-        trips.groupby(["osmid_origin", "osmid_destination"])
-        .agg({"count": "sum"})
-        .reset_index()
-        .rename(columns={"osmid_origin": "s", "osmid_destination": "t", "count": "trips"})
-    )
+    # restrict trips to the ones crossing the area, and snap origin and destination to the closest nodes
+    area = area_polygon.to_crs(od_snapper.crs).geometry.unary_union
+    od_in_area = od_snapper.match_nodes(nodes, area=area)
     return od_in_area
 
 
@@ -97,36 +350,33 @@ def recreate_lane_graph(project_edges: pd.DataFrame, run_output: pd.DataFrame):
         project_edges.set_index(["source", "target", "edge_key"], inplace=True)
     project_edges.sort_index(inplace=True)
 
-    # add additional edges for new lanes (reversed bike lanes in the other direction)
-    reversed_bike_edges = run_output[(run_output["lanetype"] == "P") & (run_output["edge_key"].str.contains("revbike"))]
-    new_edges = []
-    for _, bike_reversed_row in reversed_bike_edges.iterrows():
-        # print(bike_reversed_row)
-        s, t, k = bike_reversed_row["source"], bike_reversed_row["target"], bike_reversed_row["edge_key"]
-        forward_row = project_edges.loc[t, s].iloc[0].to_dict()
-        forward_row["gradient"] = forward_row["gradient"] * (-1)
-        forward_row["source"] = s
-        forward_row["target"] = t
-        forward_row["lanetype"] = "P"
-        forward_row["edge_key"] = k
-        new_edges.append(forward_row)
-
-    replaced_bike_edges = run_output[
-        (run_output["lanetype"] == "P") & ~(run_output["edge_key"].str.contains("revbike"))
-    ]
+    bike_output = run_output[run_output["lanetype"] == "P"]
+    is_reversed = bike_output["edge_key"].astype(str).str.contains("revbike", regex=False).values
 
-    counter = 0
-    for _, bike_forward_row in replaced_bike_edges.iterrows():
-        s, t, k = bike_forward_row["source"], bike_forward_row["target"], str(bike_forward_row["edge_key"])
-        project_edges.loc[(s, t, k), "lanetype"] = "P"
-        counter += 1
-    # print(f"converted {counter} edges")
-    total_edges = pd.concat((project_edges.reset_index(), pd.DataFrame(new_edges)))
-    # print(len(total_edges), len(project_edges), sum(total_edges["lanetype"] == "P"))
+    # add additional edges for new lanes (reversed bike lanes in the other direction): copy the attributes of the first
+    # lane in the opposite direction
+    forward_edges = project_edges.reset_index().drop_duplicates(subset=["source", "target"])
+    forward_edges = forward_edges.drop(columns="edge_key").rename(columns={"source": "target", "target": "source"})
+    new_edges = bike_output.loc[is_reversed, ["source", "target", "edge_key"]].merge(
+        forward_edges, on=["source", "target"], how="inner"
+    )
+    new_edges["gradient"] = new_edges["gradient"] * (-1)
+    new_edges["lanetype"] = "P"
+
+    # lanes that were converted into bike lanes
+    replaced_index = pd.MultiIndex.from_arrays(
+        [
+            bike_output.loc[~is_reversed, "source"].values,
+            bike_output.loc[~is_reversed, "target"].values,
+            bike_output.loc[~is_reversed, "edge_key"].astype(str).values,
+        ]
+    )
+    project_edges.loc[project_edges.index.isin(replaced_index), "lanetype"] = "P"
+    total_edges = pd.concat((project_edges.reset_index(), new_edges), ignore_index=True)
 
     # add bike and car time attributes
-    total_edges["bike_time"] = total_edges.apply(compute_edgedependent_bike_time, axis=1)
-    total_edges["car_time"] = total_edges.apply(compute_car_time, axis=1)
+    total_edges["bike_time"] = compute_edgedependent_bike_time_vectorized(total_edges)
+    total_edges["car_time"] = compute_car_time_vectorized(total_edges)
 
     lane_graph = nx.from_pandas_edgelist(
         total_edges,
@@ -136,6 +386,128 @@ def recreate_lane_graph(project_edges: pd.DataFrame, run_output: pd.DataFrame):
     )
     return lane_graph
 
+
+class RunGraphCache:
+    """
+    LRU cache for the data of one run that the evaluation endpoints need: the lane graph reconstructed with
+    recreate_lane_graph, the OD matrix, and the raw project edges and run output.
+    The cache is bounded by the (estimated) memory of the entries. The cached objects are shared between requests, so
+    they must not be modified apart from adding attributes that only depend on the run (e.g. node coordinates).
+    """
+
+    def __init__(self, max_bytes: int = RUN_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (project_id, run_id) -> (entry, nr_bytes)
+        self.nr_bytes = 0
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def estimate_bytes(entry: dict) -> int:
+        nr_bytes = entry["lane_graph"].number_of_edges() * GRAPH_BYTES_PER_EDGE
+        for key in ["od", "edges", "run_output"]:
+            nr_bytes += entry[key].memory_usage(deep=True).sum()
+        return int(nr_bytes)
+
+    def get(self, project_id: int, run_id: int, load_run) -> dict:
+        """Get the entry of a run, or create it with load_run(project_id, run_id) if it is not cached"""
+        key = (int(project_id), int(run_id))
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+        # load outside of the lock, such that other requests are not blocked
+        with timed_span("db_read"):
+            edges, od, run_output = load_run(*key)
+        od = od.rename(columns={"source": "s", "target": "t"})
+        with timed_span("graph_reconstruction"):
+            lane_graph = recreate_lane_graph(edges.copy(), run_output)
+        entry = {"lane_graph": lane_graph, "od": od, "edges": edges, "run_output": run_output}
+        nr_bytes = self.estimate_bytes(entry)
+        with self.lock:
+            if key not in self.entries and nr_bytes <= self.max_bytes:
+                self.entries[key] = (entry, nr_bytes)
+                self.nr_bytes += nr_bytes
+            # remove least recently used entries
+            while self.nr_bytes > self.max_bytes:
+                _, (_, removed_bytes) = self.entries.popitem(last=False)
+                self.nr_bytes -= removed_bytes
+        return entry
+
+    def invalidate(self, project_id: int) -> None:
+        """Remove all runs of a project, e.g. when a new run was written"""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == int(project_id)]:
+                self.nr_bytes -= self.entries.pop(key)[1]
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.nr_bytes, "hits": self.hits, "misses": self.misses}
+
+
+def get_result_key(edges: pd.DataFrame, od: pd.DataFrame, params: dict) -> str:
+    """
+    Content hash of the inputs of an optimization: the lane graph edges, the OD matrix and the parameters. Runs with the
+    same key have the same result, so the result of an earlier run can be reused
+    """
+    edges = edges[RESULT_KEY_EDGE_COLUMNS].sort_values(["source", "target", "edge_key"])
+    od = od[["s", "t", "trips"]].sort_values(["s", "t"])
+    key = hashlib.sha1()
+    key.update(pd.util.hash_pandas_object(edges, index=False).values.tobytes())
+    key.update(pd.util.hash_pandas_object(od, index=False).values.tobytes())
+    key.update(json.dumps(params, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+def get_distance_per_lane_type(project_edges: pd.DataFrame, run_output: pd.DataFrame) -> dict:
+    """
+    Total distance of the bike lanes (P) and car lanes (M>) of a run: the lanes of the run are joined with the project
+    edges on source and target
+    """
+    run_distances = run_output[["source", "target", "lanetype"]].merge(
+        project_edges[["source", "target", "distance"]], on=["source", "target"]
+    )
+    bike_distance = run_distances.loc[run_distances["lanetype"] == "P", "distance"]
+    car_distance = run_distances.loc[run_distances["lanetype"] == "M>", "distance"]
+    return {
+        "distance_bike": float(bike_distance.sum()) if len(bike_distance) else None,
+        "distance_car": float(car_distance.sum()) if len(car_distance) else None,
+    }
+
+
+def compute_run_summary(
+    project_edges: pd.DataFrame,
+    od: pd.DataFrame,
+    run_output: pd.DataFrame,
+    nodes: pd.DataFrame = None,
+    sp_method: str = "od",
+    weight_od_flow: bool = False,
+) -> dict:
+    """
+    Compute all statistics of a run that are shown in the app in one pass: distance per lane type, degree ratios,
+    travel times and (if the node coordinates are given) network bearings
+    Args:
+        project_edges: edges of the project (columns source, target, edge_key, ...)
+        od: OD matrix with columns s, t and trips
+        run_output: lanetype of every edge after the optimization (columns source, target, edge_key, lanetype)
+        nodes: optional, node coordinates with columns osmid, x and y
+    """
+    lane_graph = recreate_lane_graph(project_edges.copy(), run_output)
+    summary = get_distance_per_lane_type(project_edges, run_output)
+    summary["bike_degree_ratios"] = json.dumps(get_degree_ratios(lane_graph, "P"))
+    summary["car_degree_ratios"] = json.dumps(get_degree_ratios(lane_graph, "M"))
+    summary["bike_travel_time"], summary["car_travel_time"] = compute_travel_times_in_graph(
+        lane_graph, od, sp_method, weight_od_flow
+    )
+    if nodes is not None:
+        nx.set_node_attributes(lane_graph, dict(zip(nodes["osmid"], nodes["x"])), "x")
+        nx.set_node_attributes(lane_graph, dict(zip(nodes["osmid"], nodes["y"])), "y")
+        summary["bike_network_bearings"] = get_network_bearings(lane_graph, "P", "distance")
+        summary["car_network_bearings"] = get_network_bearings(lane_graph, "M", "distance")
+    return summary
+
+
 ### complexity ###
 def get_mode_subgraph(lane_graph, mode):
     """
@@ -181,29 +553,106 @@ def angle_difference(bearing1, bearing2):
     return min(diff, 360 - diff)
 
 
-def get_network_bearings(lane_graph, mode, weight=None):
+def get_network_bearings(
+    lane_graph,
+    mode,
+    weight=None,
+    sample_size: int = None,
+    time_budget: float = None,
+    batch_size: int = BEARING_BATCH_SIZE,
+    seed: int = None,
+    return_ci: bool = False,
+):
     """
     Calculates and returns the average deviation of all shortest path edges from the direct bearing
     between nodes in a specified mode subgraph of a transportation network.
+    The shortest path trees are computed for a batch of sources at a time, so the paths are never stored, and the
+    deviations are computed from arrays of node coordinates by walking up the predecessor trees.
+    For large networks, the deviation can be estimated from a random sample of sources (sample_size) and / or from as
+    many sources as can be processed within time_budget seconds.
+    Returns:
+        The average deviation, or, if return_ci, a dict with the average deviation ("mean"), a 95% confidence interval
+        ("ci_low", "ci_high"; equal to the mean if all sources were used) and the number of sources used ("sources").
+        The deviation is None if the mode subgraph has no paths (e.g. a run without bike lanes)
     """
+    tic = time.time()
+    no_paths = {"mean": None, "ci_low": None, "ci_high": None, "sources": 0} if return_ci else None
     G = get_mode_subgraph(lane_graph, mode)
-
-    G = add_edge_bearings(G)  
-
-    all_pairs_sp = nx.all_pairs_dijkstra_path(G, weight=weight)
-    total_path_deviation = 0
-    path_count = 0
-                
-    for start, paths in all_pairs_sp:
-        for end, path in paths.items():
-            if start == end and len(path) <= 2:
-                continue
-            
-            average_deviation = average_path_deviation(G, path)
-            total_path_deviation += average_deviation
-            path_count += 1            
-
-    return total_path_deviation / path_count
+    if G.number_of_edges() == 0 or all(u == v for u, v in G.edges()):
+        return no_paths
+    nodes = list(G.nodes)
+    node_index = {node: i for i, node in enumerate(nodes)}
+    x = np.array([G.nodes[node]["x"] for node in nodes], dtype=float)
+    y = np.array([G.nodes[node]["y"] for node in nodes], dtype=float)
+
+    # shortest paths only use the shortest of parallel edges
+    edges = pd.DataFrame(
+        [
+            (node_index[u], node_index[v], data.get(weight, 1) if weight is not None else 1)
+            for u, v, data in G.edges(data=True)
+            if u != v
+        ],
+        columns=["u", "v", "weight"],
+    )
+    edges = edges.groupby(["u", "v"], as_index=False)["weight"].min()
+    adjacency = csr_matrix((edges["weight"].values, (edges["u"].values, edges["v"].values)), shape=(len(nodes),) * 2)
+
+    # order of the sources: random if only a part of them is used
+    if sample_size is not None or time_budget is not None:
+        sources = np.random.default_rng(seed).permutation(len(nodes))[:sample_size]
+    else:
+        sources = np.arange(len(nodes))
+
+    deviation_per_source, paths_per_source = [], []
+    for batch_start in range(0, len(sources), batch_size):
+        batch = sources[batch_start : batch_start + batch_size]
+        dist, pred = dijkstra(adjacency, indices=batch, return_predecessors=True)
+        rows, targets = np.nonzero(np.isfinite(dist))
+        is_path = targets != batch[rows]
+        rows, targets = rows[is_path], targets[is_path]
+
+        # walk from the targets to the sources and sum up the deviation of every edge from the path bearing
+        path_bearing = calculate_bearing(x[batch[rows]], y[batch[rows]], x[targets], y[targets])
+        deviation_sum, nr_edges = np.zeros(len(rows)), np.zeros(len(rows))
+        current = targets.copy()
+        active = np.ones(len(rows), dtype=bool)
+        while active.any():
+            cur = current[active]
+            prev = pred[rows[active], cur]
+            edge_bearing = calculate_bearing(y[prev], x[prev], y[cur], x[cur])
+            diff = np.abs(path_bearing[active] - edge_bearing) % 360
+            deviation_sum[active] += np.minimum(diff, 360 - diff)
+            nr_edges[active] += 1
+            current[active] = prev
+            active[active] = prev != batch[rows[active]]
+
+        deviation_per_source.append(np.bincount(rows, weights=deviation_sum / nr_edges, minlength=len(batch)))
+        paths_per_source.append(np.bincount(rows, minlength=len(batch)))
+        if time_budget is not None and time.time() - tic > time_budget:
+            break
+
+    if len(deviation_per_source) == 0:
+        return no_paths
+    deviation_per_source = np.concatenate(deviation_per_source)
+    paths_per_source = np.concatenate(paths_per_source)
+    if paths_per_source.sum() == 0:
+        return no_paths
+    mean_deviation = deviation_per_source.sum() / int(paths_per_source.sum())
+    if not return_ci:
+        return mean_deviation
+
+    # confidence interval of the ratio estimator over the sampled sources (with finite population correction)
+    nr_sampled = len(deviation_per_source)
+    if nr_sampled == len(nodes):
+        ci_low, ci_high = mean_deviation, mean_deviation
+    elif nr_sampled < 2:
+        ci_low, ci_high = None, None
+    else:
+        residuals = deviation_per_source - mean_deviation * paths_per_source
+        variance = (1 - nr_sampled / len(nodes)) * np.sum(residuals**2) / (nr_sampled - 1) / nr_sampled
+        std_error = np.sqrt(variance) / paths_per_source.mean()
+        ci_low, ci_high = mean_deviation - 1.96 * std_error, mean_deviation + 1.96 * std_error
+    return {"mean": mean_deviation, "ci_low": ci_low, "ci_high": ci_high, "sources": nr_sampled}
 
 
 def zurich_to_database(
@@ -233,3 +682,7 @@ def zurich_to_database(
     zurich_nodes.to_postgis("nodes_full", engine, schema=schema, if_exists="replace", index=True)
     zurich_edges.to_postgis("edges_full", engine, schema=schema, if_exists="replace", index=True)
     od_whole_zurich_nodes.to_sql("od_matrix_full", engine, schema=schema, if_exists="replace", index=False)
+    # new version of the data, such that the local caches of the app are refreshed (see BaseDataCache)
+    pd.DataFrame({"version": [time.strftime("%Y%m%d%H%M%S")]}).to_sql(
+        "data_version", engine, schema=schema, if_exists="append", index=False
+    )
@@ -207,6 +207,28 @@ def filter_graph_by_attribute(G_lane: nx.MultiDiGraph, attr: str, attr_values: l
     return subgraph_filtered
 
 
+def partition_graph_by_regions(G: nx.MultiDiGraph, regions_gdf: gpd.GeoDataFrame) -> dict:
+    """
+    Assign the nodes of a graph to (possibly overlapping) regions with one spatial join of all node coordinates with all
+    region polygons. The subgraph of a region is the subgraph induced by its nodes, as with
+    osmnx.truncate.truncate_graph_polygon(G, polygon, retain_all=True), which scans the whole graph for every region
+    Arguments:
+        G: graph with node attributes x and y in the crs of regions_gdf
+        regions_gdf: GeoDataFrame with the region polygons
+    Returns:
+        dict from region index to an array with the node IDs in the region (regions without nodes are missing). The
+        subgraph can be built with G.subgraph(node_ids).copy()
+    """
+    node_ids = np.array(list(G.nodes()))
+    coords = np.array([[data["x"], data["y"]] for _, data in G.nodes(data=True)])
+    nodes = gpd.GeoDataFrame(
+        {"osmid": node_ids}, geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]), crs=regions_gdf.crs
+    )
+    regions = gpd.GeoDataFrame({"region": regions_gdf.index}, geometry=regions_gdf.geometry.values, crs=regions_gdf.crs)
+    joined = gpd.sjoin(nodes, regions, how="inner", predicate="intersects")
+    return {region: region_nodes.values for region, region_nodes in joined.groupby("region")["osmid"]}
+
+
 def nodes_to_geodataframe(G, crs=4326):
     to_df = []
     for n, d in G.nodes(data=True):
@@ -251,11 +273,10 @@ def determine_vertices_on_shortest_paths(od_pair, graph, number_of_paths):
 
 def determine_arcs_between_vertices(graph, vertices):
     """Auxiliary routine that returns all arcs in the graph, that have both endpoints in the specified vertex set."""
-    valid_arcs = []
-    for arc in graph.edges():
-        if arc[0] in vertices and arc[1] in vertices:
-            valid_arcs.append(arc)
-    return list(set(valid_arcs))
+    vertices = set(vertices)
+    # only the outgoing arcs of the vertices are checked (instead of all arcs in the graph)
+    valid_arcs = {(u, v) for u in vertices if u in graph for v in graph.successors(u) if v in vertices}
+    return list(valid_arcs)
 
 
 def lossless_to_undirected(graph):
@@ -309,14 +330,23 @@ def clean_street_graph_multiedges(street_graph_edges: gpd.GeoDataFrame, lane_att
     if "u" in street_graph_edges.columns:
         street_graph_edges.set_index(["u", "v"], inplace=True)
     # make copy that contains only the ones with key 0
-    street_graph_edges_new = street_graph_edges[street_graph_edges["key"] == 0]
-    for u, v in street_graph_edges[street_graph_edges["key"] > 0].index:
-        lane_set = set()
-        for ln_desc in street_graph_edges.loc[(u, v), lane_attr].values:
-            for ln in ln_desc.split(" | "):
-                lane_set.add(ln)
-        lane_set = " | ".join(list(lane_set))
-        street_graph_edges_new.loc[(u, v), lane_attr] = lane_set
+    street_graph_edges_new = street_graph_edges[street_graph_edges["key"] == 0].copy()
+
+    # select all rows of u-v pairs that appear with a key > 0
+    multi_index = street_graph_edges.index[street_graph_edges["key"] > 0].unique()
+    if len(multi_index) == 0:
+        return street_graph_edges_new
+    multi_lanes = street_graph_edges.loc[street_graph_edges.index.isin(multi_index), lane_attr]
+
+    # one row per lane, keep every lane only once per u-v pair, and join them again
+    lanes = multi_lanes.str.split(" | ", regex=False).explode().dropna()
+    lanes = lanes[~lanes.reset_index().duplicated().values]
+    lane_set = lanes.groupby(level=[0, 1], sort=False).agg(" | ".join)
+
+    # write the merged lanes to the edges with key 0
+    lane_set = lane_set.reindex(street_graph_edges_new.index)
+    has_lane_set = lane_set.notna().values
+    street_graph_edges_new.loc[has_lane_set, lane_attr] = lane_set[has_lane_set].values
     return street_graph_edges_new
 
 
@@ -333,20 +363,25 @@ def clean_street_graph_directions(street_graph_edges: gpd.GeoDataFrame, lane_att
         gpd.GeoDataFrame: Edges with all bidirectional edges merged
     """
     new_street_graph_edges = street_graph_edges.copy()
-    # get all unique edges
-    unique_edges = set([tuple(e) for e in street_graph_edges.index])
-    # iterate over edges and set key=2 for edges where the edge in the opposite direction exists
-    for (u, v), row in street_graph_edges.iterrows():
-        # if opposite way is in the unique edges (but just do that one time)
-        if (v, u) in unique_edges and u < v:
-            new_street_graph_edges.loc[(u, v), "key"] = 2  # this will be removed
-            lanes_forward = street_graph_edges.loc[(v, u), lane_attr]
-            lanes_backward = street_graph_edges.loc[(u, v), lane_attr]
-            lanes_forward = lanes_forward.replace("-", ">")
-            lanes_backward = (
-                lanes_backward.replace("-", ">").replace("<", "<backup").replace(">", "<").replace("<backup", ">")
-            )
-            #             print(lanes_forward, "       ", lanes_backward)
-            new_lanes = " | ".join(lanes_forward.split(" | ") + lanes_backward.split(" | "))
-            new_street_graph_edges.loc[(v, u), lane_attr] = new_lanes
+    u = street_graph_edges.index.get_level_values(0)
+    v = street_graph_edges.index.get_level_values(1)
+    # find all edges where the edge in the opposite direction exists
+    reversed_index = pd.MultiIndex.from_arrays([v, u])
+    has_reverse = reversed_index.isin(street_graph_edges.index)
+    # the edge with u < v will be removed, and its lanes are added to the reverse edge (u > v)
+    to_remove = has_reverse & (u < v)
+    to_update = has_reverse & (u > v)
+
+    lanes = street_graph_edges[lane_attr]
+    lanes = lanes[~lanes.index.duplicated()]
+    lanes_forward = lanes.reindex(street_graph_edges.index[to_update]).str.replace("-", ">", regex=False)
+    # the lanes of the removed edge must be reversed (swap < and >)
+    lanes_backward = (
+        lanes.reindex(reversed_index[to_update])
+        .str.replace("-", ">", regex=False)
+        .str.translate(str.maketrans("<>", "><"))
+    )
+    new_street_graph_edges.loc[to_update, lane_attr] = lanes_forward.values + " | " + lanes_backward.values
+
+    new_street_graph_edges = new_street_graph_edges[~to_remove]
     return new_street_graph_edges[new_street_graph_edges["key"] == 0]
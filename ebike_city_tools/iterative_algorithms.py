@@ -264,11 +264,13 @@ def betweenness_pareto(
     save_graph_path=None,
     save_graph_every_x=50,
     return_graph_at_edges=None,
+    callback=None,
 ):
     """
     Arguments:
         betweenness_attr: String, if car_time, we remove edges with the minimum car_time betweenness centralityk if bike_time, we
             remove edges with the highest bike_time betwenness centrality
+        callback: function that is called with every new row of the pareto frontier (e.g. to report progress)
     """
     # initialize pareto
     pareto_df = []
@@ -295,6 +297,8 @@ def betweenness_pareto(
                 "car_time": car_travel_time,
             }
         )
+        if callback is not None:
+            callback(pareto_df[-1])
         return betweenness
 
     # set car and bike time attributes of the graph (starting from a graph with only cars)
@@ -442,6 +446,7 @@ def topdown_betweenness_pareto(
     weight_od_flow=False,
     save_graph_path=None,
     save_graph_every_x=50,
+    callback=None,
 ):
     """
     Implements the algorithm from Steinacker et al where we start with a full bike network and iteratively remove bike
@@ -513,6 +518,8 @@ def topdown_betweenness_pareto(
             }
         )
         print(pareto_df[-1])
+        if callback is not None:
+            callback(pareto_df[-1])
 
         # save graph
         if save_graph_path is not None and (edges_removed % save_graph_every_x == 0):
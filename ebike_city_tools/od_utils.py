@@ -1,7 +1,29 @@
+import os
+import hashlib
+from collections import OrderedDict
 import pandas as pd
 import geopandas as gpd
 import numpy as np
-from shapely.geometry import LineString
+import pyproj
+import shapely
+from scipy.spatial import cKDTree
+
+# number of node sets for which the KD-tree is kept in memory
+NODE_TREE_CACHE_SIZE = 32
+_node_tree_cache = OrderedDict()
+# number of OD files whose trip endpoints are kept in memory (only the newest version of each file)
+OD_SNAPPER_CACHE_SIZE = 2
+_od_snapper_cache = OrderedDict()
+# directory where the OD matrices matched to a node set are stored (see ODMatchingCache)
+OD_CACHE_DIR = os.environ.get(
+    "OD_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ebike_city_tools", "od_matching")
+)
+# number of trips that are read from a trip file at once when streaming it
+TRIP_CHUNK_SIZE = int(os.environ.get("TRIP_CHUNK_SIZE", 1_000_000))
+# OD files larger than this are streamed in chunks instead of keeping all trips in memory (see load_od_snapper)
+OD_STREAMING_MIN_BYTES = int(os.environ.get("OD_STREAMING_MIN_BYTES", 1024**3))
+# columns of a city-wide OD file
+OD_FILE_COLUMNS = ["start_lng", "start_lat", "end_lng", "end_lat", "count"]
 
 
 def reduce_od_by_trip_ratio(od: pd.DataFrame, trip_ratio: float = 0.75) -> pd.DataFrame:
@@ -30,14 +52,17 @@ def reduce_od_by_trip_ratio(od: pd.DataFrame, trip_ratio: float = 0.75) -> pd.Da
     return most_frequent_trips.drop(["cumulative_trips"], axis=1)
 
 
-def extend_od_circular(od, nodes):
+def extend_od_circular(od, nodes, seed=None):
     """
     Create new OD matrix that ensures connectivity by connecting one node to the next in a list
     od: pd.DataFrame, original OD with columns s, t and trips_per_day
     nodes: list, all nodes in the graph
+    seed: optional, random seed for shuffling the nodes. If given, the result does not depend on the order of the nodes
     """
+    if seed is not None:
+        nodes = sorted(nodes)
     # shuffle and convert to df
-    new_od_paths = pd.DataFrame(nodes, columns=["s"]).sample(frac=1).reset_index(drop=True)
+    new_od_paths = pd.DataFrame(nodes, columns=["s"]).sample(frac=1, random_state=seed).reset_index(drop=True)
     # shift by one to ensure cirularity
     new_od_paths["t"] = new_od_paths["s"].shift(1)
     # fille nan
@@ -97,71 +122,295 @@ def extend_od_matrix(od, nodes):
     return od_new
 
 
-def match_od_with_nodes(station_data_path: str, nodes: gpd.GeoDataFrame):
+def get_od_crs(station_data_path: str):
+    """
+    Get the CRS of the coordinates in a city-wide OD file and the projected CRS used for matching them to nodes
+
+    Args:
+        station_data_path (str): path to the OD file with columns start_lng, start_lat, end_lng, end_lat and count
+    Returns:
+        tuple: (CRS of the coordinates in the file, projected CRS of the city)
+    """
+    if "birchplatz" in station_data_path or "affoltern" in station_data_path or "zurich" in station_data_path:
+        return "EPSG:2056", "EPSG:2056"
+    elif "cambridge" in station_data_path:
+        return "EPSG:4326", "EPSG:2249"
+    elif "chicago" in station_data_path:
+        return "EPSG:4326", "EPSG:26971"
+    raise NotImplementedError("Unknown city")
+
+
+def nodes_to_arrays(nodes: gpd.GeoDataFrame, crs=None):
+    """Get the node IDs and the node coordinates (optionally transformed to crs) as numpy arrays"""
+    if crs is not None and nodes.crs is not None and not pyproj.CRS(nodes.crs).equals(pyproj.CRS(crs)):
+        nodes = nodes.to_crs(crs)
+    node_ids = nodes["osmid"].to_numpy() if "osmid" in nodes.columns else nodes.index.to_numpy()
+    node_coords = shapely.get_coordinates(nodes.geometry.values)
+    return node_ids, node_coords
+
+
+def node_set_hash(node_ids: np.ndarray, node_coords: np.ndarray) -> str:
+    """Hash of a node set, computed from the sorted node IDs and their coordinates"""
+    order = np.argsort(node_ids, kind="stable")
+    hasher = hashlib.sha1()
+    hasher.update(np.ascontiguousarray(node_ids[order]).astype(np.int64).tobytes())
+    hasher.update(np.ascontiguousarray(node_coords[order]).astype(np.float64).tobytes())
+    return hasher.hexdigest()
+
+
+def get_node_tree(node_ids: np.ndarray, node_coords: np.ndarray) -> cKDTree:
+    """Build a KD-tree over the node coordinates, or return the cached one if it was already built for this node set"""
+    key = node_set_hash(node_ids, node_coords)
+    if key in _node_tree_cache:
+        _node_tree_cache.move_to_end(key)
+        return _node_tree_cache[key]
+    tree = cKDTree(node_coords)
+    _node_tree_cache[key] = tree
+    if len(_node_tree_cache) > NODE_TREE_CACHE_SIZE:
+        _node_tree_cache.popitem(last=False)
+    return tree
+
+
+class ODSnapper:
+    """
+    Matches trips (origin and destination coordinates) to the closest graph nodes.
+    The trip endpoints are kept as numpy arrays, and the nodes are found with a KD-tree that is cached per node set.
+    """
+
+    def __init__(self, origins: np.ndarray, destinations: np.ndarray, trips: np.ndarray, crs):
+        """
+        Args:
+            origins (np.ndarray): array of shape (n, 2) with the x and y coordinates of the trip origins
+            destinations (np.ndarray): array of shape (n, 2) with the x and y coordinates of the trip destinations
+            trips (np.ndarray): number of trips per row
+            crs: projected CRS of the coordinates
+        """
+        self.origins = origins
+        self.destinations = destinations
+        self.trips = trips
+        self.crs = crs
+
+    @classmethod
+    def from_dataframe(cls, station_data: pd.DataFrame, crs, target_crs=None, drop_invalid: bool = False):
+        """
+        Create a snapper from a dataframe with the columns start_lng, start_lat, end_lng, end_lat and count
+
+        Args:
+            station_data (pd.DataFrame): trips with origin and destination coordinates
+            crs: CRS of the coordinates
+            target_crs (optional): if given, the coordinates are transformed to this CRS. Defaults to None.
+            drop_invalid (bool, optional): drop trips with missing coordinates or with the same origin and destination
+                (these would be invalid LineStrings). Defaults to False.
+        """
+        coords = station_data[["start_lng", "start_lat", "end_lng", "end_lat"]].to_numpy(dtype=float)
+        trips = station_data["count"].to_numpy()
+        if target_crs is not None and not pyproj.CRS(crs).equals(pyproj.CRS(target_crs)):
+            transformer = pyproj.Transformer.from_crs(crs, target_crs, always_xy=True)
+            coords[:, 0], coords[:, 1] = transformer.transform(coords[:, 0], coords[:, 1])
+            coords[:, 2], coords[:, 3] = transformer.transform(coords[:, 2], coords[:, 3])
+            crs = target_crs
+        if drop_invalid:
+            valid = np.all(np.isfinite(coords), axis=1) & np.any(coords[:, :2] != coords[:, 2:], axis=1)
+            coords, trips = coords[valid], trips[valid]
+        return cls(coords[:, :2], coords[:, 2:], trips, crs)
+
+    @classmethod
+    def from_csv(cls, station_data_path: str):
+        """Load the trips of a city-wide OD file (see get_od_crs for the supported cities)"""
+        original_crs, target_crs = get_od_crs(station_data_path)
+        station_data = pd.read_csv(station_data_path, usecols=OD_FILE_COLUMNS)
+        # print("Whole city OD matrix", len(station_data))
+        return cls.from_dataframe(
+            station_data, original_crs, target_crs=target_crs, drop_invalid=original_crs != target_crs
+        )
+
+    @classmethod
+    def iter_csv(cls, station_data_path: str, chunksize: int = TRIP_CHUNK_SIZE):
+        """Read the trips of a city-wide OD file in chunks, yields one snapper per chunk"""
+        original_crs, target_crs = get_od_crs(station_data_path)
+        for station_data in pd.read_csv(station_data_path, usecols=OD_FILE_COLUMNS, chunksize=chunksize):
+            yield cls.from_dataframe(
+                station_data, original_crs, target_crs=target_crs, drop_invalid=original_crs != target_crs
+            )
+
+    def intersects(self, area) -> np.ndarray:
+        """Boolean mask of the trips where the line from origin to destination intersects the area (a polygon)"""
+        minx, miny, maxx, maxy = area.bounds
+        # cheap bounding box check before creating any geometries
+        candidates = (
+            (np.minimum(self.origins[:, 0], self.destinations[:, 0]) <= maxx)
+            & (np.maximum(self.origins[:, 0], self.destinations[:, 0]) >= minx)
+            & (np.minimum(self.origins[:, 1], self.destinations[:, 1]) <= maxy)
+            & (np.maximum(self.origins[:, 1], self.destinations[:, 1]) >= miny)
+        )
+        candidate_lines = shapely.linestrings(
+            np.stack([self.origins[candidates], self.destinations[candidates]], axis=1)
+        )
+        mask = np.zeros(len(self.trips), dtype=bool)
+        mask[candidates] = shapely.intersects(candidate_lines, area)
+        return mask
+
+    def match(self, node_ids: np.ndarray, node_coords: np.ndarray, area=None) -> pd.DataFrame:
+        """
+        Snap origins and destinations to the closest nodes and aggregate the trips per node pair
+
+        Args:
+            node_ids (np.ndarray): IDs of the graph nodes
+            node_coords (np.ndarray): array of shape (n, 2) with the node coordinates (in the CRS of the trips)
+            area (optional): polygon, if given only the trips crossing this polygon are used. Defaults to None.
+        Returns:
+            pd.DataFrame with columns s, t and trips
+        """
+        mask = self.intersects(area) if area is not None else np.ones(len(self.trips), dtype=bool)
+        tree = get_node_tree(node_ids, node_coords)
+        _, origin_index = tree.query(self.origins[mask])
+        _, destination_index = tree.query(self.destinations[mask])
+        od = pd.DataFrame({"s": node_ids[origin_index], "t": node_ids[destination_index], "trips": self.trips[mask]})
+        return od.groupby(["s", "t"], as_index=False)["trips"].sum()
+
+    def match_nodes(self, nodes: gpd.GeoDataFrame, area=None) -> pd.DataFrame:
+        """
+        Match the trips to the nodes of a GeoDataFrame.
+        If no area is given, only the trips crossing the convex hull of the nodes are used.
+        """
+        node_ids, node_coords = nodes_to_arrays(nodes, self.crs)
+        if area is None:
+            area = shapely.multipoints(node_coords).convex_hull
+        return self.match(node_ids, node_coords, area=area)
+
+
+def add_trip_counts(counts: pd.DataFrame, new_counts: pd.DataFrame, keys: tuple = ("s", "t")) -> pd.DataFrame:
+    """Add up two tables of trip counts (columns keys and trips), used to keep running counts over chunks"""
+    if counts is None:
+        return new_counts
+    return pd.concat([counts, new_counts]).groupby(list(keys), as_index=False)["trips"].sum()
+
+
+def match_od_with_nodes_streaming(
+    station_data_path: str, nodes: gpd.GeoDataFrame, chunksize: int = TRIP_CHUNK_SIZE
+) -> pd.DataFrame:
+    """
+    Match the trips of an OD file to the nodes without loading the whole file: the trips are read in chunks, filtered
+    by the bounding box (and the convex hull) of the nodes and snapped to the closest nodes, and the counts per node
+    pair are added up. The memory depends on the number of OD pairs instead of the number of trips.
+    """
+    _, crs = get_od_crs(station_data_path)
+    node_ids, node_coords = nodes_to_arrays(nodes, crs)
+    area = shapely.multipoints(node_coords).convex_hull
+    od = None
+    for snapper in ODSnapper.iter_csv(station_data_path, chunksize=chunksize):
+        od = add_trip_counts(od, snapper.match(node_ids, node_coords, area=area))
+    if od is None:
+        return pd.DataFrame(columns=["s", "t", "trips"])
+    return od
+
+
+def load_od_snapper(station_data_path: str) -> ODSnapper:
+    """Load the trips of an OD file only once (reloaded if the file was modified)"""
+    path, mtime = os.path.abspath(station_data_path), os.path.getmtime(station_data_path)
+    if path in _od_snapper_cache and _od_snapper_cache[path][0] == mtime:
+        _od_snapper_cache.move_to_end(path)
+        return _od_snapper_cache[path][1]
+    # free the outdated version of the file before loading the new one
+    _od_snapper_cache.pop(path, None)
+    snapper = ODSnapper.from_csv(station_data_path)
+    _od_snapper_cache[path] = (mtime, snapper)
+    if len(_od_snapper_cache) > OD_SNAPPER_CACHE_SIZE:
+        _od_snapper_cache.popitem(last=False)
+    return snapper
+
+
+class ODMatchingCache:
+    """
+    Disk cache for the OD matrices (s, t, trips) created with match_od_with_nodes. The key is a hash of the node set
+    (sorted node IDs and coordinates), the path and modification time of the OD file, and the CRS.
+    The OD matrices are stored as parquet files.
+    """
+
+    def __init__(self, cache_dir: str = OD_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, station_data_path: str, node_ids: np.ndarray, node_coords: np.ndarray, crs) -> str:
+        """Compute the cache key for the nodes (coordinates in crs) matched with this OD file"""
+        hasher = hashlib.sha1()
+        hasher.update(node_set_hash(node_ids, node_coords).encode())
+        hasher.update(os.path.abspath(station_data_path).encode())
+        hasher.update(str(os.path.getmtime(station_data_path)).encode())
+        hasher.update(pyproj.CRS(crs).to_string().encode())
+        return hasher.hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"od_{key}.parquet")
+
+    def load(self, key: str):
+        """Returns the cached OD matrix or None if it is not in the cache"""
+        path = self.get_path(key)
+        if os.path.exists(path):
+            try:
+                od = pd.read_parquet(path)
+                self.hits += 1
+                return od
+            except Exception as e:
+                print("Could not read cached OD matrix", path, e)
+        self.misses += 1
+        return None
+
+    def save(self, key: str, od: pd.DataFrame) -> None:
+        """Write the OD matrix to the cache (first to a temporary file, so that the cache is never corrupted)"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        od.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# one cache per directory, such that the hit and miss counters are shared
+_od_matching_caches = {}
+
+
+def get_od_matching_cache(cache_dir: str = OD_CACHE_DIR) -> ODMatchingCache:
+    """Get the OD matching cache for this directory"""
+    if cache_dir not in _od_matching_caches:
+        _od_matching_caches[cache_dir] = ODMatchingCache(cache_dir)
+    return _od_matching_caches[cache_dir]
+
+
+def match_od_with_nodes(station_data_path: str, nodes: gpd.GeoDataFrame, cache_dir: str = None):
     """
     Match a OD matrix of coordinates with the node IDs
 
     Args:
         station_data_path (str): path to folder for one city (district)
         nodes (gpd.GeoDataFrame): List of graph nodes with geometry
+        cache_dir (str, optional): If not None, the matched OD matrix is stored in / loaded from this directory (see
+            ODMatchingCache). Defaults to None.
     Returns:
         pd.DataFrame with columns s, t and trips, containint origin and destination node id and the number of trips
     """
+    if cache_dir is not None:
+        _, crs = get_od_crs(station_data_path)
+        node_ids, node_coords = nodes_to_arrays(nodes, crs)
+        cache = get_od_matching_cache(cache_dir)
+        key = cache.get_key(station_data_path, node_ids, node_coords, crs)
+        trips_final = cache.load(key)
+        if trips_final is not None:
+            print("Loaded OD matrix from cache:", len(trips_final), "OD-pairs", cache.stats())
+            return trips_final
 
-    def linestring_from_coords(row):
-        return LineString([[row["start_lng"], row["start_lat"]], [row["end_lng"], row["end_lat"]]])
-
-    station_data = pd.read_csv(station_data_path)
-    # print("Whole city OD matrix", len(station_data))
-
-    # create linestring and convert to geodataframe
-    station_data["geometry"] = station_data.apply(linestring_from_coords, axis=1)
-    station_data = gpd.GeoDataFrame(station_data)
-    station_data.set_geometry("geometry", inplace=True)
-
-    if "birchplatz" in station_data_path or "affoltern" in station_data_path or "zurich" in station_data_path:
-        original_crs = "EPSG:2056"
-        station_data.crs = original_crs
-        nodes.to_crs(2056, inplace=True)
+    if os.path.getsize(station_data_path) > OD_STREAMING_MIN_BYTES:
+        # too large to keep all trips in memory
+        trips_final = match_od_with_nodes_streaming(station_data_path, nodes)
     else:
-        original_crs = "EPSG:4326"
-        station_data.crs = original_crs
-        if "cambridge" in station_data_path:
-            nodes.to_crs("EPSG:2249", inplace=True)
-            station_data.to_crs("EPSG:2249", inplace=True)
-        elif "chicago" in station_data_path:
-            nodes.to_crs("EPSG:26971", inplace=True)
-            station_data.to_crs("EPSG:26971", inplace=True)
-        else:
-            raise NotImplementedError("Unknown city")
-        station_data = station_data[station_data.geometry.is_valid]
-
-    # select only the rows where the linestring intersects the area polygon
-    area_polygon = gpd.GeoDataFrame(geometry=[nodes.geometry.unary_union.convex_hull], crs=nodes.crs)
-    trips = station_data.sjoin(area_polygon)
-
-    # get the closest nodes to the respective destination
-    trips["geom_destination"] = gpd.points_from_xy(x=trips["end_lng"], y=trips["end_lat"])
-    trips.set_geometry("geom_destination", inplace=True, crs=original_crs)
-    trips.to_crs(nodes.crs, inplace=True)
-    trips = trips.sjoin_nearest(nodes, distance_col="dist_destination", how="left", lsuffix="", rsuffix="destination")
-    trips.rename(columns={"osmid": "osmid_destination"}, inplace=True)
-
-    # set geometry to origin
-    trips["geom_origin"] = gpd.points_from_xy(x=trips["start_lng"], y=trips["start_lat"])
-    # trips["geom_origin"].apply(wkt.loads)
-    trips.set_geometry("geom_origin", inplace=True, crs=original_crs)
-    trips.to_crs(nodes.crs, inplace=True)
-    trips.drop(["geom_destination"], axis=1, inplace=True)
-
-    # get the closest nodes to the respective origin
-    trips = trips.sjoin_nearest(nodes, distance_col="dist_origin", how="left", lsuffix="", rsuffix="origin")
-    trips.rename(columns={"osmid": "osmid_origin"}, inplace=True)
-    trips_final = (
-        trips.groupby(["osmid_origin", "osmid_destination"])
-        .agg({"count": "sum"})
-        .reset_index()
-        .rename(columns={"osmid_origin": "s", "osmid_destination": "t", "count": "trips"})
-    )
+        snapper = load_od_snapper(station_data_path)
+        # select only the trips where the line intersects the area of the nodes, and snap them to the closest nodes
+        trips_final = snapper.match_nodes(nodes)
     print("Number of OD-pairs (nodes):", len(trips_final), "Number of trips:", trips_final["trips"].sum())
+
+    if cache_dir is not None:
+        cache.save(key, trips_final)
     return trips_final
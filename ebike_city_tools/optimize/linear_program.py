@@ -1,8 +1,11 @@
+import hashlib
+import pickle
+from collections import OrderedDict
 import networkx as nx
 import pandas as pd
 import numpy as np
 from mip import mip, INTEGER, CONTINUOUS
-from ebike_city_tools.utils import compute_bike_time, valid_arcs_spatial_selection
+from ebike_city_tools.utils import compute_bike_time, valid_arcs_spatial_selection, output_to_dataframe
 
 
 def define_IP(
@@ -272,13 +275,206 @@ def define_IP(
     )
 
     if shared_lane_variables:
-        # travel time on shared lanes -> weight by shared lane factor
+        # travel time on shared lanes -> weighted by shared lane factor in set_objective_weights
         objective_shared = mip.xsum(
-            f_shared(od_ind, e) * bike_time[e] * shared_lane_factor * od_weighting[od_ind]
+            f_shared(od_ind, e) * bike_time[e] * od_weighting[od_ind]
             for od_ind in range(len(od_flow))
             for e in G.edges
         )
-        streetIP += objective_bike + car_weight * objective_car + objective_shared
     else:
-        streetIP += objective_bike + car_weight * objective_car
+        objective_shared = None
+    # keep the terms of the objective, so that the weights can be changed without rebuilding the constraints
+    streetIP.objective_terms = (objective_bike, objective_car, objective_shared)
+    set_objective_weights(streetIP, car_weight, shared_lane_factor)
     return streetIP
+
+
+def set_objective_weights(streetIP, car_weight, shared_lane_factor):
+    """
+    Set the objective of a model from define_IP with new weights. car_weight and shared_lane_factor only appear in
+    the objective, so the model can be re-solved with other weights without rebuilding the constraints
+    """
+    objective_bike, objective_car, objective_shared = streetIP.objective_terms
+    objective = objective_bike + car_weight * objective_car
+    if objective_shared is not None:
+        objective = objective + shared_lane_factor * objective_shared
+    streetIP.objective = objective
+
+
+class LPModelCache:
+    """
+    Cache of models from define_IP by their constraint system, i.e. by the graph, OD matrix and all other arguments
+    except car_weight, shared_lane_factor and the fixed edges. The models are built without fixed edges. For a cached
+    model only the objective is replaced (e.g. when sweeping over car weights for the same project), and the fixed
+    edges are applied as bounds of the capacity variables, so all LPs of a pareto frontier use the same model.
+    """
+
+    def __init__(self, max_models=2):
+        """max_models: number of models to keep (models of large graphs need a lot of memory)"""
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def get_key(G, od_df, kwargs) -> str:
+        """Hash of everything that determines the constraints of the model (without the fixed edges)"""
+        edges = sorted(
+            (u, v, d.get("capacity"), d.get("distance"), d.get("gradient"), d.get("speed_limit"))
+            for u, v, d in G.edges(data=True)
+        )
+        od = None if od_df is None else od_df[["s", "t", "trips"]].values.tolist()
+        return hashlib.sha1(pickle.dumps((edges, od, sorted(kwargs.items())))).hexdigest()
+
+    def get_model(self, G, od_df=None, fixed_edges=pd.DataFrame(), car_weight=5, shared_lane_factor=2, **kwargs):
+        """Same as define_IP, but reuses the constraints of a cached model with the same inputs"""
+        if "edges_bike_list" in kwargs or "edges_car_list" in kwargs:
+            # the capacity variables of the fixed edges may be missing in the model -> not cached
+            return define_IP(
+                G,
+                od_df=od_df,
+                fixed_edges=fixed_edges,
+                car_weight=car_weight,
+                shared_lane_factor=shared_lane_factor,
+                **kwargs,
+            )
+        key = self.get_key(G, od_df, kwargs)
+        if key in self.models:
+            self.hits += 1
+            self.models.move_to_end(key)
+            streetIP = self.models[key]
+            set_objective_weights(streetIP, car_weight, shared_lane_factor)
+        else:
+            self.misses += 1
+            streetIP = define_IP(G, od_df=od_df, car_weight=car_weight, shared_lane_factor=shared_lane_factor, **kwargs)
+            streetIP.fixed_vars = []
+            self.models[key] = streetIP
+            while len(self.models) > self.max_models:
+                self.models.popitem(last=False)
+        set_fixed_edges(streetIP, fixed_edges)
+        return streetIP
+
+
+def set_fixed_edges(streetIP, fixed_edges: pd.DataFrame) -> None:
+    """
+    Fix the capacities of a model from define_IP (built without fixed edges) via the bounds of the capacity variables.
+    This is equivalent to building the model with fixed_edges, where the fixed capacities are constants.
+    The bounds of the edges that were fixed before are reset
+    """
+    for var in streetIP.fixed_vars:
+        var.lb, var.ub = 0, mip.INF
+    streetIP.fixed_vars = []
+    if len(fixed_edges) == 0:
+        return
+    for e, u_b, u_c in zip(fixed_edges["Edge"], fixed_edges["u_b(e)"], fixed_edges["u_c(e)"]):
+        for var, value in [(streetIP.vars[f"u_{e},b"], u_b), (streetIP.vars[f"u_{e},c"], u_c)]:
+            var.lb, var.ub = value, value
+            streetIP.fixed_vars.append(var)
+
+
+def car_weight_pareto_frontier(
+    G,
+    od_df=None,
+    min_car_weight=0.01,
+    max_car_weight=100,
+    shared_lane_factor=2,
+    tolerance=1e-6,
+    lp_cache=None,
+    **kwargs,
+):
+    """
+    Compute all LP solutions that are optimal for some car_weight in [min_car_weight, max_car_weight], i.e. the exact
+    trade-off curve between bike and car travel time of the LP. The objective is bike + car_weight * car, so every
+    solution is optimal for an interval of weights. For two neighboring solutions, the LP is re-solved at the weight
+    where their objectives are equal: either this yields a new solution between them, or the weight is the breakpoint
+    where the optimal solution changes. Only the objective changes between the solves (see LPModelCache).
+    Arguments:
+        G: street graph (nx.DiGraph)
+        od_df: Dataframe with OD pairs (columns s, t and trips)
+        min_car_weight, max_car_weight: interval of car weights to consider
+        shared_lane_factor: penalty factor for biking on car lanes (part of the bike objective)
+        tolerance: relative tolerance for deciding whether two solutions have the same objective
+        lp_cache: LPModelCache, optional
+        kwargs: further arguments for define_IP
+    Returns:
+        pareto_df: Dataframe with one row per solution, sorted by car weight, with the columns car_weight_min and
+            car_weight_max (interval of weights where the solution is optimal), bike_objective and car_objective
+        capacities: list of dataframes with the capacities of each solution (see output_to_dataframe)
+    """
+    if lp_cache is None:
+        lp_cache = LPModelCache(max_models=1)
+
+    def solve(car_weight):
+        streetIP = lp_cache.get_model(
+            G, od_df=od_df, car_weight=car_weight, shared_lane_factor=shared_lane_factor, **kwargs
+        )
+        streetIP.verbose = False
+        streetIP.optimize()
+        assert streetIP.objective_value is not None, f"LP could not be solved for car_weight={car_weight}"
+        objective_bike, objective_car, objective_shared = streetIP.objective_terms
+        bike_objective = objective_bike.x
+        if objective_shared is not None:
+            bike_objective += shared_lane_factor * objective_shared.x
+        return {
+            "car_weight": car_weight,
+            "bike_objective": bike_objective,
+            "car_objective": objective_car.x,
+            "capacities": output_to_dataframe(streetIP, G),
+        }
+
+    def is_close(a, b):
+        return abs(a - b) <= tolerance * max(1, abs(a), abs(b))
+
+    # with increasing car weight, the car objective decreases and the bike objective increases
+    solutions = [solve(min_car_weight), solve(max_car_weight)]
+    # pairs of neighboring solutions that may have other solutions between them
+    to_check = [(solutions[0], solutions[1])]
+    while len(to_check) > 0:
+        low, high = to_check.pop()
+        if is_close(low["car_objective"], high["car_objective"]):
+            # same trade-off, no solution in between
+            continue
+        # weight where both solutions have the same objective value
+        car_weight = (high["bike_objective"] - low["bike_objective"]) / (low["car_objective"] - high["car_objective"])
+        new = solve(car_weight)
+        objective_new = new["bike_objective"] + car_weight * new["car_objective"]
+        objective_low = low["bike_objective"] + car_weight * low["car_objective"]
+        # otherwise, car_weight is the breakpoint between the two solutions
+        if not (is_close(objective_new, objective_low) or objective_new > objective_low):
+            solutions.append(new)
+            to_check.extend([(low, new), (new, high)])
+
+    # sort by decreasing car objective, i.e. increasing car weight, and remove solutions with the same trade-off
+    solutions = sorted(solutions, key=lambda sol: (-sol["car_objective"], sol["bike_objective"]))
+    distinct_solutions = [solutions[0]]
+    for sol in solutions[1:]:
+        if not is_close(sol["car_objective"], distinct_solutions[-1]["car_objective"]):
+            distinct_solutions.append(sol)
+
+    # the breakpoints are the weights where neighboring solutions have the same objective. Solutions that are optimal
+    # only at a single weight (ties within the tolerance) are merged into their neighbors
+    hull, weights_min = [], []
+    for sol in distinct_solutions:
+        car_weight = min_car_weight
+        while len(hull) > 0:
+            car_weight = (sol["bike_objective"] - hull[-1]["bike_objective"]) / (
+                hull[-1]["car_objective"] - sol["car_objective"]
+            )
+            if car_weight > weights_min[-1] and not is_close(car_weight, weights_min[-1]):
+                break
+            hull.pop()
+            weights_min.pop()
+            car_weight = min_car_weight
+        if car_weight < max_car_weight and not is_close(car_weight, max_car_weight):
+            hull.append(sol)
+            weights_min.append(car_weight)
+
+    pareto_df = pd.DataFrame(
+        {
+            "car_weight_min": weights_min,
+            "car_weight_max": weights_min[1:] + [max_car_weight],
+            "bike_objective": [sol["bike_objective"] for sol in hull],
+            "car_objective": [sol["car_objective"] for sol in hull],
+        }
+    )
+    print(f"Found {len(pareto_df)} LP solutions with {lp_cache.hits + lp_cache.misses} solves")
+    return pareto_df, [sol["capacities"] for sol in hull]
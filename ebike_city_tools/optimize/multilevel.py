@@ -0,0 +1,257 @@
+import time
+import numpy as np
+import pandas as pd
+import networkx as nx
+from multiprocessing import Pool, cpu_count
+from scipy.spatial import cKDTree
+
+from ebike_city_tools.od_utils import extend_od_circular, reduce_od_by_trip_ratio
+from ebike_city_tools.graph_utils import keep_only_the_largest_connected_component
+from ebike_city_tools.optimize.round_optimized import ParetoRoundOptimize
+
+# streets of these hierarchies form the coarse (arterial) network, all other streets are grouped into neighborhoods
+ARTERIAL_HIERARCHIES = ["1_main_road"]
+# hierarchy of the edges that connect a contracted neighborhood to the arterial network
+CONNECTOR_HIERARCHY = "connector"
+# neighborhoods with fewer lanes are not refined
+MIN_NEIGHBORHOOD_EDGES = 4
+# the coarse LP only includes the most frequent OD pairs that make up this ratio of the trips (its size grows with
+# the number of OD pairs, see reduce_od_by_trip_ratio)
+COARSE_TRIP_RATIO = 0.6
+
+
+def split_into_neighborhoods(G_lane: nx.MultiDiGraph, arterial_hierarchies: list = ARTERIAL_HIERARCHIES) -> tuple:
+    """
+    Split the nodes of a lane graph into the nodes of the arterial network (all nodes that are incident to an arterial
+    lane) and neighborhoods, i.e. the connected groups of the remaining nodes, which are enclosed by arterial roads
+    Returns:
+        arterial_nodes: set of node IDs
+        neighborhoods: list of node sets
+    """
+    arterial_nodes = set()
+    for u, v, data in G_lane.edges(data=True):
+        if data.get("hierarchy") in arterial_hierarchies:
+            arterial_nodes.update([u, v])
+    G_inner = G_lane.subgraph([n for n in G_lane.nodes() if n not in arterial_nodes])
+    neighborhoods = list(nx.weakly_connected_components(G_inner))
+    return arterial_nodes, neighborhoods
+
+
+def coarsen_lane_graph(
+    G_lane: nx.MultiDiGraph, od_df: pd.DataFrame, arterial_nodes: set, neighborhoods: list
+) -> tuple:
+    """
+    Contract every neighborhood into one super-node. The coarse graph contains all lanes between arterial nodes, and
+    one fixed connector lane per direction between a super-node and each arterial node that the neighborhood is
+    connected to. The OD matrix is aggregated to the super-nodes
+    Returns:
+        G_coarse: nx.MultiDiGraph, coarse lane graph (super-nodes have negative IDs)
+        od_coarse: pd.DataFrame with columns s, t and trips
+    """
+    node_to_super = {n: -1 - i for i, neighborhood in enumerate(neighborhoods) for n in neighborhood}
+
+    G_coarse = nx.MultiDiGraph(**G_lane.graph)
+    G_coarse.add_nodes_from((n, G_lane.nodes[n]) for n in arterial_nodes)
+    # super-nodes are placed at the mean location of their nodes
+    for i, neighborhood in enumerate(neighborhoods):
+        node_attrs = pd.DataFrame([G_lane.nodes[n] for n in neighborhood])
+        attrs = {col: node_attrs[col].mean() for col in ["x", "y", "elevation"] if col in node_attrs.columns}
+        if "x" in attrs and "y" in attrs:
+            attrs["loc"] = np.array([attrs["x"], attrs["y"]])
+        G_coarse.add_node(-1 - i, **attrs)
+
+    connectors = {}
+    for u, v, k, data in G_lane.edges(keys=True, data=True):
+        if u in arterial_nodes and v in arterial_nodes:
+            G_coarse.add_edge(u, v, key=k, **data)
+        elif u in arterial_nodes or v in arterial_nodes:
+            # lane between a neighborhood and the arterial network -> aggregated into a connector
+            connectors.setdefault((node_to_super.get(u, u), node_to_super.get(v, v)), []).append(data)
+    for (u, v), lanes in connectors.items():
+        G_coarse.add_edge(
+            u,
+            v,
+            key=0,
+            lanetype="M",
+            distance=np.mean([lane["distance"] for lane in lanes]),
+            capacity=1,
+            gradient=0,
+            speed_limit=np.mean([lane["speed_limit"] for lane in lanes]),
+            fixed=True,
+            hierarchy=CONNECTOR_HIERARCHY,
+        )
+
+    od_coarse = od_df.assign(s=od_df["s"].map(lambda n: node_to_super.get(n, n)))
+    od_coarse["t"] = od_coarse["t"].map(lambda n: node_to_super.get(n, n))
+    od_coarse = od_coarse[od_coarse["s"] != od_coarse["t"]].groupby(["s", "t"], as_index=False)["trips"].sum()
+    return G_coarse, od_coarse
+
+
+def neighborhood_subproblems(
+    G_lane: nx.MultiDiGraph, od_df: pd.DataFrame, neighborhoods: list, coarse_edges: pd.DataFrame = None
+):
+    """
+    Cut out the lanes of every neighborhood (including the lanes to the adjacent arterial nodes) for the refinement,
+    with one pass over the lanes and the OD matrix.
+    The arterial lanes between the boundary nodes of a neighborhood are added from the coarse solution as fixed lanes
+    (with their coarse lanetype and coarse_lane=True), so that the refinement builds on the arterial bike lanes.
+    Trips with one end outside of the neighborhood enter or leave it at the boundary node that is closest to the
+    outside end, trips that only pass through the neighborhood are covered by the coarse solution.
+    Yields: lane graph and OD matrix of every neighborhood
+    """
+    # optimized arterial lanes by source node (without the helper lanes in the opposite direction of bike lanes)
+    coarse_lanes_by_source = {}
+    if coarse_edges is not None and len(coarse_edges) > 0:
+        coarse_edges = coarse_edges[~coarse_edges["key"].astype(str).str.contains("revbike")]
+        for lane in coarse_edges.drop(columns=["car_time", "bike_time"], errors="ignore").to_dict("records"):
+            lane = {attr: value for attr, value in lane.items() if not (np.isscalar(value) and pd.isna(value))}
+            coarse_lanes_by_source.setdefault(lane.pop("source"), []).append(lane)
+
+    node_to_neighborhood = {n: i for i, neighborhood in enumerate(neighborhoods) for n in neighborhood}
+    lanes_per_neighborhood = [[] for _ in neighborhoods]
+    for u, v, k in G_lane.edges(keys=True):
+        i = node_to_neighborhood.get(u, node_to_neighborhood.get(v))
+        if i is not None:
+            lanes_per_neighborhood[i].append((u, v, k))
+    od_df = od_df.assign(
+        s_neighborhood=od_df["s"].map(node_to_neighborhood), t_neighborhood=od_df["t"].map(node_to_neighborhood)
+    )
+    od_per_neighborhood = {}
+    for col in ["s_neighborhood", "t_neighborhood"]:
+        for i, od in od_df.groupby(col):
+            od_per_neighborhood.setdefault(int(i), []).append(od)
+
+    for i, neighborhood in enumerate(neighborhoods):
+        G_neighborhood = G_lane.edge_subgraph(lanes_per_neighborhood[i]).copy()
+        boundary_nodes = np.array([n for n in G_neighborhood.nodes() if n not in neighborhood])
+        boundary_set = set(boundary_nodes)
+        for u in boundary_nodes:
+            for lane in coarse_lanes_by_source.get(u, []):
+                if lane["target"] in boundary_set:
+                    attrs = {attr: value for attr, value in lane.items() if attr not in ["target", "key"]}
+                    attrs.update({"fixed": True, "coarse_lane": True})
+                    G_neighborhood.add_edge(u, lane["target"], key=lane["key"], **attrs)
+        od_inside = pd.concat(od_per_neighborhood.get(i, [od_df.iloc[:0]])).drop_duplicates(subset=["s", "t"])
+        od_inside = od_inside[["s", "t", "trips"]].copy()
+        if len(boundary_nodes) > 0 and len(od_inside) > 0:
+            boundary_tree = cKDTree([[G_lane.nodes[n]["x"], G_lane.nodes[n]["y"]] for n in boundary_nodes])
+            for col in ["s", "t"]:
+                outside = ~od_inside[col].isin(neighborhood)
+                if outside.any():
+                    coords = [[G_lane.nodes[n]["x"], G_lane.nodes[n]["y"]] for n in od_inside.loc[outside, col]]
+                    _, closest = boundary_tree.query(coords)
+                    od_inside.loc[outside, col] = boundary_nodes[closest]
+        od_inside = od_inside[od_inside["s"] != od_inside["t"]].groupby(["s", "t"], as_index=False)["trips"].sum()
+        yield G_neighborhood, od_inside
+
+
+def part_edge_list(G_part: nx.MultiDiGraph, lanetype: str = None) -> pd.DataFrame:
+    """
+    Edge list of the lanes of a part, without the connector lanes and the fixed lanes of the coarse solution
+    (optionally with the same lanetype for all lanes)
+    """
+    edges = nx.to_pandas_edgelist(G_part, edge_key="key")
+    if lanetype is not None:
+        edges["lanetype"] = lanetype
+    if "hierarchy" in edges.columns:
+        edges = edges[edges["hierarchy"] != CONNECTOR_HIERARCHY]
+    if "coarse_lane" in edges.columns:
+        edges = edges[~edges["coarse_lane"].eq(True)].drop(columns=["coarse_lane"])
+    return edges
+
+
+def optimize_part(args) -> pd.DataFrame:
+    """
+    Allocate bike lanes in one part of the multilevel problem (the coarse graph or one neighborhood)
+    Returns: edge list of the optimized lane graph (without connector lanes and the fixed lanes of the coarse solution)
+    """
+    G_part, od_df, optimize_params, edge_fraction, num_optimizations, fix_multilane = args
+    # the lane graph must be strongly connected for the optimization, the other lanes stay car lanes
+    G_connected = keep_only_the_largest_connected_component(G_part)
+    G_unchanged = G_part.edge_subgraph(set(G_part.edges(keys=True)) - set(G_connected.edges(keys=True)))
+    G_part = G_connected
+    od_df = od_df[od_df["s"].isin(G_part.nodes()) & od_df["t"].isin(G_part.nodes())]
+    od_df = extend_od_circular(od_df, list(G_part.nodes()))
+    if not (od_df["trips"] > 0).any():
+        # if all weightings are 0, it doesn't work, so we have to set it to 1 in this case
+        od_df["trips"] = 1
+
+    # only the lanes that are optimized in this part count for the fraction of bike lanes (not the connectors and
+    # the arterial lanes around a neighborhood)
+    nr_lanes = sum(
+        data.get("hierarchy") != CONNECTOR_HIERARCHY and not data.get("coarse_lane", False)
+        for _, _, data in G_part.edges(data=True)
+    )
+    params = {**optimize_params, "optimize_every_x": max(1, nr_lanes // num_optimizations)}
+    opt = ParetoRoundOptimize(G_part, od_df, **params)
+    optimized_G_lane, _ = opt.pareto(return_graph_at_edges=int(nr_lanes * edge_fraction), fix_multilane=fix_multilane)
+
+    optimized_edges = part_edge_list(optimized_G_lane)
+    if G_unchanged.number_of_edges() > 0:
+        optimized_edges = pd.concat([optimized_edges, part_edge_list(G_unchanged, lanetype="M>")], ignore_index=True)
+    return optimized_edges
+
+
+def multilevel_optimization(
+    G_lane: nx.MultiDiGraph,
+    od_df: pd.DataFrame,
+    optimize_params: dict = {},
+    edge_fraction: float = 0.4,
+    num_optimizations: int = 10,
+    fix_multilane: bool = True,
+    arterial_hierarchies: list = ARTERIAL_HIERARCHIES,
+    coarse_trip_ratio: float = COARSE_TRIP_RATIO,
+    processes: int = None,
+) -> pd.DataFrame:
+    """
+    Optimize the bike lane allocation of a whole city in three steps:
+    1) Coarsen: contract the neighborhoods between arterial roads into super-nodes, with the OD matrix aggregated
+    2) Solve the coarse problem, which allocates the bike lanes on the arterial network
+    3) Refine every neighborhood in parallel. The surrounding arterial lanes are fixed to the coarse solution, and
+    trips from / to the outside enter the neighborhood at its boundary nodes.
+    Every LP only covers the arterial network or one neighborhood. The neighborhood LPs are small, but the coarse LP
+    grows with the number of aggregated OD pairs (up to the squared number of super-nodes and arterial nodes), so
+    it only includes the most frequent OD pairs that make up coarse_trip_ratio of the trips.
+    Arguments:
+        G_lane: lane graph of the city with the edge attribute hierarchy
+        od_df: OD matrix with columns s, t and trips
+        optimize_params: parameters for ParetoRoundOptimize (optimize_every_x is set per part from num_optimizations)
+        edge_fraction: fraction of the lanes that should be converted into bike lanes (in each part)
+        coarse_trip_ratio: ratio of the trips that are included in the OD matrix of the coarse problem (1: all)
+        processes: number of processes for the refinement (default: number of CPUs)
+    Returns:
+        edge list of the optimized lane graph with every lane of G_lane (lanetype M> or P, see ParetoRoundOptimize),
+        plus the lanes in the opposite direction of bike lanes (key ending with revbike)
+    """
+    tic = time.time()
+    arterial_nodes, neighborhoods = split_into_neighborhoods(G_lane, arterial_hierarchies)
+    G_coarse, od_coarse = coarsen_lane_graph(G_lane, od_df, arterial_nodes, neighborhoods)
+    if coarse_trip_ratio < 1:
+        od_coarse = reduce_od_by_trip_ratio(od_coarse, coarse_trip_ratio)
+    print(
+        f"Coarse graph: {G_coarse.number_of_nodes()} nodes ({len(neighborhoods)} neighborhoods),",
+        f"{G_coarse.number_of_edges()} lanes, {len(od_coarse)} OD pairs ({time.time() - tic:.1f}s)",
+    )
+    if G_coarse.number_of_edges() > 0:
+        coarse_args = (G_coarse, od_coarse, optimize_params, edge_fraction, num_optimizations, fix_multilane)
+        coarse_edges = optimize_part(coarse_args)
+        print(f"Solved coarse problem ({time.time() - tic:.1f}s)")
+    else:
+        # no arterial roads, the whole graph is one neighborhood
+        coarse_edges = pd.DataFrame()
+
+    args_list, unchanged_edges = [], []
+    for G_neighborhood, od_neighborhood in neighborhood_subproblems(G_lane, od_df, neighborhoods, coarse_edges):
+        if len(part_edge_list(G_neighborhood)) < MIN_NEIGHBORHOOD_EDGES:
+            # small neighborhoods are not refined, their lanes stay car lanes
+            unchanged_edges.append(part_edge_list(G_neighborhood, lanetype="M>"))
+            continue
+        args_list.append(
+            (G_neighborhood, od_neighborhood, optimize_params, edge_fraction, num_optimizations, fix_multilane)
+        )
+    # largest neighborhoods first, so that they do not start last
+    args_list = sorted(args_list, key=lambda args: args[0].number_of_edges(), reverse=True)
+    with Pool(processes or cpu_count()) as pool:
+        neighborhood_edges = pool.map(optimize_part, args_list, chunksize=1)
+    print(f"Refined {len(args_list)} neighborhoods ({time.time() - tic:.1f}s)")
+    return pd.concat([coarse_edges] + neighborhood_edges + unchanged_edges, ignore_index=True)
@@ -14,13 +14,16 @@ from ebike_city_tools.utils import (
 from ebike_city_tools.graph_utils import lane_to_street_graph
 from ebike_city_tools.iterative_algorithms import transform_car_to_bike_edge
 from ebike_city_tools.metrics import compute_travel_times_in_graph
+from ebike_city_tools.profiling import observe_span
 
 FLOW_CONSTANT = 1
 
 
 class ParetoRoundOptimize:
-    def __init__(self, G_lane, od, sp_method="od", optimize_every_x=5, **kwargs):
+    def __init__(self, G_lane, od, sp_method="od", optimize_every_x=5, lp_cache=None, **kwargs):
         """
+        lp_cache: optional LPModelCache, to reuse the LP of earlier runs that only differed in car_weight or
+            shared_lane_factor
         kwargs: Potential keyword arguments to be passed to the LP function
         """
         self.G_lane = G_lane
@@ -29,6 +32,7 @@ class ParetoRoundOptimize:
         self.sp_method = sp_method
         self.optimize_every_x = optimize_every_x
         self.optimize_kwargs = kwargs
+        self.lp_cache = lp_cache
         self.shared_lane_factor = self.optimize_kwargs.get("shared_lane_factor", 2)
 
         # transform to street graph
@@ -36,6 +40,8 @@ class ParetoRoundOptimize:
 
         # log the runtimes for optimizing
         self.runtimes = {"time_init": [], "time_optim": []}
+        # function called with every new row of the pareto frontier
+        self.pareto_callback = None
 
         # init all variables for the pareto frontier
         self.reset_pareto_variables()
@@ -59,7 +65,12 @@ class ParetoRoundOptimize:
             del ip
             # initialize
             tic = time.time()
-            ip = define_IP(self.G_street, od_df=self.od, fixed_edges=fixed_capacities, **self.optimize_kwargs)
+            if self.lp_cache is not None:
+                ip = self.lp_cache.get_model(
+                    self.G_street, od_df=self.od, fixed_edges=fixed_capacities, **self.optimize_kwargs
+                )
+            else:
+                ip = define_IP(self.G_street, od_df=self.od, fixed_edges=fixed_capacities, **self.optimize_kwargs)
             toc = time.time()
             ip.verbose = False
             # optimize
@@ -67,6 +78,8 @@ class ParetoRoundOptimize:
             obj_value = ip.objective_value
             toc_optim = time.time()
             counter += 1  # increase counter
+            observe_span("lp_build", toc - tic)
+            observe_span("lp_solve", toc_optim - toc)
 
         # log runtimes
         self.runtimes["time_init"].append(toc - tic)
@@ -139,6 +152,8 @@ class ParetoRoundOptimize:
             }
         )
         print(self.pareto_df[-1])
+        if self.pareto_callback is not None:
+            self.pareto_callback(self.pareto_df[-1])
 
     def reset_pareto_variables(self):
         self.pareto_df = []
@@ -166,6 +181,12 @@ class ParetoRoundOptimize:
         self.fixed_capacities = pd.DataFrame(columns=["Edge", "u_b(e)", "u_c(e)", "capacity"])
         self.total_capacities = nx.get_edge_attributes(self.G_street, "capacity")
 
+    def observe_rounding_time(self, tic_pareto: float, nr_optimizations: int):
+        """Record the time spent in pareto() outside of building and solving the LPs as rounding time"""
+        time_lp = sum(self.runtimes["time_init"][nr_optimizations:])
+        time_lp += sum(self.runtimes["time_optim"][nr_optimizations:])
+        observe_span("rounding", time.time() - tic_pareto - time_lp)
+
     def allocate_x_bike_lanes(self, fraction_bike_lanes, fix_multilane=True):
         """Run rounding until we have allocation <fraction_bike_lanes>% of the edges as bike lanes, return graph"""
         desired_num_bike_edges = int(self.G_lane.number_of_edges() * fraction_bike_lanes)
@@ -173,7 +194,7 @@ class ParetoRoundOptimize:
         return optimized_graph
 
     def pareto(
-        self, save_graph_path=None, fix_multilane=True, return_list=False, return_graph_at_edges=None
+        self, save_graph_path=None, fix_multilane=True, return_list=False, return_graph_at_edges=None, callback=None
     ) -> pd.DataFrame:
         """
         Computes the pareto frontier of bike and car travel times by rounding in batches
@@ -182,27 +203,44 @@ class ParetoRoundOptimize:
         the edge is allocated as a bike lane
         Arguments:
             fix_multilane: bool, determines if we initially fix one bike lane per multilane - saves computational time
+            callback: function that is called with every new row of the pareto frontier (e.g. to report progress)
 
         Returns:
             pareto_frontier: pd.DataFrame with columns ["bike_time", car_time", "bike_edges", "car_edges"]
         """
+        self.pareto_callback = callback
+        tic_pareto = time.time()
+        nr_optimizations = len(self.runtimes["time_optim"])
         self.reset_pareto_variables()
 
         # whether the lane is fixed as a car lane
         is_fixed_car = nx.get_edge_attributes(self.G_lane, "fixed")
 
-        # add initial situation to pareto frontier - 0 bike edges, 0 edges added
-        self.add_to_pareto(0, 0)
+        # allocate the lanes that are fixed as bike lanes (e.g. the arterial lanes in the multilevel optimization),
+        # unless this disconnects the car graph
+        nr_fixed_bike = 0
+        for e, lanetype in nx.get_edge_attributes(self.G_lane, "lanetype").items():
+            if lanetype != "P" or not is_fixed_car.get(e, False):
+                continue
+            self.car_graph.remove_edge(*e)
+            if nx.is_strongly_connected(self.car_graph):
+                self.allocate_bike_edge(e)
+                nr_fixed_bike += 1
+            else:
+                self.car_graph.add_edge(*e)
+
+        # add initial situation to pareto frontier - 0 bike edges (apart from the fixed ones), 0 edges added
+        self.add_to_pareto(nr_fixed_bike, 0)
 
         # fix edges that are multilane as one bike edge
         if fix_multilane:
             edges_to_fix = fix_multilane_bike_lanes(self.G_lane, check_for_existing=False)
             # allocate them
             for e in edges_to_fix:
-                if not is_fixed_car.get(e, False):
+                if not is_fixed_car.get(e, False) and not self.is_bike[e[:2]]:
                     self.allocate_bike_edge(e, assert_greater_0=True, remove_from_car=True)
             # add new situation to pareto frontier -> 0 actual edges added, but already x bike edges
-            self.add_to_pareto(len(edges_to_fix), 0)
+            self.add_to_pareto(nr_fixed_bike + len(edges_to_fix), 0)
             print(pd.DataFrame(self.pareto_df))
         else:
             edges_to_fix = []
@@ -254,7 +292,7 @@ class ParetoRoundOptimize:
             # transform to bike lane -> update bike and car time
             self.allocate_bike_edge(edge_to_transform)
             # update pareto frontier
-            self.add_to_pareto(len(edges_to_fix) + edges_removed, edges_removed)
+            self.add_to_pareto(nr_fixed_bike + len(edges_to_fix) + edges_removed, edges_removed)
 
             # save graph with the same frequency as re-optimizing (always saved before reoptimizing)
             if edges_removed % self.optimize_every_x == 0:
@@ -268,8 +306,10 @@ class ParetoRoundOptimize:
 
             # return graph if at this number of edges
             if return_graph_at_edges is not None and edges_removed == return_graph_at_edges:
+                self.observe_rounding_time(tic_pareto, nr_optimizations)
                 return self.modified_G_lane, pd.DataFrame(self.pareto_df)
 
+        self.observe_rounding_time(tic_pareto, nr_optimizations)
         # if we have reached the end but not the number of edges we wanted to allocate, return graph
         if return_graph_at_edges is not None:
             return self.modified_G_lane, pd.DataFrame(self.pareto_df)
@@ -157,6 +157,7 @@ def optimization_with_snman(
     crs=2056,
     return_ranking=True,
     return_only_car_graph=False,
+    od_cache_dir=None,
     **kwargs,
 ):
     """
@@ -166,6 +167,7 @@ def optimization_with_snman(
         od_df_path (str): with OD pairs (must have columns named 's' and 't')
         edge_fraction (float): Fraction of edges that should be eliminated (= converted to bike lanes)
         optimize_params (dict): parameters for the optimization algorithm, see above for hard-coded defaults
+        od_cache_dir (str): directory to cache the OD matrix matched to the nodes of L (default: no cache)
     Returns:
         if return_ranking:
             optimized_ranking: pd.DataFrame, ranking of edges by their optimized bike lane capacity (per street!)
@@ -185,7 +187,7 @@ def optimization_with_snman(
     # make OD matrix
     if os.path.exists(od_df_path):
         node_gdf = nodes_to_geodataframe(G_lane, crs=crs)
-        od_df = match_od_with_nodes(station_data_path=od_df_path, nodes=node_gdf)
+        od_df = match_od_with_nodes(station_data_path=od_df_path, nodes=node_gdf, cache_dir=od_cache_dir)
     else:
         od_df = None
         warnings.warn("Attention: The path to a city-wide OD-matrix does not exist, so we are using a random OD")
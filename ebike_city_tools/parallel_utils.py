@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import networkx as nx
+from multiprocessing import shared_memory
+
+# node attributes that are passed to the workers ("loc" is rebuilt from x and y, other attributes such as the geometry
+# are not needed for the optimization and are dropped)
+SHARED_NODE_ATTRIBUTES = ["x", "y", "elevation"]
+
+
+class SharedArrays:
+    """
+    Numpy arrays in one block of shared memory. Only the handle (name of the block and layout of the arrays) is pickled
+    and sent to the workers, which open the arrays as views (see attach_shared_arrays)
+    """
+
+    def __init__(self, arrays: dict):
+        layout, size = [], 0
+        for name, arr in arrays.items():
+            arr = np.asarray(arr)
+            layout.append((name, arr.dtype.str, arr.shape, size))
+            # keep all arrays 8-byte aligned
+            size += -(-arr.nbytes // 8) * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for (name, dtype, shape, offset), arr in zip(layout, arrays.values()):
+            np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)[...] = arr
+        self.handle = (self.shm.name, layout)
+        self.nbytes = size
+
+    def unlink(self) -> None:
+        """Free the shared memory (once all workers are done with it)"""
+        if self.shm is None:
+            return
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+def attach_shared_arrays(handle: tuple):
+    """Open the arrays of a SharedArrays handle, returns the shared memory block (to close it) and the arrays"""
+    name, layout = handle
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = {
+        name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset) for name, dtype, shape, offset in layout
+    }
+    return shm, arrays
+
+
+def region_to_shared_arrays(G_lane: nx.MultiDiGraph, od_df: pd.DataFrame) -> tuple:
+    """
+    Put the edges and nodes of a lane graph and an OD matrix into shared memory as columnar arrays. String attributes
+    (e.g. lanetype and hierarchy) are stored as integer codes, their categories are returned with the handle
+    Returns:
+        shared: SharedArrays (the caller needs to unlink it after the worker is done)
+        metadata: dict with the categories of the string edge attributes and the graph attributes (e.g. crs)
+    """
+    edges = nx.to_pandas_edgelist(G_lane, source="source", target="target", edge_key="key")
+    nodes = pd.DataFrame.from_dict(dict(G_lane.nodes(data=True)), orient="index")
+    nodes = nodes[[col for col in SHARED_NODE_ATTRIBUTES if col in nodes.columns]]
+
+    arrays, categories = {"node:osmid": nodes.index.values}, {}
+    for col in nodes.columns:
+        arrays[f"node:{col}"] = nodes[col].values.astype(float)
+    for col in edges.columns:
+        if edges[col].dtype == object:
+            codes, categories[col] = pd.factorize(edges[col], use_na_sentinel=False)
+            arrays[f"edge:{col}"] = codes.astype(np.int32)
+        else:
+            arrays[f"edge:{col}"] = edges[col].values
+    for col in od_df.columns:
+        arrays[f"od:{col}"] = od_df[col].values
+    metadata = {"categories": {col: list(cat) for col, cat in categories.items()}, "graph": dict(G_lane.graph)}
+    return SharedArrays(arrays), metadata
+
+
+def region_from_shared_arrays(handle: tuple, metadata: dict) -> tuple:
+    """
+    Rebuild the lane graph and OD matrix from the shared arrays of region_to_shared_arrays (in the worker).
+    The graph is built directly from views of the shared arrays, only the OD matrix is copied (it outlives the shared
+    memory block, which is closed afterwards). The nodes only keep the attributes in SHARED_NODE_ATTRIBUTES and loc
+    (rebuilt from x and y), other node attributes such as the geometry are dropped. All edge attributes are kept.
+    """
+    categories = metadata["categories"]
+    shm, arrays = attach_shared_arrays(handle)
+    tables = {"node": {}, "edge": {}, "od": {}}
+    for key, arr in arrays.items():
+        table, col = key.split(":", 1)
+        if table == "edge" and col in categories:
+            arr = np.asarray(categories[col], dtype=object)[arr]
+        tables[table][col] = arr
+
+    edges = tables["edge"]
+    attrs = [col for col in edges if col not in ["source", "target", "key"]]
+    attr_values = [edges[col].tolist() for col in attrs]
+    G_lane = nx.MultiDiGraph()
+    G_lane.add_edges_from(
+        (u, v, k, {attr: values[i] for attr, values in zip(attrs, attr_values)})
+        for i, (u, v, k) in enumerate(zip(edges["source"].tolist(), edges["target"].tolist(), edges["key"].tolist()))
+    )
+    nodes = {col: arr.tolist() for col, arr in tables["node"].items() if col != "osmid"}
+    G_lane.add_nodes_from(
+        (n, {col: values[i] for col, values in nodes.items()}) for i, n in enumerate(tables["node"]["osmid"].tolist())
+    )
+    if "x" in nodes and "y" in nodes:
+        loc = {n: np.array([x, y]) for n, x, y in zip(tables["node"]["osmid"].tolist(), nodes["x"], nodes["y"])}
+        nx.set_node_attributes(G_lane, loc, "loc")
+    G_lane.graph.update(metadata["graph"])
+    od_df = pd.DataFrame({col: arr.copy() for col, arr in tables["od"].items()})
+
+    # the views must be released before the shared memory block can be closed
+    del arrays, tables, edges
+    shm.close()
+    return G_lane, od_df
@@ -0,0 +1,97 @@
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+# upper bounds of the histogram buckets in seconds (from fast requests to long LP solves)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, np.inf)
+
+
+class Histogram:
+    """Latency histogram with one series per combination of label values, rendered in the Prometheus text format"""
+
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = np.array(buckets, dtype=float)
+        self.counts = defaultdict(lambda: np.zeros(len(self.buckets), dtype=int))
+        self.sums = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        with self.lock:
+            self.counts[label_values][np.searchsorted(self.buckets, value) :] += 1
+            self.sums[label_values] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, counts in sorted(self.counts.items()):
+                labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+                for bound, count in zip(self.buckets, counts):
+                    le = "+Inf" if np.isinf(bound) else f"{bound:g}"
+                    lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {count}')
+                lines.append(f"{self.name}_sum{{{labels}}} {self.sums[label_values]}")
+                lines.append(f"{self.name}_count{{{labels}}} {counts[-1]}")
+        return lines
+
+
+REQUEST_LATENCY = Histogram(
+    "ebike_request_duration_seconds", "Latency of the app endpoints", ("endpoint", "method", "status")
+)
+SPAN_DURATION = Histogram(
+    "ebike_span_duration_seconds",
+    "Duration of the phases of a request or optimization job (DB reads, graph reconstruction, LP build, LP solve, "
+    "rounding)",
+    ("span",),
+)
+
+# spans that are recorded in worker processes and sent back to the app (see record_spans)
+_recorded_spans = threading.local()
+
+
+def observe_span(name: str, duration: float) -> None:
+    """Record the duration of one phase"""
+    SPAN_DURATION.observe(duration, name)
+    recorded = getattr(_recorded_spans, "spans", None)
+    if recorded is not None:
+        recorded.append((name, duration))
+
+
+@contextmanager
+def timed_span(name: str):
+    """Measure the duration of the block as the phase <name>"""
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_span(name, time.perf_counter() - tic)
+
+
+@contextmanager
+def record_spans():
+    """
+    Collect all spans of the block in a list of (name, duration). Used in worker processes, whose histograms are not
+    visible to the app: the list is returned to the app and added with observe_spans
+    """
+    _recorded_spans.spans = []
+    try:
+        yield _recorded_spans.spans
+    finally:
+        _recorded_spans.spans = None
+
+
+def observe_spans(spans: list) -> None:
+    for name, duration in spans:
+        SPAN_DURATION.observe(duration, name)
+
+
+def render_metrics(gauges: dict = {}) -> str:
+    """All metrics in the Prometheus text format. Additional gauges can be given as {name: value}"""
+    lines = REQUEST_LATENCY.render() + SPAN_DURATION.render()
+    for name, value in gauges.items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
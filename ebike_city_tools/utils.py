@@ -3,7 +3,9 @@ import networkx as nx
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from shapely.geometry import LineString
 from ebike_city_tools.graph_utils import (
     transfer_node_attributes,
@@ -11,6 +13,9 @@ from ebike_city_tools.graph_utils import (
     determine_arcs_between_vertices,
 )
 
+# number of origins whose shortest path trees are computed at once in valid_arcs_spatial_selection
+SHORTEST_PATH_BATCH_SIZE = 64
+
 
 def output_to_dataframe(streetIP, G: nx.DiGraph, fixed_edges: pd.DataFrame = pd.DataFrame()) -> pd.DataFrame:
     """
@@ -172,6 +177,21 @@ def compute_edgedependent_bike_time(row, shared_lane_factor: int = 2):
         return biketime * shared_lane_factor
 
 
+def compute_car_time_vectorized(edges: pd.DataFrame) -> np.ndarray:
+    """Same as compute_car_time, but for all rows of a dataframe at once"""
+    is_car = edges["lanetype"].str.contains("M", regex=False, na=False).values
+    return np.where(is_car, 60 * edges["distance"].values / edges["speed_limit"].values, np.inf)
+
+
+def compute_edgedependent_bike_time_vectorized(edges: pd.DataFrame, shared_lane_factor: int = 2) -> np.ndarray:
+    """Same as compute_edgedependent_bike_time, but for all rows of a dataframe at once"""
+    gradient = edges["gradient"].values.astype(float)
+    speed = np.where(gradient > 0, np.maximum(21.6 - 1.44 * gradient, 1), 21.6 - 0.86 * gradient)
+    biketime = 60 * (edges["distance"].values / speed)
+    is_bike = edges["lanetype"].str.contains("P", regex=False, na=False).values
+    return np.where(is_bike, biketime, biketime * shared_lane_factor)
+
+
 def compute_penalized_car_time(attr_dict: dict, bike_lane_speed: int = 10) -> int:
     if "M" in attr_dict["lanetype"]:
         return 60 * attr_dict["distance"] / attr_dict["speed_limit"]
@@ -257,42 +277,77 @@ def determine_valid_arcs(od_pairs, graph, number_of_paths=3):
     return output
 
 
-def make_node_ranking(G_base: nx.DiGraph):
+def make_node_ranking(G_base: nx.DiGraph, k_closest: int = None):
     """
     Auxiliary method to sort nodes by their distance to other nodes
 
     Args:
         G_base (nx.DiGraph): Input graph
+        k_closest (int, optional): only rank the k closest nodes (including the node itself). Defaults to None (all).
 
     Returns:
         distance_ranking (np.ndarray): 2D array with ranks of other nodes per node
         id_index_mapping (dict): maps from node ID to index in distance_ranking array
     """
     # get node attribute and save nodes in array
-    node_coords = nx.get_node_attributes(G_base, "loc")
-    id_index_mapping, index_id_mapping, node_coord_array = (
-        {},
-        np.zeros(len(node_coords)),
-        np.zeros((len(node_coords), 2)),
-    )
-    for i, (key, value) in enumerate(sorted(node_coords.items())):
-        id_index_mapping[key] = i  # map node ID to index in new array
-        node_coord_array[i] = value[:2]
-        index_id_mapping[i] = key
-
-    # compute pairwise distance
-    pairwise_distance = cdist(node_coord_array, node_coord_array)
-    # find closest nodes
-    distance_ranking = np.argsort(pairwise_distance, axis=1)
+    node_coords = sorted(nx.get_node_attributes(G_base, "loc").items())
+    index_id_mapping = np.array([key for key, _ in node_coords])
+    node_coord_array = np.array([value[:2] for _, value in node_coords], dtype=float).reshape(-1, 2)
+    id_index_mapping = {key: i for i, key in enumerate(index_id_mapping)}
+
+    # find closest nodes with a KD-tree (instead of the full pairwise distance matrix)
+    k = len(node_coords) if k_closest is None else min(k_closest, len(node_coords))
+    _, distance_ranking = cKDTree(node_coord_array).query(node_coord_array, k=k)
     # translate into closest node ID
-    for i in range(len(distance_ranking)):
-        distance_ranking[i] = index_id_mapping[(distance_ranking[i]).astype(int)]
+    distance_ranking = index_id_mapping[np.asarray(distance_ranking).reshape(len(node_coords), k)]
     return distance_ranking.astype(int), id_index_mapping
 
 
+def iter_shortest_paths(od: pd.DataFrame, G_base: nx.DiGraph, weight: str = "bike_travel_time"):
+    """
+    Compute the shortest paths of all OD pairs: the shortest path trees of a batch of origins are computed at once with
+    scipy, and the path to every destination is read from the predecessors.
+    Note: if there are several shortest paths (e.g. if the weight is missing, which counts as 1 like in networkx),
+    another one than with nx.shortest_path may be returned.
+
+    Args:
+        od (pd.DataFrame): OD matrix with columns s and t
+        G_base (nx.DiGraph): input graph
+        weight (str): edge attribute with the length of the edges
+
+    Yields:
+        (s, t, path): origin, destination and the list of nodes on the shortest path
+    """
+    nodes = list(G_base.nodes)
+    node_index = {node: i for i, node in enumerate(nodes)}
+    # adjacency matrix with only the shortest of parallel edges
+    edges = pd.DataFrame(
+        [(node_index[u], node_index[v], data.get(weight, 1)) for u, v, data in G_base.edges(data=True) if u != v],
+        columns=["u", "v", "weight"],
+    ).astype({"u": int, "v": int, "weight": float})
+    edges = edges.groupby(["u", "v"], as_index=False)["weight"].min()
+    adjacency = csr_matrix((edges["weight"].values, (edges["u"].values, edges["v"].values)), shape=(len(nodes),) * 2)
+
+    targets_per_origin = list(od.groupby("s", sort=False)["t"])
+    for batch_start in range(0, len(targets_per_origin), SHORTEST_PATH_BATCH_SIZE):
+        batch = targets_per_origin[batch_start : batch_start + SHORTEST_PATH_BATCH_SIZE]
+        _, pred = dijkstra(adjacency, indices=[node_index[s] for s, _ in batch], return_predecessors=True)
+        for row, (s, targets) in enumerate(batch):
+            for t in targets:
+                # walk from the destination back to the origin
+                path_indices = [node_index[t]]
+                while path_indices[-1] != node_index[s]:
+                    path_indices.append(pred[row, path_indices[-1]])
+                    if path_indices[-1] < 0:
+                        raise nx.NetworkXNoPath(f"No path between {s} and {t}.")
+                yield s, t, [nodes[i] for i in reversed(path_indices)]
+
+
 def valid_arcs_spatial_selection(od: pd.DataFrame, G_base: nx.DiGraph, k_closest: int):
     """
     Select arcs for each OD pair by using the k_closest nodes for each node on the shortest path
+    Note: if there are several shortest paths or several nodes at the same distance, the selection depends on the
+    tie-breaking (see iter_shortest_paths and make_node_ranking)
 
     Args:
         od (pd.DataFrame): OD matrix
@@ -304,22 +359,15 @@ def valid_arcs_spatial_selection(od: pd.DataFrame, G_base: nx.DiGraph, k_closest
     """
     assert k_closest > 0, "k closest must be at least 0"
 
-    # rank nodes by their distance to another
-    distance_ranking, id_index_mapping = make_node_ranking(G_base)
+    # rank nodes by their distance to another (only the nodes on the paths need the attribute loc)
+    distance_ranking, id_index_mapping = make_node_ranking(G_base, k_closest)
 
     valid_arcs = {}
-    # iterate over OD pairs
-    for od_pair in zip(od["s"], od["t"]):
-        (s, t) = od_pair
-        # compute shortest path between them
-        shortest_path_nodes = nx.shortest_path(G_base, s, t, "bike_travel_time")
+    for s, t, path in iter_shortest_paths(od, G_base):
         # for each node from the shortest path, find the k closest nodes
-        nodes_for_subgraph = []
-        for node in shortest_path_nodes:
-            k_closest_nodes = distance_ranking[id_index_mapping[node], :k_closest]
-            nodes_for_subgraph.extend(k_closest_nodes)
+        nodes_for_subgraph = distance_ranking[[id_index_mapping[node] for node in path]].ravel().tolist()
         # make the subgraph of all selected nodes
-        valid_arcs[od_pair] = determine_arcs_between_vertices(G_base, nodes_for_subgraph)
+        valid_arcs[(s, t)] = determine_arcs_between_vertices(G_base, nodes_for_subgraph)
     return valid_arcs
 
 
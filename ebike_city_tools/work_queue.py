@@ -0,0 +1,258 @@
+import os
+import time
+import pickle
+import socket
+import sqlite3
+import threading
+import traceback
+
+# name of the task table in the queue directory
+QUEUE_DB_FN = "tasks.db"
+# a claimed task is given to another worker if its worker did not renew the lease within this time
+LEASE_SECONDS = int(os.environ.get("QUEUE_LEASE_SECONDS", 600))
+# number of times a task is tried before it is marked as failed
+MAX_ATTEMPTS = 3
+
+
+class TaskQueue:
+    """
+    Work queue in a shared directory: an SQLite task table plus one pickle file per task payload and result.
+    Any number of workers (processes on any host that can access the directory) claim tasks with a lease, which they
+    renew while working on the task. Tasks of workers that died are given to another worker once the lease expired,
+    failed tasks are retried up to max_attempts times.
+    The default rollback journal of SQLite is used (WAL does not work on network file systems).
+    """
+
+    def __init__(self, queue_dir: str, lease_seconds: float = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.db_path = os.path.join(queue_dir, QUEUE_DB_FN)
+        os.makedirs(os.path.join(queue_dir, "payloads"), exist_ok=True)
+        os.makedirs(os.path.join(queue_dir, "results"), exist_ok=True)
+        con = self._connect()
+        con.execute(
+            """CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                priority REAL,
+                status TEXT,
+                attempts INTEGER,
+                worker TEXT,
+                lease_until REAL,
+                error TEXT
+            )"""
+        )
+        con.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # one connection per operation, so that the queue can be used after forking. Transactions are started
+        # explicitly with BEGIN IMMEDIATE, which locks the table for other writers
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def _path(self, kind: str, task_id: str) -> str:
+        return os.path.join(self.queue_dir, kind, f"{task_id}.pkl")
+
+    def _write_pickle(self, obj, path: str) -> str:
+        tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as outfile:
+            pickle.dump(obj, outfile)
+        return tmp_path
+
+    def _expire_leases(self, con: sqlite3.Connection) -> None:
+        """Tasks whose lease expired are retried, or marked as failed after max_attempts (inside a transaction)"""
+        now = time.time()
+        con.execute(
+            "UPDATE tasks SET status = 'failed', error = 'lease expired' "
+            "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+            (now, self.max_attempts),
+        )
+        con.execute("UPDATE tasks SET status = 'pending' WHERE status = 'running' AND lease_until < ?", (now,))
+
+    def publish(self, task_id: str, payload, priority: float = 0) -> None:
+        """Add a task (or reset it if it exists). Tasks with higher priority are claimed first"""
+        payload_path = self._path("payloads", task_id)
+        os.replace(self._write_pickle(payload, payload_path), payload_path)
+        if os.path.exists(self._path("results", task_id)):
+            os.remove(self._path("results", task_id))
+        con = self._connect()
+        con.execute(
+            "INSERT OR REPLACE INTO tasks VALUES (?, ?, 'pending', 0, NULL, NULL, NULL)", (task_id, float(priority))
+        )
+        con.close()
+
+    def clear(self, keep: list = []) -> None:
+        """Remove all tasks except the ones in keep, e.g. the outdated leftovers of an interrupted run"""
+        keep = set(keep)
+        con = self._connect()
+        con.execute("BEGIN IMMEDIATE")
+        task_ids = [row[0] for row in con.execute("SELECT task_id FROM tasks") if row[0] not in keep]
+        con.executemany("DELETE FROM tasks WHERE task_id = ?", [(task_id,) for task_id in task_ids])
+        con.execute("COMMIT")
+        con.close()
+        for task_id in task_ids:
+            for kind in ["payloads", "results"]:
+                if os.path.exists(self._path(kind, task_id)):
+                    os.remove(self._path(kind, task_id))
+
+    def claim(self, worker_id: str):
+        """
+        Claim the pending task with the highest priority
+        Returns: (task_id, payload), or None if no task is pending
+        """
+        con = self._connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            self._expire_leases(con)
+            row = con.execute(
+                "SELECT task_id FROM tasks WHERE status = 'pending' ORDER BY priority DESC, task_id LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                con.execute(
+                    "UPDATE tasks SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                    "WHERE task_id = ?",
+                    (worker_id, time.time() + self.lease_seconds, row[0]),
+                )
+            con.execute("COMMIT")
+        finally:
+            con.close()
+        if row is None:
+            return None
+        with open(self._path("payloads", row[0]), "rb") as infile:
+            return row[0], pickle.load(infile)
+
+    def renew(self, task_id: str, worker_id: str) -> bool:
+        """Extend the lease of a claimed task, returns False if the task is not claimed by this worker anymore"""
+        con = self._connect()
+        cursor = con.execute(
+            "UPDATE tasks SET lease_until = ? WHERE task_id = ? AND worker = ? AND status = 'running'",
+            (time.time() + self.lease_seconds, task_id, worker_id),
+        )
+        con.close()
+        return cursor.rowcount > 0
+
+    def complete(self, task_id: str, worker_id: str, result) -> bool:
+        """
+        Save the result of a claimed task. Returns False (and discards the result) if the lease was lost and the task
+        was claimed by another worker
+        """
+        result_path = self._path("results", task_id)
+        tmp_path = self._write_pickle(result, result_path)
+        con = self._connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            cursor = con.execute(
+                "UPDATE tasks SET status = 'done', lease_until = NULL "
+                "WHERE task_id = ? AND worker = ? AND status = 'running'",
+                (task_id, worker_id),
+            )
+            if cursor.rowcount > 0:
+                # the result file exists before other processes can see that the task is done
+                os.replace(tmp_path, result_path)
+            con.execute("COMMIT")
+        finally:
+            con.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return cursor.rowcount > 0
+
+    def fail(self, task_id: str, worker_id: str, error: str) -> None:
+        """Give a claimed task back to the queue for a retry, or mark it as failed after max_attempts"""
+        con = self._connect()
+        con.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, error = ?, "
+            "lease_until = NULL WHERE task_id = ? AND worker = ? AND status = 'running'",
+            (self.max_attempts, error, task_id, worker_id),
+        )
+        con.close()
+
+    def status(self) -> dict:
+        """Number of tasks per status (pending, running, done, failed)"""
+        con = self._connect()
+        counts = dict(con.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        con.close()
+        return counts
+
+    def task_statuses(self) -> dict:
+        """Status of every task by task ID"""
+        con = self._connect()
+        statuses = dict(con.execute("SELECT task_id, status FROM tasks").fetchall())
+        con.close()
+        return statuses
+
+    def iter_results(self, task_ids: list = None, poll_interval: float = 5):
+        """
+        Wait for the tasks and yield (task_id, result) in the order in which they finish (used by the coordinator)
+        Raises: RuntimeError if a task failed max_attempts times
+        """
+        remaining = None if task_ids is None else set(task_ids)
+        while remaining is None or len(remaining) > 0:
+            con = self._connect()
+            con.execute("BEGIN IMMEDIATE")
+            self._expire_leases(con)
+            con.execute("COMMIT")
+            rows = con.execute("SELECT task_id, status, error FROM tasks").fetchall()
+            con.close()
+            if remaining is None:
+                remaining = {task_id for task_id, _, _ in rows}
+            rows = [row for row in rows if row[0] in remaining]
+            failed = [(task_id, error) for task_id, status, error in rows if status == "failed"]
+            if len(failed) > 0:
+                raise RuntimeError(f"Task {failed[0][0]} failed after {self.max_attempts} attempts:\n{failed[0][1]}")
+            done = [task_id for task_id, status, _ in rows if status == "done"]
+            for task_id in done:
+                with open(self._path("results", task_id), "rb") as infile:
+                    result = pickle.load(infile)
+                remaining.remove(task_id)
+                yield task_id, result
+            if len(done) == 0 and len(remaining) > 0:
+                time.sleep(poll_interval)
+
+
+def _renew_lease(queue: TaskQueue, task_id: str, worker_id: str, stop: threading.Event) -> None:
+    while not stop.wait(queue.lease_seconds / 3):
+        if not queue.renew(task_id, worker_id):
+            print(f"Worker {worker_id} lost the lease of task {task_id}")
+            return
+
+
+def run_worker(
+    queue_dir: str,
+    function,
+    worker_id: str = None,
+    poll_interval: float = 5,
+    idle_timeout: float = None,
+    **queue_kwargs,
+) -> int:
+    """
+    Claim tasks from the queue and run function(payload) on them, while renewing the lease in the background
+    Arguments:
+        queue_dir: directory of the TaskQueue
+        function: function that is applied to the task payloads, its return value is saved as the result
+        worker_id: name of the worker (default: host name and process id)
+        idle_timeout: stop after this many seconds without a pending task (default: run until killed)
+    Returns: number of tasks that were completed by this worker
+    """
+    queue = TaskQueue(queue_dir, **queue_kwargs)
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    nr_completed, idle_since = 0, time.time()
+    while idle_timeout is None or time.time() - idle_since < idle_timeout:
+        task = queue.claim(worker_id)
+        if task is None:
+            time.sleep(poll_interval)
+            continue
+        task_id, payload = task
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_renew_lease, args=(queue, task_id, worker_id, stop), daemon=True)
+        heartbeat.start()
+        try:
+            result = function(payload)
+        except Exception:
+            print(f"Worker {worker_id} failed on task {task_id}")
+            queue.fail(task_id, worker_id, traceback.format_exc())
+        else:
+            nr_completed += queue.complete(task_id, worker_id, result)
+        finally:
+            stop.set()
+            heartbeat.join()
+        idle_since = time.time()
+    return nr_completed
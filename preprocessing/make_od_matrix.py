@@ -6,7 +6,14 @@ import pyproj
 import geopandas as gpd
 from shapely.geometry import LineString
 
-from ebike_city_tools.od_utils import match_od_with_nodes, reduce_od_by_trip_ratio
+from ebike_city_tools.od_utils import (
+    match_od_with_nodes,
+    reduce_od_by_trip_ratio,
+    get_od_matching_cache,
+    add_trip_counts,
+    OD_CACHE_DIR,
+    TRIP_CHUNK_SIZE,
+)
 
 CH1903 = "epsg:21781"
 LV05 = CH1903
@@ -31,42 +38,48 @@ def bike_sharing_preprocessing(data_path: str) -> None:
     Args:
         data_path (str): path to data folder
     """
-    all_data = []
+    all_data = None
     for i in np.arange(1, 13):
         print("processing file", i)
-        data = pd.read_csv(
+        # the trips are read in chunks and only the counts per coordinate pair are kept
+        for data in pd.read_csv(
             os.path.join(
                 data_path, "raw_od_matrix", f"2023{str(i).zfill(2)}" + filename_mapping[data_path.split(os.sep)[-1]]
-            )
-        )
-        data.rename(columns=column_name_mapping, inplace=True)
-        data.dropna(subset=["start_station_id", "end_station_id"], inplace=True)
-        data["start_station_id"] = data["start_station_id"].astype(str)
-        data["end_station_id"] = data["end_station_id"].astype(str)
-        data = data[
-            (~data["start_station_id"].str.contains("checking"))
-            & (~data["start_station_id"].str.contains("charg"))
-            & (~data["end_station_id"].str.contains("checking"))
-            & (~data["end_station_id"].str.contains("charg"))
-        ]
-        station_data = (
-            data.groupby(["start_lat", "start_lng", "end_lat", "end_lng"])
-            .agg(
-                {"start_lat": "count"}
-                #     # first version: group by station ids --> it's slightly less than using the stations
-                #     station_data = data.groupby(["start_station_id", "end_station_id"]).agg(
-                # {"ride_id": "count", "start_lat": "mean", "start_lng": "mean", "end_lat": "mean", "end_lng": "mean"}
-            )
-            .rename(columns={"start_lat": "count"})
-            .reset_index()
-        )
-        all_data.append(station_data)
-    all_data = pd.concat(all_data)
-    # group by stations again
-    all_data = all_data.groupby(["start_lat", "start_lng", "end_lat", "end_lng"]).agg({"count": "sum"}).reset_index()
+            ),
+            chunksize=TRIP_CHUNK_SIZE,
+        ):
+            station_data = count_station_trips(data)
+            all_data = add_trip_counts(all_data, station_data, keys=["start_lat", "start_lng", "end_lat", "end_lng"])
+    all_data = all_data.rename(columns={"trips": "count"})
     all_data.to_csv(os.path.join(data_path, "raw_od_matrix", "od_whole_city.csv"), index=False)
 
 
+def count_station_trips(data: pd.DataFrame) -> pd.DataFrame:
+    """Count the trips of a chunk of raw bike sharing data per start and end coordinates"""
+    data.rename(columns=column_name_mapping, inplace=True)
+    data.dropna(subset=["start_station_id", "end_station_id"], inplace=True)
+    data["start_station_id"] = data["start_station_id"].astype(str)
+    data["end_station_id"] = data["end_station_id"].astype(str)
+    data = data[
+        (~data["start_station_id"].str.contains("checking"))
+        & (~data["start_station_id"].str.contains("charg"))
+        & (~data["end_station_id"].str.contains("checking"))
+        & (~data["end_station_id"].str.contains("charg"))
+    ]
+    station_data = (
+        data.groupby(["start_lat", "start_lng", "end_lat", "end_lng"])
+        .agg(
+            {"start_lat": "count"}
+            #     # first version: group by station ids --> it's slightly less than using the stations
+            #     station_data = data.groupby(["start_station_id", "end_station_id"]).agg(
+            # {"ride_id": "count", "start_lat": "mean", "start_lng": "mean", "end_lat": "mean", "end_lng": "mean"}
+        )
+        .rename(columns={"start_lat": "trips"})
+        .reset_index()
+    )
+    return station_data
+
+
 def zurich_preprocessing(data_path: str) -> None:
     """
     Preprocess raw od data from Mobility Microcensus in Zurich
@@ -96,32 +109,39 @@ def zurich_preprocessing(data_path: str) -> None:
     station_data.to_csv(os.path.join(data_path, "raw_od_matrix", "od_whole_city.csv"), index=False)
 
 
-def match_od_with_nodes_path(data_path: str) -> pd.DataFrame:
+def match_od_with_nodes_path(data_path: str, cache_dir: str = OD_CACHE_DIR) -> pd.DataFrame:
     """
     Match a row OD matrix of coordinates with the node IDs
 
     Args:
         data_path (str): path to folder for one city (district)
+        cache_dir (str): directory for caching the matched OD matrix (None to disable caching)
     Returns:
         pd.DataFrame with columns s, t and trips, containint origin and destination node id and the number of trips
     """
     nodes = gpd.read_file(os.path.join(data_path, "nodes_all_attributes.gpkg"))
     station_data_path = os.path.join(data_path, "raw_od_matrix", "od_whole_city.csv")
-    return match_od_with_nodes(station_data_path, nodes)
+    return match_od_with_nodes(station_data_path, nodes, cache_dir=cache_dir)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--data_path", default="../street_network_data/affoltern", type=str)
     parser.add_argument("-r", "--trip_ratio", default=0.8, type=float)
+    parser.add_argument("-c", "--cache_dir", default=OD_CACHE_DIR, type=str, help="directory to cache OD matrices")
+    parser.add_argument("--no_cache", action="store_true", help="match the OD matrix without the cache")
     args = parser.parse_args()
+    if args.no_cache:
+        args.cache_dir = None
 
     data_path = args.data_path
     # preprocessing of bike sharing data
     # bike_sharing_preprocessing(data_path)
 
     # create od matrix based on the graph nodes
-    od_matrix = match_od_with_nodes_path(data_path)
+    od_matrix = match_od_with_nodes_path(data_path, cache_dir=args.cache_dir)
+    if args.cache_dir is not None:
+        print("OD matching cache", get_od_matching_cache(args.cache_dir).stats())
 
     # for chicago and cambridge: reduce od matrix size to 75% most frequent trips
     if "chicago" in data_path or "cambridge" in data_path:
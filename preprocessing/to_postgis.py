@@ -7,37 +7,26 @@ from shapely import wkt
 import datetime
 import networkx as nx
 from shapely.geometry import Point
-import geopandas as gpd
-import shapely.ops
+import shapely
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from ebike_city_tools.graph_utils import street_to_lane_graph
-from ebike_city_tools.app_utils import get_database_connector
+from ebike_city_tools.app_utils import get_database_connector, COPY_CHUNKSIZE
 
 DATABASE_CONNECTOR = get_database_connector("../../dblogin_mielab.json")
+# number of tables that are loaded into the database at the same time
+POSTGIS_WRITERS = int(os.environ.get("POSTGIS_WRITERS", 4))
 
 
 def join_with_geometry(edges, edges_geom):
     """Joins the edges with their detailed geometry"""
-
-    def reverse_geom(geom):
-        def _reverse(x, y, z=None):
-            if z:
-                return x[::-1], y[::-1], z[::-1]
-            return x[::-1], y[::-1]
-
-        return shapely.ops.transform(_reverse, geom)
-
     # drop duplicates
     edges_geom.drop_duplicates(subset=["u", "v"], inplace=True)
 
-    # first, we create the reverse geometries before we can join them
-    edges_geom_reversed = edges_geom.copy()
-    edges_geom_reversed["v_temp"] = edges_geom_reversed["v"]
-    edges_geom_reversed["v"] = edges_geom_reversed["u"]
-    edges_geom_reversed["u"] = edges_geom_reversed["v_temp"]
-    edges_geom_reversed.drop("v_temp", axis=1, inplace=True)
-    len(edges_geom_reversed)
-    edges_geom_reversed["geometry"] = edges_geom_reversed.geometry.apply(reverse_geom)
+    # first, we create the reverse geometries before we can join them (all geometries at once with shapely 2)
+    edges_geom_reversed = edges_geom.rename(columns={"u": "v", "v": "u"})
+    edges_geom_reversed["geometry"] = shapely.reverse(edges_geom_reversed.geometry.values)
     # combined forward with backward
     edges_geom_all = pd.concat([edges_geom, edges_geom_reversed])
 
@@ -50,24 +39,29 @@ def join_with_geometry(edges, edges_geom):
 
 
 def add_single_lane_flag(inp_edges):
-    car_lanes = inp_edges[inp_edges["lanetype"].str.contains("M")]
-    bike_lanes = inp_edges[~inp_edges["lanetype"].str.contains("M")]
+    """Flag the car lanes without a car lane in the opposite direction (one-way streets)"""
+    is_car = inp_edges["lanetype"].str.contains("M")
+    car_lanes = inp_edges[is_car]
     # for bike lanes, we don't need the chevrons anyways
-    bike_lanes["flag"] = 0
-
-    # add flag to car lanes
-    car_lanes.set_index(["source", "target"], inplace=True)
-    flag = []
-    for s, t in car_lanes.index:
-        if (t, s) in car_lanes.index:
-            flag.append(0)
-        else:
-            flag.append(1)
-    car_lanes["flag"] = flag
-    new_all_lanes = pd.concat([bike_lanes, car_lanes.reset_index()])
+    bike_lanes = inp_edges[~is_car].assign(flag=0)
+
+    # add flag to car lanes: 1 if there is no car lane from target to source
+    car_pairs = car_lanes.groupby(["source", "target"]).size().index
+    reverse_pairs = pd.MultiIndex.from_arrays([car_lanes["target"], car_lanes["source"]])
+    car_lanes = car_lanes.assign(flag=(~reverse_pairs.isin(car_pairs)).astype(int))
+    new_all_lanes = pd.concat([bike_lanes, car_lanes])
     return new_all_lanes
 
 
+def write_to_postgis(gdf: gpd.GeoDataFrame, table_name: str, schema: str = "graphs") -> None:
+    """Replace a table with the dataframe (geopandas loads the rows with COPY, in chunks of COPY_CHUNKSIZE)"""
+    tic = time.time()
+    gdf.to_postgis(
+        table_name, DATABASE_CONNECTOR, schema=schema, if_exists="replace", index=False, chunksize=COPY_CHUNKSIZE
+    )
+    print("Written table to database", table_name, len(gdf), f"({time.time() - tic:.1f}s)")
+
+
 def whole_city_graph_to_postgis(
     path_input="../street_network_data/zurich/street_graph_nodes.gpkg",
     path_output="outputs/rebuild_zurich/optimization_10_zurich/rebuild_whole_graph.gpkg",
@@ -104,8 +98,7 @@ def whole_city_graph_to_postgis(
 
     print(save_graph)
     # to postgis
-    save_graph.to_postgis("zurich_rebuild", DATABASE_CONNECTOR, schema="graphs", if_exists="replace", index=False)
-    print("Written lane graph to postgis", len(lane_with_geometry))
+    write_to_postgis(save_graph, "zurich_rebuild")
 
 
 include_attributes = [
@@ -124,24 +117,36 @@ include_attributes = [
 def write_all_graphs_to_postgis():
     IN_PATH_DATA = "../street_network_data/"
     IN_PATH_OUTPUTS = "outputs/cluster_mylanegraph_final/cluster_final_optimized"
-    for instance in os.listdir(IN_PATH_OUTPUTS):
+    # the tables are loaded in parallel threads while the next graphs are processed. At most POSTGIS_WRITERS tables
+    # are pending, so that the processed graphs do not pile up in memory (and errors of the writers are raised)
+    writes = deque()
+    with ThreadPoolExecutor(POSTGIS_WRITERS) as writer:
+        for save_graph, table_name in iter_graphs(IN_PATH_DATA, IN_PATH_OUTPUTS):
+            if len(writes) >= POSTGIS_WRITERS:
+                writes.popleft().result()
+            writes.append(writer.submit(write_to_postgis, save_graph, table_name))
+        for write in writes:
+            write.result()
+
+
+def iter_graphs(in_path_data: str, in_path_outputs: str):
+    """Yields the node tables and optimized graphs of all instances with their table names"""
+    for instance in os.listdir(in_path_outputs):
         if instance[0] == ".":
             continue
         # 2) Process nodes
-        nodes = gpd.read_file(os.path.join(IN_PATH_DATA, instance, "nodes_all_attributes.gpkg"))
+        nodes = gpd.read_file(os.path.join(in_path_data, instance, "nodes_all_attributes.gpkg"))
         save_nodes = nodes.rename({"osmid": "node"}, axis=1).drop(
             ["traffic_signals", "osmid_original", "highway"], axis=1
         )
-        save_nodes.to_postgis(
-            f"{instance}_nodes", DATABASE_CONNECTOR, schema="graphs", if_exists="replace", index=False
-        )
+        yield save_nodes, f"{instance}_nodes"
 
         # load edge geometries (same as lane_geometries.gpkg)
         inst_short = instance[:-2] if "_1" in instance or "_2" in instance else instance
 
-        edge_geometries = gpd.read_file(os.path.join(IN_PATH_DATA, inst_short, "edges_all_attributes.gpkg"))
+        edge_geometries = gpd.read_file(os.path.join(in_path_data, inst_short, "edges_all_attributes.gpkg"))
 
-        for f in os.listdir(os.path.join(IN_PATH_OUTPUTS, instance)):
+        for f in os.listdir(os.path.join(in_path_outputs, instance)):
             if not "csv" in f or not "graph" in f:
                 continue
 
@@ -169,7 +174,7 @@ def write_all_graphs_to_postgis():
                 continue
             # print("processing", instance, f)
 
-            edges = pd.read_csv(os.path.join(IN_PATH_OUTPUTS, instance, f))
+            edges = pd.read_csv(os.path.join(in_path_outputs, instance, f))
 
             # join edges with geometry
             edges_w_geom = join_with_geometry(edges, edge_geometries)
@@ -194,10 +199,7 @@ def write_all_graphs_to_postgis():
             save_graph = add_single_lane_flag(save_graph)
 
             out_name = f"edges_{algorithm}_bikelanes{edges_allocated}"
-            save_graph.to_postgis(
-                f"{instance}_{out_name}", DATABASE_CONNECTOR, schema="graphs", if_exists="replace", index=False
-            )
-            print("Written graph to database", f"{instance}_{out_name}")
+            yield save_graph, f"{instance}_{out_name}"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+import argparse
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from ebike_city_tools.app_utils import get_database_connector, copy_insert, COPY_CHUNKSIZE
+
+warnings.filterwarnings("ignore")
+
+SCHEMA = "benchmark"
+
+
+def random_project_edges(nr_edges: int, seed: int = 0) -> pd.DataFrame:
+    """Synthetic table with the same columns as webapp.edges"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "source": rng.integers(0, nr_edges // 3, nr_edges),
+            "target": rng.integers(0, nr_edges // 3, nr_edges),
+            "edge_key": rng.integers(0, 4, nr_edges),
+            "fixed": rng.random(nr_edges) < 0.1,
+            "lanetype": rng.choice(["M>", "H>", "M-", "P"], nr_edges),
+            "distance": rng.random(nr_edges) * 0.5,
+            "gradient": rng.normal(size=nr_edges) * 3,
+            "speed_limit": rng.choice([30, 50, 60], nr_edges),
+            "id_prj": 1,
+        }
+    )
+
+
+def time_write(engine, df: pd.DataFrame, table: str, **kwargs) -> float:
+    """Write the dataframe into an empty table in one transaction and return the runtime"""
+    with engine.begin() as con:
+        con.execute(text(f"DROP TABLE IF EXISTS {SCHEMA}.{table}"))
+    tic = time.time()
+    with engine.begin() as con:
+        df.to_sql(table, con, schema=SCHEMA, if_exists="append", index=False, **kwargs)
+    return time.time() - tic
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dblogin", type=str, default="dblogin.json", help="database login file")
+    parser.add_argument("-u", "--uri", type=str, default=None, help="database URI, e.g. of a local test database")
+    parser.add_argument("-n", "--nr_rows", type=int, nargs="+", default=[10000, 100000, 500000])
+    args = parser.parse_args()
+
+    engine = create_engine(args.uri) if args.uri is not None else get_database_connector(args.dblogin)
+    with engine.begin() as con:
+        con.execute(text(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA}"))
+
+    results = []
+    for nr_rows in args.nr_rows:
+        edges = random_project_edges(nr_rows)
+        time_insert = time_write(engine, edges, "edges_insert")
+        time_multi = time_write(engine, edges, "edges_multi", method="multi", chunksize=1000)
+        time_copy = time_write(engine, edges, "edges_copy", method=copy_insert, chunksize=COPY_CHUNKSIZE)
+
+        # check that COPY writes the same table
+        edges_insert = pd.read_sql(f"SELECT * FROM {SCHEMA}.edges_insert", engine)
+        edges_copy = pd.read_sql(f"SELECT * FROM {SCHEMA}.edges_copy", engine)
+        pd.testing.assert_frame_equal(edges_insert, edges_copy)
+
+        results.append(
+            {"rows": nr_rows, "to_sql": time_insert, "to_sql_multi": time_multi, "copy": time_copy}
+        )
+        print(results[-1])
+
+    with engine.begin() as con:
+        con.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+    results = pd.DataFrame(results)
+    results["speedup"] = results["to_sql"] / results["copy"]
+    print(results.to_string(index=False))
@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 from ebike_city_tools.synthetic import random_lane_graph, make_fake_od
 from ebike_city_tools.od_utils import extend_od_circular
 from ebike_city_tools.optimize.round_optimized import ParetoRoundOptimize
+from ebike_city_tools.optimize.linear_program import LPModelCache
 from ebike_city_tools.iterative_algorithms import topdown_betweenness_pareto, betweenness_pareto
 
 WEIGHT_OD_FLOW = False
@@ -47,12 +48,19 @@ if __name__ == "__main__":
 
         # for optimization, extend OD to ensure strongly connected
         od = extend_od_circular(od, list(G_lane.nodes()))
+        # all runs on this graph reuse one LP model (see LPModelCache)
+        lp_cache = LPModelCache(max_models=1)
 
         # Run ParetoRoundOptimize with varying batch size
         for trial, optimize_every in enumerate([G_lane.number_of_edges() + 10] + OPTIMIZE_EVERY_LIST):
             for car_weight in CAR_WEIGHT_LIST:
                 opt = ParetoRoundOptimize(
-                    G_lane.copy(), od.copy(), optimize_every_x=optimize_every, car_weight=car_weight, **kwargs
+                    G_lane.copy(),
+                    od.copy(),
+                    optimize_every_x=optimize_every,
+                    car_weight=car_weight,
+                    lp_cache=lp_cache,
+                    **kwargs,
                 )
                 pareto_front = opt.pareto()
                 optimize_every_name = "none" if trial == 0 else optimize_every
@@ -5,6 +5,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from ebike_city_tools.synthetic import random_lane_graph, make_fake_od
 from ebike_city_tools.optimize.round_optimized import ParetoRoundOptimize
+from ebike_city_tools.optimize.linear_program import LPModelCache
 from ebike_city_tools.optimize.round_optimized_sort_selection import ParetoRoundOptimizeSortSelect
 from ebike_city_tools.od_utils import extend_od_circular
 from ebike_city_tools.iterative_algorithms import topdown_betweenness_pareto, betweenness_pareto
@@ -55,6 +56,8 @@ if __name__ == "__main__":
             pareto_between.to_csv(os.path.join(OUT_PATH, f"pareto_{algorithm}_{graph_trial}.csv"), index=False)
 
         od = extend_od_circular(od, list(G_lane.nodes()))
+        # reuse one LP model across the car weights (only for ParetoRoundOptimize, the sort selection builds its own)
+        lp_cache = LPModelCache(max_models=1)
 
         # Run ParetoRoundOptimize with varying batch size
         for trial, optimize_every in enumerate([G_lane.number_of_edges() + 10] + OPTIMIZE_EVERY_LIST):
@@ -67,6 +70,7 @@ if __name__ == "__main__":
                                 od.copy(),
                                 optimize_every_x=optimize_every,
                                 car_weight=car_weight,
+                                lp_cache=lp_cache,
                                 **kwargs,
                             )
                             break  # for bike_value method we don't need the number_paths argument, so we stop
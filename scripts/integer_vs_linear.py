@@ -10,6 +10,7 @@ from ebike_city_tools.od_utils import extend_od_circular
 from ebike_city_tools.graph_utils import lane_to_street_graph
 from ebike_city_tools.optimize.round_simple import graph_from_integer_solution
 from ebike_city_tools.optimize.round_optimized import ParetoRoundOptimize
+from ebike_city_tools.optimize.linear_program import LPModelCache
 
 OUT_PATH = "outputs"
 os.makedirs(OUT_PATH, exist_ok=True)
@@ -45,6 +46,8 @@ if __name__ == "__main__":
             # define graph
             od = make_fake_od(size, int(od_factor * size**2), nodes=G.nodes)
             od = extend_od_circular(od, list(G_lane.nodes()))
+            # the linear runs on this graph only differ in car weight and fixed edges -> one LP model (see LPModelCache)
+            lp_cache = LPModelCache(max_models=1)
 
             for OPTIMIZE_EVERY_K in [10, 20]:
 
@@ -98,6 +101,7 @@ if __name__ == "__main__":
                                 sp_method=SP_METHOD,
                                 shared_lane_factor=shared_lane_factor,
                                 weight_od_flow=WEIGHT_OD_FLOW,
+                                lp_cache=lp_cache,
                             )
                             res_dict_list = opt.pareto(return_list=True)
                         # add general infos to integer or linear (pareto) solution
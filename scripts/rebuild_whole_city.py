@@ -1,10 +1,14 @@
 import argparse
 import os
+import json
+import hashlib
 import geopandas as gpd
 import pandas as pd
-import osmnx
 import time
+import threading
+import numpy as np
 import networkx as nx
+from functools import partial
 from multiprocessing import Pool, cpu_count
 from ebike_city_tools.optimize.wrapper import lane_optimization, optimization_with_snman
 from ebike_city_tools.graph_utils import (
@@ -13,10 +17,20 @@ from ebike_city_tools.graph_utils import (
     nodes_to_geodataframe,
     keep_only_the_largest_connected_component,
     filter_graph_by_attribute,
+    partition_graph_by_regions,
 )
 from ebike_city_tools.iterative_algorithms import betweenness_pareto
+from ebike_city_tools.optimize.multilevel import multilevel_optimization
 from ebike_city_tools.utils import fix_edges_from_attribute
-from ebike_city_tools.od_utils import match_od_with_nodes, reduce_od_by_trip_ratio
+from ebike_city_tools.app_utils import compute_nr_variables
+from ebike_city_tools.parallel_utils import region_to_shared_arrays, region_from_shared_arrays
+from ebike_city_tools.work_queue import TaskQueue, run_worker
+from ebike_city_tools.od_utils import (
+    match_od_with_nodes,
+    reduce_od_by_trip_ratio,
+    get_od_matching_cache,
+    OD_CACHE_DIR,
+)
 from snman.constants import *
 import snman
 import warnings
@@ -29,12 +43,19 @@ EDGE_FRACTION = 0.4
 CAR_WEIGHT = 4
 VALID_EDGES_K = 0
 REDUCE_OD_FOR_MAIN_ROADS = 0.6
+# rough memory of one LP variable (python-mip model and CBC), used to predict the memory of a region
+LP_BYTES_PER_VARIABLE = 500
+# maximum predicted memory of the regions that are optimized at the same time
+MAX_LP_MEMORY = int(os.environ.get("MAX_LP_MEMORY", 32 * 1024**3))
+# file in the output directory that maps each region to the hash of its inputs and its result file
+MANIFEST_FN = "rebuild_manifest.json"
 
 
 def snman_rebuilding(
     data_directory: str,
     output_path: str,
     whole_city_od_path: str,  # TODO: would need to pass it to rebuild_regions function as an argument for the LP
+    od_cache_dir: str = OD_CACHE_DIR,
 ):
 
     print("Load street graph")
@@ -54,74 +75,108 @@ def snman_rebuilding(
     snman.rebuilding.multi_rebuild_regions(
         G,
         rebuilding_regions_gdf,
-        rebuilding_function=optimization_with_snman,
+        rebuilding_function=partial(optimization_with_snman, od_cache_dir=od_cache_dir),
         verbose=True,
         export_G=output_path,
     )
     # save G after rebuilding is finished
 
 
-def apply_changes_to_street_graph(street_graph_init: pd.DataFrame, G_lane_modified: pd.DataFrame):
+def count_lanes_per_street(G_lanes_modified: list) -> pd.DataFrame:
     """
-    Applies changes in the motorized lanes in a lane graph to the original big street graph
+    Count the motorized lanes in both directions and the bike lanes of every street in the optimized lane graphs
+    Returns: Dataframe with columns order (index of the lane graph in the list), u, v, m_forward, m_backward and p
     """
-    # get count per source-target-lane group
-    count_per_lane = G_lane_modified.groupby(["source", "target", "lanetype"])["lanetype"].count()
-
-    # iterate over edges in the original graph and modify where necessary
-    for u, v in street_graph_init.index:
-        # extract old lanes
-        old_lanes = street_graph_init.loc[(u, v), "ln_desc"].replace("M-", "M> | M<").split(" | ")
-
-        m_forward_count, m_backward_count, p_count = 0, 0, 0
-        try:
-            m_forward_count += count_per_lane.loc[u, v, "M>"]
-        except KeyError:
-            pass
-        try:
-            m_backward_count += count_per_lane.loc[v, u, "M>"]
-        except KeyError:
-            pass
-        try:
-            p_count += count_per_lane.loc[u, v, "P"]
-            assert count_per_lane.loc[v, u, "P"] > 0
-        except KeyError:
-            pass
-
-        # no bike lane was placed, so we don't need to change anything at that edge?
-        # no, the direction of the car lane might have changed nevertheless
-        #     if p_count == 0:
-        #         continue
-
-        new_lanes = (
-            ["M>" for _ in range(m_forward_count)]
-            + ["M<" for _ in range(m_backward_count)]
-            + ["P" for _ in range(p_count)]
-        )
-        if len(new_lanes) == 0:
-            # no changes at this edge or it wasn't even processed
-            continue
+    lanes = pd.concat(
+        [edges[["source", "target", "lanetype"]].assign(order=i) for i, edges in enumerate(G_lanes_modified)]
+    )
+    counts = lanes.groupby(["order", "source", "target", "lanetype"]).size().unstack("lanetype", fill_value=0)
+    counts = counts.reindex(columns=["M>", "P"], fill_value=0)
+    # car lanes from u to v are forward lanes of (u, v) and backward lanes of (v, u)
+    forward = counts.rename(columns={"M>": "m_forward", "P": "p"}).rename_axis(["order", "u", "v"])
+    backward = counts[["M>"]].rename(columns={"M>": "m_backward"}).rename_axis(["order", "v", "u"])
+    backward = backward.reorder_levels(["order", "u", "v"])
+    counts = forward.join(backward, how="outer").fillna(0).astype(int).reset_index()
+    return counts[(counts["m_forward"] + counts["m_backward"] + counts["p"]) > 0]
 
-        # there are some new lanes
-        old_other_lanes = [l for l in old_lanes if "M" not in l]
-        old_motorized_lanes = [l for l in old_lanes if "M" in l]
-
-        # if there has been any change at all, update the motorized edges
-        if not sorted(new_lanes) == sorted(old_motorized_lanes):
-            # if a bike lane was placed, delete existing bike lanes
-            if "P" in new_lanes:
-                old_other_lanes = [l for l in old_other_lanes if "P" not in l and "L" not in l]
-            new_lanes_string = " | ".join(old_other_lanes + new_lanes)
-            if len(new_lanes_string.split(" | ")) > len(old_other_lanes) + len(old_motorized_lanes):
-                # this problem mainly arises if there are highways in the existing lanes:
-                new_lanes_string = try_fixing_highway_problem(old_other_lanes, new_lanes)
-                # print if problem persists
-                if len(new_lanes_string.split(" | ")) > len(old_other_lanes) + len(old_motorized_lanes):
-                    print("PROBLEM: more new lanes than old lanes:")
-                    print(
-                        u, v, "OLD:", old_other_lanes, old_motorized_lanes, "NEW:", new_lanes, "ATTR:", new_lanes_string
-                    )
-            street_graph_init.loc[(u, v), "ln_desc_after"] = new_lanes_string
+
+def apply_changes_to_street_graph(street_graph_init: pd.DataFrame, G_lanes_modified: list):
+    """
+    Applies changes in the motorized lanes in lane graphs to the original big street graph
+    G_lanes_modified: edge lists of the optimized lane graphs, applied in this order (if a street was optimized in
+        several lane graphs, it gets the lanes of the last one that changed it)
+    """
+    counts = count_lanes_per_street(G_lanes_modified)
+    counts = counts[pd.MultiIndex.from_frame(counts[["u", "v"]]).isin(street_graph_init.index)]
+
+    # old lanes of the streets, with one row per lane
+    old_lanes = street_graph_init["ln_desc"].str.replace("M-", "M> | M<", regex=False).str.split(" | ", regex=False)
+    old_lanes = old_lanes.rename_axis(["u", "v"]).rename("lane").explode().reset_index()
+    old_lanes = old_lanes[old_lanes["lane"].notna()]
+    is_motorized = old_lanes["lane"].str.contains("M", regex=False)
+    other_lanes = old_lanes[~is_motorized]
+    # if a bike lane is placed, existing bike lanes (P and L) are removed
+    other_lanes_without_bike = other_lanes[~other_lanes["lane"].str.contains("P|L")]
+    old = pd.DataFrame(
+        {
+            "old_m_forward": (old_lanes["lane"] == "M>").groupby([old_lanes["u"], old_lanes["v"]]).sum(),
+            "old_m_backward": (old_lanes["lane"] == "M<").groupby([old_lanes["u"], old_lanes["v"]]).sum(),
+            "old_motorized": is_motorized.groupby([old_lanes["u"], old_lanes["v"]]).sum(),
+            "other": other_lanes.groupby(["u", "v"])["lane"].agg(" | ".join),
+            "other_without_bike": other_lanes_without_bike.groupby(["u", "v"])["lane"].agg(" | ".join),
+        }
+    )
+    old[["other", "other_without_bike"]] = old[["other", "other_without_bike"]].fillna("")
+    changes = counts.join(old, on=["u", "v"])
+    changes[["old_m_forward", "old_m_backward", "old_motorized"]] = (
+        changes[["old_m_forward", "old_m_backward", "old_motorized"]].fillna(0).astype(int)
+    )
+    changes[["other", "other_without_bike"]] = changes[["other", "other_without_bike"]].fillna("")
+
+    # only update the motorized lanes if there has been any change at all
+    changed = (
+        (changes["p"] > 0)
+        | (changes["m_forward"] != changes["old_m_forward"])
+        | (changes["m_backward"] != changes["old_m_backward"])
+        | (changes["old_motorized"] != changes["old_m_forward"] + changes["old_m_backward"])
+    )
+    changes = changes[changed].copy()
+
+    # new lanes: the other lanes followed by the new motorized and bike lanes
+    other = changes["other"].where(changes["p"] == 0, changes["other_without_bike"])
+    new_lanes = (
+        pd.Series("M> | ", index=changes.index).str.repeat(changes["m_forward"])
+        + pd.Series("M< | ", index=changes.index).str.repeat(changes["m_backward"])
+        + pd.Series("P | ", index=changes.index).str.repeat(changes["p"])
+    ).str[:-3]
+    changes["new_lanes_string"] = (other + " | ").where(other != "", "") + new_lanes
+
+    # this problem mainly arises if there are highways in the existing lanes (rare, so they are fixed one by one)
+    too_many = changes["m_forward"] + changes["m_backward"] + changes["p"] > changes["old_motorized"]
+    fixed_strings = {}
+    for i, u, v, other_string, new_string, old_motorized in zip(
+        changes.index[too_many],
+        changes.loc[too_many, "u"],
+        changes.loc[too_many, "v"],
+        other[too_many],
+        new_lanes[too_many],
+        changes.loc[too_many, "old_motorized"],
+    ):
+        old_other_lanes = other_string.split(" | ") if other_string != "" else []
+        new_lanes_list = new_string.split(" | ")
+        fixed_strings[i] = try_fixing_highway_problem(old_other_lanes, new_lanes_list.copy())
+        # print if problem persists
+        if len(fixed_strings[i].split(" | ")) > len(old_other_lanes) + old_motorized:
+            print("PROBLEM: more new lanes than old lanes:")
+            print(u, v, "OLD:", old_other_lanes, "NEW:", new_lanes_list, "ATTR:", fixed_strings[i])
+    changes.loc[too_many, "new_lanes_string"] = pd.Series(fixed_strings, dtype=object)
+
+    # apply the lane graphs in the given order, i.e. the last change of a street is kept
+    changes = changes.sort_values("order", kind="stable").drop_duplicates(subset=["u", "v"], keep="last")
+    if len(changes) > 0:
+        street_graph_init.loc[pd.MultiIndex.from_frame(changes[["u", "v"]]), "ln_desc_after"] = changes[
+            "new_lanes_string"
+        ].values
     return street_graph_init
 
 
@@ -142,58 +197,168 @@ def try_fixing_highway_problem(old_other_lanes, new_lanes):
     return new_lanes_string
 
 
-def optimize_region(args):
-    G_lane_region, od_df, save_intermediate_path = args
-    tic = time.time()
-    if ALGORITHM == "optimize":
+def region_input_hash(G_lane_region: nx.MultiDiGraph, od_df: pd.DataFrame) -> str:
+    """Hash of the inputs of a region (lane graph, OD matrix and optimization parameters) to detect changed regions"""
+    edges = nx.to_pandas_edgelist(G_lane_region, edge_key="key")
+    edges = edges[sorted(edges.columns)].sort_values(["source", "target", "key"])
+    od = od_df.sort_values(["s", "t"])
+    params = [ALGORITHM, NUM_OPTIMIZATIONS, EDGE_FRACTION, CAR_WEIGHT, VALID_EDGES_K]
+    key = hashlib.sha1()
+    key.update(pd.util.hash_pandas_object(edges, index=False).values.tobytes())
+    key.update(pd.util.hash_pandas_object(od, index=False).values.tobytes())
+    key.update(json.dumps(params).encode())
+    return key.hexdigest()
+
+
+def load_manifest(output_path: str) -> dict:
+    manifest_path = os.path.join(output_path, MANIFEST_FN)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as infile:
+        return json.load(infile)
+
+
+def save_manifest(output_path: str, manifest: dict) -> None:
+    # write to a temporary file first, so that an interrupted run cannot leave a corrupt manifest
+    manifest_path = os.path.join(output_path, MANIFEST_FN)
+    with open(manifest_path + ".tmp", "w") as outfile:
+        json.dump(manifest, outfile, indent=4)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+class MemoryBudget:
+    """Limits the predicted memory of the regions that are optimized at the same time"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.aborted = False
+        self.condition = threading.Condition()
+
+    def acquire(self, nr_bytes: int) -> bool:
+        """Wait until the region fits into the budget. Returns False if the budget was aborted while waiting"""
+        with self.condition:
+            # a region that exceeds the budget on its own is started when no other region is running
+            self.condition.wait_for(lambda: self.aborted or self.used == 0 or self.used + nr_bytes <= self.max_bytes)
+            if self.aborted:
+                return False
+            self.used += nr_bytes
+            return True
+
+    def release(self, nr_bytes: int) -> None:
+        with self.condition:
+            self.used -= nr_bytes
+            self.condition.notify_all()
+
+    def abort(self) -> None:
+        """Stop waiting regions (e.g. if a worker failed, its memory is never released)"""
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+
+def schedule_regions(args_list: list, costs: list, memory: list, budget: MemoryBudget):
+    """
+    Yield the region arguments ordered by decreasing predicted cost, so that the largest regions do not start last.
+    Regions are only handed to the pool when their predicted memory fits into the budget
+    (the generator is consumed by the task handler thread of the pool, so waiting here does not block the results)
+    """
+    for i in np.argsort(costs)[::-1]:
+        if args_list[i] is None:
+            # result was loaded from an earlier run
+            continue
+        if not budget.acquire(memory[i]):
+            return
+        yield int(i), args_list[i]
+
+
+def region_parameters() -> dict:
+    """Parameters of the region optimization (sent with the tasks of the work queue, so that all workers use them)"""
+    return {
+        "algorithm": ALGORITHM,
+        "num_optimizations": NUM_OPTIMIZATIONS,
+        "edge_fraction": EDGE_FRACTION,
+        "car_weight": CAR_WEIGHT,
+        "valid_edges_k": VALID_EDGES_K,
+    }
+
+
+def optimize_lane_graph(
+    G_lane_region: nx.MultiDiGraph,
+    od_df: pd.DataFrame,
+    algorithm: str = ALGORITHM,
+    num_optimizations: int = NUM_OPTIMIZATIONS,
+    edge_fraction: float = EDGE_FRACTION,
+    car_weight: float = CAR_WEIGHT,
+    valid_edges_k: int = VALID_EDGES_K,
+) -> pd.DataFrame:
+    """Optimize the lanes of one region, returns the edge list of the optimized lane graph"""
+    if algorithm == "optimize":
         # set parameters based on graph size
         m = G_lane_region.number_of_edges()
         params = {
-            "optimize_every_x": int(m / NUM_OPTIMIZATIONS),
-            "valid_edges_k": VALID_EDGES_K if m < 1000 else 50,
-            "car_weight": CAR_WEIGHT,
+            "optimize_every_x": int(m / num_optimizations),
+            "valid_edges_k": valid_edges_k if m < 1000 else 50,
+            "car_weight": car_weight,
         }
         # optimize region
-        optimized_G_lane = lane_optimization(G_lane_region, od_df, optimize_params=params, edge_fraction=EDGE_FRACTION)
-    elif ALGORITHM == "betweenness":
+        optimized_G_lane = lane_optimization(G_lane_region, od_df, optimize_params=params, edge_fraction=edge_fraction)
+    elif algorithm == "betweenness":
         optimized_G_lane, _ = betweenness_pareto(
             G_lane_region, od_df, sp_method="od", return_graph_at_edges=int(0.4 * G_lane_region.number_of_edges())
         )
     else:
         raise NotImplementedError("algorithm must be betweenness or optimize")
-    # save the intermediate result
-    nx.to_pandas_edgelist(optimized_G_lane, edge_key="key").to_csv(save_intermediate_path)
+    return nx.to_pandas_edgelist(optimized_G_lane, edge_key="key")
+
+
+def save_region_result(optimized_edges: pd.DataFrame, save_intermediate_path: str) -> None:
+    # save the intermediate result (via a temporary file, so that a killed worker cannot leave a corrupt result)
+    tmp_path = f"{save_intermediate_path}.{os.getpid()}.tmp"
+    optimized_edges.to_csv(tmp_path)
+    os.replace(tmp_path, save_intermediate_path)
+
+
+def optimize_region(args):
+    region_index, (region_handle, region_metadata, save_intermediate_path) = args
+    tic = time.time()
+    # rebuild the region inputs from shared memory
+    G_lane_region, od_df = region_from_shared_arrays(region_handle, region_metadata)
+    optimized_edges = optimize_lane_graph(G_lane_region, od_df)
+    save_region_result(optimized_edges, save_intermediate_path)
     print("FINISHED REGION", save_intermediate_path, time.time() - tic)
-    return optimized_G_lane
+    return region_index, optimized_edges
+
+
+def optimize_region_task(payload: dict) -> pd.DataFrame:
+    """Optimize a region that was claimed from the work queue (see run_region_worker)"""
+    tic = time.time()
+    optimized_edges = optimize_lane_graph(payload["G_lane"], payload["od"], **payload["params"])
+    print("FINISHED REGION", payload["name"], time.time() - tic)
+    return optimized_edges
+
+
+def run_region_worker(queue_dir: str, idle_timeout: float = None) -> None:
+    """Worker for the work queue mode: can be started on any host that has access to the queue directory"""
+    nr_completed = run_worker(queue_dir, optimize_region_task, idle_timeout=idle_timeout)
+    print("Worker finished, completed regions:", nr_completed)
 
 
 def rebuild_street_network_parallel(
-    data_directory: str, output_path: str, whole_city_od_path: str, out_attr_name: str = "ln_desc_after"
+    data_directory: str,
+    output_path: str,
+    whole_city_od_path: str,
+    out_attr_name: str = "ln_desc_after",
+    od_cache_dir: str = OD_CACHE_DIR,
+    queue_dir: str = None,
 ):
+    """
+    Optimize the rebuilding regions in parallel, either in a local pool or (if queue_dir is given) by publishing them
+    to a work queue, which is processed by workers on any number of hosts (see run_region_worker)
+    """
     tic = time.time()
     # 1) LOADING
-    # load lane graph - MultiDiGraph
-    # load nodes and edges dataframes
-    street_graph_nodes, street_graph_edges = load_nodes_edges_dataframes(
-        data_directory,
-        node_fn="street_graph_nodes.gpkg",
-        edge_fn="street_graph_edges.gpkg",
-        remove_multistreets=True,
-        target_crs=CRS_internal,
-    )
-    # create lane graph
-    G_lane = street_to_lane_graph(street_graph_nodes, street_graph_edges, target_crs=CRS_internal)
-    assert street_graph_edges["key"].nunique() == 1
-    assert len(street_graph_edges) == len(street_graph_edges.reset_index().drop_duplicates(["u", "v"]))
-
-    print(
-        "Street graph size",
-        len(street_graph_nodes),
-        len(street_graph_edges),
-        "Lane graph size",
-        G_lane.number_of_nodes(),
-        G_lane.number_of_edges(),
-    )
+    street_graph_edges, G_lane = load_city_graphs(data_directory)
 
     # initialize with the original lanes
     street_graph_edges[out_attr_name] = street_graph_edges["ln_desc"]
@@ -203,18 +368,25 @@ def rebuild_street_network_parallel(
     )
 
     # 2) Prepare arguments for processing each region
-    args_list = []
+    # assign all nodes to the regions at once (instead of cutting out each region from the whole graph)
+    region_nodes = partition_graph_by_regions(G_lane, rebuilding_regions_gdf)
+    print("Partitioned lane graph into regions", time.time() - tic)
+    args_list, costs, shared_regions = [], [], []
     index_counter, put_to_end = 0, []
+    # results of regions whose inputs did not change since the last run are loaded instead of recomputed
+    manifest = load_manifest(output_path)
+    results, region_names, region_hashes = {}, [], []
+    if queue_dir is not None:
+        queue = TaskQueue(queue_dir)
+        # the tasks are identified by the input hash of their region, so that the tasks of an interrupted run with the
+        # same inputs are continued, and their finished results are collected below
+        queued_tasks, task_indices = queue.task_statuses(), {}
     for i, rebuilding_region in rebuilding_regions_gdf.iterrows():
-        # get the region polygon
-        polygon = rebuilding_region["geometry"]
-
         # make a graph cutout based on the region geometry and skip this region if the resulting subgraph is empty
-        try:
-            G_lane_region = osmnx.truncate.truncate_graph_polygon(G_lane, polygon, quadrat_width=100, retain_all=True)
-        except ValueError:
+        if i not in region_nodes:
             # print("Skipping empty region ", i)
             continue
+        G_lane_region = G_lane.subgraph(region_nodes[i]).copy()
         if len(G_lane_region.edges) == 0:
             # print("Skipping empty region ", i)
             continue
@@ -249,7 +421,7 @@ def rebuild_street_network_parallel(
 
         # make OD matrix for this region
         node_gdf = nodes_to_geodataframe(G_lane_region, crs=CRS_internal)
-        od_df = match_od_with_nodes(station_data_path=whole_city_od_path, nodes=node_gdf)
+        od_df = match_od_with_nodes(station_data_path=whole_city_od_path, nodes=node_gdf, cache_dir=od_cache_dir)
         if "main" in name:
             print("reducing OD matrix size...")
             od_df = reduce_od_by_trip_ratio(od_df, REDUCE_OD_FOR_MAIN_ROADS)
@@ -263,37 +435,152 @@ def rebuild_street_network_parallel(
         )
 
         save_intermediate_path = os.path.join(output_path, f"rebuild_region_{name}_graph.csv")
+        region_names.append(name)
+        region_hashes.append(region_input_hash(G_lane_region, od_df))
+        if manifest.get(name, {}).get("hash") == region_hashes[-1] and os.path.exists(save_intermediate_path):
+            print("Inputs did not change, loading result from", save_intermediate_path)
+            results[index_counter] = pd.read_csv(save_intermediate_path, index_col=0)
+            args_list.append(None)
+            costs.append(0)
+            shared_regions.append(None)
+            index_counter += 1
+            continue
+
+        # predict the runtime of the region from the size of the LP
+        costs.append(compute_nr_variables(G_lane_region.number_of_edges(), len(od_df)))
+        if queue_dir is not None:
+            # the inputs are published as a task that any worker can claim (the largest regions first)
+            task_indices[region_hashes[-1]] = index_counter
+            if queued_tasks.get(region_hashes[-1]) not in ["pending", "running", "done"]:
+                payload = {"name": name, "G_lane": G_lane_region, "od": od_df, "params": region_parameters()}
+                queue.publish(region_hashes[-1], payload, priority=costs[-1])
+            shared_regions.append(None)
+            args_list.append([None, None, save_intermediate_path])
+            index_counter += 1
+            continue
+        # the inputs are passed to the workers via shared memory instead of pickling the graph and the OD matrix
+        shared_region, region_metadata = region_to_shared_arrays(G_lane_region, od_df)
+        shared_regions.append(shared_region)
 
         # append to input arguments for parallel processing
-        args_list.append([G_lane_region, od_df, save_intermediate_path])
+        args_list.append([shared_region.handle, region_metadata, save_intermediate_path])
         index_counter += 1
 
-    print(f"-----Starting pool of {len(args_list)} processes")
-    # 3) Initialize multiprocessing.Pool()
-    pool = Pool(cpu_count())
+    if od_cache_dir is not None:
+        print("OD matching cache", get_od_matching_cache(od_cache_dir).stats())
+    if queue_dir is not None:
+        # remove the outdated tasks of earlier runs
+        queue.clear(keep=list(task_indices))
+
+    # results of regions that are recomputed are outdated until the region is finished
+    for i, args in enumerate(args_list):
+        if args is not None:
+            manifest.pop(region_names[i], None)
+    save_manifest(output_path, manifest)
+
+    def finish_region(i, optimized_edges):
+        results[i] = optimized_edges
+        # record the finished region, so that it is not recomputed if the run is restarted
+        manifest[region_names[i]] = {"hash": region_hashes[i], "result": os.path.basename(args_list[i][2])}
+        save_manifest(output_path, manifest)
+
+    # 3) Predict the memory of each region from the size of the LP
+    memory = [nr_variables * LP_BYTES_PER_VARIABLE for nr_variables in costs]
+    budget = MemoryBudget(MAX_LP_MEMORY)
+    print(f"-----Starting pool of {cpu_count()} processes for {len(args_list) - len(results)} regions")
+    print(f"Largest region: {max(costs, default=0)} variables (memory {max(memory, default=0) / 1024**3:.1f} GB)")
+
+    # 4) Process the regions in parallel, largest first, and collect the results (the optimized lane edges)
+    try:
+        if queue_dir is not None:
+            print(f"-----Waiting for workers on the queue {queue_dir} (start them with --worker)")
+            for task_id, optimized_edges in queue.iter_results(list(task_indices)):
+                save_region_result(optimized_edges, args_list[task_indices[task_id]][2])
+                finish_region(task_indices[task_id], optimized_edges)
+        else:
+            with Pool(cpu_count()) as pool:
+                scheduled_regions = schedule_regions(args_list, costs, memory, budget)
+                try:
+                    for i, optimized_edges in pool.imap_unordered(optimize_region, scheduled_regions):
+                        budget.release(memory[i])
+                        shared_regions[i].unlink()
+                        finish_region(i, optimized_edges)
+                finally:
+                    # if a worker failed, the scheduler must stop waiting for memory, otherwise the pool cannot be
+                    # terminated
+                    budget.abort()
+    finally:
+        # free the shared memory of all regions, also if a worker failed
+        for shared_region in shared_regions:
+            if shared_region is not None:
+                shared_region.unlink()
+
+    # Combine the results and apply them to the original street graph in one pass. The main roads are applied in the
+    # very end (note: currently not really necessary because bike lanes are never turned back into car lanes)
+    order = [i for i in range(len(args_list)) if i not in put_to_end] + put_to_end
+    street_graph_edges = apply_changes_to_street_graph(street_graph_edges, [results[i] for i in order])
 
-    # 4) Process each region in parallel, collect results (the optimized lane graphs)
-    results = pool.map(optimize_region, args_list)
+    print("----------\nFinished rebuilding whole city", time.time() - tic)
+    save_rebuilt_street_graph(street_graph_edges, output_path)
 
-    # Combine the results and apply to the original street graph
-    for i, optimized_G_lane in enumerate(results):
-        if i in put_to_end:
-            continue
-        street_graph_edges = apply_changes_to_street_graph(
-            street_graph_edges, nx.to_pandas_edgelist(optimized_G_lane, edge_key="key")
-        )
-    # apply main roads in the very end (note: currently not really necessary because bike lanes are never turned back)
-    # into car lanes
-    for i in put_to_end:
-        street_graph_edges = apply_changes_to_street_graph(
-            street_graph_edges, nx.to_pandas_edgelist(results[i], edge_key="key")
-        )
 
-    pool.close()
-    pool.join()
+def rebuild_street_network_multilevel(
+    data_directory: str,
+    output_path: str,
+    whole_city_od_path: str,
+    out_attr_name: str = "ln_desc_after",
+    od_cache_dir: str = OD_CACHE_DIR,
+):
+    """
+    Optimize the whole city at once with the multilevel approach instead of separate rebuilding regions: the
+    arterial network is optimized on a coarse graph, and the neighborhoods between the arterial roads are refined in
+    parallel (see multilevel_optimization)
+    """
+    tic = time.time()
+    street_graph_edges, G_lane = load_city_graphs(data_directory)
+    street_graph_edges[out_attr_name] = street_graph_edges["ln_desc"]
+    G_lane = keep_only_the_largest_connected_component(G_lane)
+    nx.set_edge_attributes(G_lane, False, "fixed")
+
+    node_gdf = nodes_to_geodataframe(G_lane, crs=CRS_internal)
+    od_df = match_od_with_nodes(station_data_path=whole_city_od_path, nodes=node_gdf, cache_dir=od_cache_dir)
+    params = {"valid_edges_k": VALID_EDGES_K, "car_weight": CAR_WEIGHT}
+    optimized_edges = multilevel_optimization(
+        G_lane, od_df, optimize_params=params, edge_fraction=EDGE_FRACTION, num_optimizations=NUM_OPTIMIZATIONS
+    )
+    street_graph_edges = apply_changes_to_street_graph(street_graph_edges, [optimized_edges])
 
     print("----------\nFinished rebuilding whole city", time.time() - tic)
-    # save final result
+    save_rebuilt_street_graph(street_graph_edges, output_path)
+
+
+def load_city_graphs(data_directory: str):
+    """Load the street graph edges and create the lane graph (MultiDiGraph) of the whole city"""
+    # load nodes and edges dataframes
+    street_graph_nodes, street_graph_edges = load_nodes_edges_dataframes(
+        data_directory,
+        node_fn="street_graph_nodes.gpkg",
+        edge_fn="street_graph_edges.gpkg",
+        remove_multistreets=True,
+        target_crs=CRS_internal,
+    )
+    # create lane graph
+    G_lane = street_to_lane_graph(street_graph_nodes, street_graph_edges, target_crs=CRS_internal)
+    assert street_graph_edges["key"].nunique() == 1
+    assert len(street_graph_edges) == len(street_graph_edges.reset_index().drop_duplicates(["u", "v"]))
+
+    print(
+        "Street graph size",
+        len(street_graph_nodes),
+        len(street_graph_edges),
+        "Lane graph size",
+        G_lane.number_of_nodes(),
+        G_lane.number_of_edges(),
+    )
+    return street_graph_edges, G_lane
+
+
+def save_rebuilt_street_graph(street_graph_edges, output_path: str):
     try:
         street_graph_edges.to_file(os.path.join(output_path, "rebuild_whole_graph.gpkg"))
     except:
@@ -311,14 +598,37 @@ if __name__ == "__main__":
     parser.add_argument(
         "-w", "--od_path", type=str, default="../street_network_data/zurich/raw_od_matrix/od_whole_city.csv"
     )
+    parser.add_argument("-c", "--od_cache_dir", type=str, default=OD_CACHE_DIR, help="directory to cache OD matrices")
+    parser.add_argument("--no_od_cache", action="store_true", help="match the OD matrices without the cache")
+    parser.add_argument(
+        "-m", "--multilevel", action="store_true", help="optimize the whole city at once instead of separate regions"
+    )
+    parser.add_argument(
+        "-q", "--queue_dir", type=str, default=None, help="shared directory of the work queue (distributed mode)"
+    )
+    parser.add_argument("--worker", action="store_true", help="process regions from the work queue in --queue_dir")
+    parser.add_argument(
+        "--idle_timeout", type=float, default=None, help="stop the worker after this many seconds without tasks"
+    )
     args = parser.parse_args()
+    if args.no_od_cache:
+        args.od_cache_dir = None
+
+    if args.worker:
+        run_region_worker(args.queue_dir, idle_timeout=args.idle_timeout)
+        exit()
 
     data_dir = args.data_dir
     output_dir = args.out_dir
     os.makedirs(output_dir, exist_ok=True)
 
-    # snman_rebuilding(data_dir, output_dir, args.od_path)
+    # snman_rebuilding(data_dir, output_dir, args.od_path, od_cache_dir=args.od_cache_dir)
 
     # rebuild_street_network(data_dir, output_dir, args.od_path)
 
-    rebuild_street_network_parallel(data_dir, output_dir, args.od_path)
+    if args.multilevel:
+        rebuild_street_network_multilevel(data_dir, output_dir, args.od_path, od_cache_dir=args.od_cache_dir)
+    else:
+        rebuild_street_network_parallel(
+            data_dir, output_dir, args.od_path, od_cache_dir=args.od_cache_dir, queue_dir=args.queue_dir
+        )
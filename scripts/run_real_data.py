@@ -17,6 +17,7 @@ from ebike_city_tools.od_utils import extend_od_circular
 from ebike_city_tools.optimize.rounding_utils import combine_paretos_from_path, combine_pareto_frontiers
 from ebike_city_tools.iterative_algorithms import betweenness_pareto, topdown_betweenness_pareto
 from ebike_city_tools.optimize.round_optimized import ParetoRoundOptimize
+from ebike_city_tools.optimize.linear_program import LPModelCache
 
 ROUNDING_METHOD = "round_bike_optimize"
 IGNORE_FIXED = True
@@ -39,7 +40,9 @@ if __name__ == "__main__":
     parser.add_argument("-i", "--instance", default="affoltern", type=str)
     parser.add_argument("-o", "--out_path", default="outputs", type=str)
     parser.add_argument("-k", "--optimize_every_k", default=50, type=int, help="how often to re-optimize")
-    parser.add_argument("-c", "--car_weight", default=1, type=float, help="weighting of cars in objective function")
+    parser.add_argument(
+        "-c", "--car_weight", default=[1], type=float, nargs="+", help="weighting of cars in objective function"
+    )
     parser.add_argument(
         "-v", "--valid_edges_k", default=0, type=int, help="if subsampling edges, the number of nodes around SP"
     )
@@ -130,7 +133,10 @@ if __name__ == "__main__":
 
     # tune the car_weight
     runtimes_pareto = []
-    for car_weight in [float(args.car_weight)]:  # [0.1, 0.25, 0.5, 1, 2, 4, 8]:
+    # the LPs for different car weights and fixed edges only differ in the objective and the variable bounds, so one
+    # model is reused for the whole sweep
+    lp_cache = LPModelCache(max_models=1)
+    for car_weight in args.car_weight:  # [0.1, 0.25, 0.5, 1, 2, 4, 8]:
         print(f"Running LP for pareto frontier (car weight={car_weight})...")
 
         # set the filename to save the results
@@ -157,6 +163,7 @@ if __name__ == "__main__":
             shared_lane_factor=shared_lane_factor,
             weight_od_flow=WEIGHT_OD_FLOW,
             valid_edges_k=args.valid_edges_k,
+            lp_cache=lp_cache,
         )
         # RUN pareto optimization, potentially with saving the graph after each optimization step
         save_graph_path = os.path.join(out_path, fn_with_parameters) if args.save_graph else None
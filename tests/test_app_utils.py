@@ -0,0 +1,38 @@
+import networkx as nx
+import pandas as pd
+
+from ebike_city_tools.app_utils import get_network_bearings, compute_run_summary
+
+
+def make_car_lane_graph():
+    G_lane = nx.MultiDiGraph()
+    for node in range(4):
+        G_lane.add_node(node, x=float(node), y=float(node % 2))
+    for node in range(3):
+        G_lane.add_edge(node, node + 1, lanetype="M>", distance=1)
+        G_lane.add_edge(node + 1, node, lanetype="M>", distance=1)
+    return G_lane
+
+
+def test_network_bearings_without_paths():
+    G_lane = make_car_lane_graph()
+    assert get_network_bearings(G_lane, "M", "distance") > 0
+    # no bike lanes, or no sampled sources
+    assert get_network_bearings(G_lane, "P", "distance") is None
+    assert get_network_bearings(G_lane, "P", "distance", return_ci=True)["mean"] is None
+    assert get_network_bearings(G_lane, "M", "distance", sample_size=0, return_ci=True)["sources"] == 0
+
+
+def test_run_summary_without_bike_lanes():
+    G_lane = make_car_lane_graph()
+    nx.set_edge_attributes(G_lane, 0, "gradient")
+    nx.set_edge_attributes(G_lane, 30, "speed_limit")
+    project_edges = nx.to_pandas_edgelist(G_lane, edge_key="edge_key")
+    nodes = pd.DataFrame([{"osmid": node, **data} for node, data in G_lane.nodes(data=True)])
+    od = pd.DataFrame({"s": [0, 3], "t": [3, 0], "trips": [1, 1]})
+    # e.g. a run with desired_edge_count=0
+    run_output = project_edges[["source", "target", "edge_key", "lanetype"]]
+    summary = compute_run_summary(project_edges, od, run_output, nodes=nodes)
+    assert summary["distance_bike"] is None and summary["distance_car"] == 6
+    assert summary["bike_network_bearings"] is None
+    assert summary["car_network_bearings"] > 0
@@ -0,0 +1,30 @@
+import pandas as pd
+
+from ebike_city_tools.graph_utils import clean_street_graph_multiedges, clean_street_graph_directions
+
+
+def make_street_edges():
+    return pd.DataFrame(
+        {
+            "u": [1, 1, 2, 3, 2, 4],
+            "v": [2, 2, 1, 4, 3, 3],
+            "key": [0, 1, 0, 0, 0, 0],
+            "ln_desc": ["M> | P", "P | L>", "M- | H<", "M<", "M>", "M- | P"],
+        }
+    )
+
+
+def test_clean_street_graph_multiedges():
+    edges = clean_street_graph_multiedges(make_street_edges())
+    assert list(edges.index) == [(1, 2), (2, 1), (3, 4), (2, 3), (4, 3)]
+    assert edges.loc[(1, 2), "ln_desc"] == "M> | P | L>"
+    assert edges.loc[(2, 1), "ln_desc"] == "M- | H<"
+
+
+def test_clean_street_graph_directions():
+    edges = clean_street_graph_directions(clean_street_graph_multiedges(make_street_edges()))
+    # the edge with u < v is removed and its (reversed) lanes are appended to the opposite edge
+    assert list(edges.index) == [(2, 1), (2, 3), (4, 3)]
+    assert edges.loc[(2, 1), "ln_desc"] == "M> | H< | M< | P | L<"
+    assert edges.loc[(4, 3), "ln_desc"] == "M> | P | M>"
+    assert edges.loc[(2, 3), "ln_desc"] == "M>"
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+from ebike_city_tools.synthetic import random_lane_graph, make_fake_od
+from ebike_city_tools.od_utils import extend_od_circular
+from ebike_city_tools.optimize.round_optimized import ParetoRoundOptimize
+from ebike_city_tools.optimize.linear_program import LPModelCache, define_IP, car_weight_pareto_frontier
+
+
+def make_problem(n=10, seed=0):
+    np.random.seed(seed)
+    G_lane = random_lane_graph(n)
+    od = extend_od_circular(make_fake_od(n, 10, nodes=G_lane.nodes), list(G_lane.nodes))
+    return G_lane, od
+
+
+def test_lp_cache_hits_across_car_weights():
+    G_lane, od = make_problem()
+    lp_cache = LPModelCache()
+    for car_weight in [1, 2]:
+        opt = ParetoRoundOptimize(
+            G_lane.copy(), od.copy(), optimize_every_x=5, car_weight=car_weight, lp_cache=lp_cache
+        )
+        opt.pareto()
+    # all LPs of both pareto frontiers (with different fixed edges) use the same model
+    assert lp_cache.misses == 1
+    assert lp_cache.hits > 2
+
+
+def test_lp_cache_fixed_edges():
+    G_lane, od = make_problem()
+    G_street = ParetoRoundOptimize(G_lane, od).G_street
+    u, v = next((u, v) for u, v in G_street.edges if G_street.has_edge(v, u))
+    capacity = G_street.edges[u, v]["capacity"]
+    fixed_edges = pd.DataFrame(
+        [
+            {"Edge": (u, v), "u_b(e)": 1, "capacity": capacity, "u_c(e)": 0},
+            {"Edge": (v, u), "u_b(e)": 1, "capacity": capacity, "u_c(e)": 0},
+        ]
+    )
+    lp_cache = LPModelCache()
+    for fixed in [pd.DataFrame(), fixed_edges, pd.DataFrame()]:
+        expected = define_IP(G_street, od_df=od, fixed_edges=fixed, car_weight=2)
+        expected.verbose = False
+        expected.optimize()
+        cached = lp_cache.get_model(G_street, od_df=od, fixed_edges=fixed, car_weight=2)
+        cached.verbose = False
+        cached.optimize()
+        assert np.isclose(cached.objective_value, expected.objective_value)
+    assert lp_cache.hits == 2
+
+
+def test_car_weight_pareto_frontier():
+    G_lane, od = make_problem()
+    G_street = ParetoRoundOptimize(G_lane, od).G_street
+    pareto_df, capacities = car_weight_pareto_frontier(G_street, od_df=od, min_car_weight=0.1, max_car_weight=10)
+    assert len(capacities) == len(pareto_df)
+    # the intervals of the solutions cover the weights without gaps, and the trade-off is monotonic
+    assert pareto_df["car_weight_min"].iloc[0] == 0.1 and pareto_df["car_weight_max"].iloc[-1] == 10
+    assert (pareto_df["car_weight_max"].values[:-1] == pareto_df["car_weight_min"].values[1:]).all()
+    assert (pareto_df["car_weight_min"] < pareto_df["car_weight_max"]).all()
+    assert pareto_df["car_objective"].is_monotonic_decreasing
+    assert pareto_df["bike_objective"].is_monotonic_increasing
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+from ebike_city_tools.optimize.multilevel import multilevel_optimization
+
+
+def make_grid_lane_graph(n=5, main_road_every=4):
+    """Grid of two-way streets, every main_road_every-th row and column is a main road with two lanes per direction"""
+    G_lane = nx.MultiDiGraph()
+    for i in range(n):
+        for j in range(n):
+            G_lane.add_node(i * n + j, x=i * 100.0, y=j * 100.0, elevation=0.0, loc=np.array([i * 100.0, j * 100.0]))
+
+    def add_street(u, v, is_main):
+        for source, target in [(u, v), (v, u)]:
+            for key in range(2 if is_main else 1):
+                G_lane.add_edge(
+                    source,
+                    target,
+                    key=key,
+                    lanetype="M",
+                    distance=0.1,
+                    capacity=1,
+                    gradient=0,
+                    speed_limit=50 if is_main else 30,
+                    fixed=False,
+                    hierarchy="1_main_road" if is_main else "4_local",
+                )
+
+    for i in range(n):
+        for j in range(n):
+            if i + 1 < n:
+                add_street(i * n + j, (i + 1) * n + j, j % main_road_every == 0)
+            if j + 1 < n:
+                add_street(i * n + j, i * n + j + 1, i % main_road_every == 0)
+    return G_lane
+
+
+def test_multilevel_optimization_covers_all_lanes():
+    np.random.seed(0)
+    G_lane = make_grid_lane_graph()
+    nodes = list(G_lane.nodes)
+    # a one-way dead end inside the neighborhood (not strongly connected) and a small neighborhood at a main road
+    lane_attrs = G_lane.edges[6, 7, 0]
+    G_lane.add_node(100, x=150.0, y=150.0, elevation=0.0, loc=np.array([150.0, 150.0]))
+    G_lane.add_edge(6, 100, key=0, **lane_attrs)
+    G_lane.add_node(101, x=-100.0, y=0.0, elevation=0.0, loc=np.array([-100.0, 0.0]))
+    G_lane.add_edge(0, 101, key=0, **lane_attrs)
+    G_lane.add_edge(101, 0, key=0, **lane_attrs)
+    od = pd.DataFrame({"s": np.random.choice(nodes, 40), "t": np.random.choice(nodes, 40)})
+    od = od[od["s"] != od["t"]].drop_duplicates(subset=["s", "t"]).assign(trips=1)
+
+    optimized_edges = multilevel_optimization(G_lane, od, optimize_params={"car_weight": 2}, processes=1)
+
+    # every input lane is in the output exactly once (plus the helper lanes in the opposite direction of bike lanes)
+    is_helper = optimized_edges["key"].astype(str).str.contains("revbike")
+    output_lanes = list(zip(optimized_edges.loc[~is_helper, "source"], optimized_edges.loc[~is_helper, "target"]))
+    output_lanes = [(u, v, k) for (u, v), k in zip(output_lanes, optimized_edges.loc[~is_helper, "key"])]
+    assert sorted(output_lanes) == sorted(G_lane.edges(keys=True))
+    assert (optimized_edges["lanetype"] == "P").any()
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+from ebike_city_tools.utils import iter_shortest_paths, valid_arcs_spatial_selection
+
+
+def make_grid(n=8):
+    G = nx.DiGraph(nx.grid_2d_graph(n, n))
+    G = nx.convert_node_labels_to_integers(G, label_attribute="pos")
+    for node, data in G.nodes(data=True):
+        data["loc"] = np.array(data.pop("pos"), dtype=float)
+    return G
+
+
+def make_od(G, nr_pairs=30, seed=0):
+    rng = np.random.default_rng(seed)
+    od = pd.DataFrame({"s": rng.choice(G.number_of_nodes(), nr_pairs), "t": rng.choice(G.number_of_nodes(), nr_pairs)})
+    return od[od["s"] != od["t"]].drop_duplicates()
+
+
+def test_iter_shortest_paths():
+    G = make_grid()
+    od = make_od(G)
+    paths = list(iter_shortest_paths(od, G))
+    assert len(paths) == len(od)
+    for s, t, path in paths:
+        assert path[0] == s and path[-1] == t
+        assert all(G.has_edge(u, v) for u, v in zip(path[:-1], path[1:]))
+        assert len(path) - 1 == nx.shortest_path_length(G, s, t)
+
+
+def test_valid_arcs_spatial_selection():
+    G = make_grid()
+    od = make_od(G)
+    # a node without location that is not on any path
+    G.add_edge(100, 0)
+    G.add_edge(0, 100)
+    k_closest = 5
+    locs = nx.get_node_attributes(G, "loc")
+    loc_array = np.array([locs[node] for node in sorted(locs)])
+    valid_arcs = valid_arcs_spatial_selection(od, G, k_closest)
+    for s, t, path in iter_shortest_paths(od, G):
+        arcs = set(valid_arcs[(s, t)])
+        # the arcs of the path are included
+        assert all((u, v) in arcs for u, v in zip(path[:-1], path[1:]))
+        # all selected nodes are among the k closest nodes (up to ties) of a node on the path
+        selected = {node for arc in arcs for node in arc}
+        for node in selected:
+            dist = [np.linalg.norm(locs[node] - locs[p]) for p in path]
+            kth_dist = [np.sort(np.linalg.norm(loc_array - locs[p], axis=1))[k_closest - 1] for p in path]
+            assert any(d <= kth + 1e-9 for d, kth in zip(dist, kth_dist))
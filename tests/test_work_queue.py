@@ -0,0 +1,61 @@
+import os
+import multiprocessing
+
+from ebike_city_tools.work_queue import TaskQueue, run_worker
+
+
+def square_or_fail_once(payload):
+    value, marker_dir = payload
+    # the first attempt of every odd value fails, to test the retries
+    marker = os.path.join(marker_dir, f"failed_{value}")
+    if value % 2 == 1 and not os.path.exists(marker):
+        open(marker, "w").close()
+        raise ValueError("first attempt fails")
+    return value**2
+
+
+def test_workers_process_all_tasks(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    queue = TaskQueue(queue_dir)
+    for value in range(10):
+        queue.publish(f"task_{value}", (value, str(tmp_path)), priority=value)
+
+    workers = [
+        multiprocessing.Process(
+            target=run_worker, args=(queue_dir, square_or_fail_once), kwargs={"poll_interval": 0.05, "idle_timeout": 1}
+        )
+        for _ in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    results = dict(queue.iter_results([f"task_{value}" for value in range(10)], poll_interval=0.05))
+    for worker in workers:
+        worker.join()
+
+    assert results == {f"task_{value}": value**2 for value in range(10)}
+    assert queue.status() == {"done": 10}
+
+
+def test_expired_lease_is_claimed_by_another_worker(tmp_path):
+    queue = TaskQueue(str(tmp_path), lease_seconds=0, max_attempts=2)
+    queue.publish("task", "payload")
+    assert queue.claim("worker_1") == ("task", "payload")
+    # worker_1 did not renew the lease -> the task is given to worker_2, and the result of worker_1 is discarded
+    assert queue.claim("worker_2") == ("task", "payload")
+    assert not queue.complete("task", "worker_1", "result_1")
+    assert queue.complete("task", "worker_2", "result_2")
+    assert list(queue.iter_results()) == [("task", "result_2")]
+
+
+def test_clear_keeps_finished_results(tmp_path):
+    queue = TaskQueue(str(tmp_path))
+    for task_id in ["task_1", "task_2"]:
+        queue.publish(task_id, "payload")
+        assert queue.claim("worker") == (task_id, "payload")
+        queue.complete(task_id, "worker", f"result_{task_id}")
+    queue.publish("task_3", "payload")
+    # the outdated task_2 is removed, the result of task_1 is still collected
+    queue.clear(keep=["task_1", "task_3"])
+    assert queue.task_statuses() == {"task_1": "done", "task_3": "pending"}
+    assert list(queue.iter_results(["task_1"])) == [("task_1", "result_task_1")]
+    assert not os.path.exists(tmp_path / "results" / "task_2.pkl")